@@ -4,10 +4,14 @@ Execute them on the exchange
 
 eventually the order generation will be a separate component from the algo
 '''
+from __future__ import print_function
 import unittest
 from exchange import Order, Exchange
-from mock import Mock
-from itertools import islice, ifilter
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+from itertools import islice
 import random
 from market_maker import MarketMaker
 import logging
@@ -47,16 +51,17 @@ class TestOrderGenerator(unittest.TestCase):
     def test_buy_sell_is_random(self):
         # When 100 orders are generated
         # Then some, but not not all of them are buy order
-        buy_orders = list(ifilter( lambda x: x.buy_sell == 'buy', islice(order_gen(),100)))
+        buy_orders = list(filter( lambda x: x.buy_sell == 'buy', islice(order_gen(),100)))
         self.assertTrue(len(buy_orders) > 0)
         self.assertTrue(len(buy_orders) < 100)
 
 class SimpleAlgo(object):
     
     def __init__(self, order_gen):
-        self.order_gen = order_gen
+        """order_gen is called once to make the generator of orders to submit"""
+        self.orders = order_gen()
     def __call__(self, exchange):
-        order = next(self.order_gen())
+        order = next(self.orders)
         exchange.submit_order(order)
 
 class TestSimpleAlgo(unittest.TestCase):
@@ -70,16 +75,28 @@ class TestSimpleAlgo(unittest.TestCase):
         exchange.do_trading()
         # A trade is added to the order book
         self.assertEqual(len(exchange.order_book()), 1)
+    def test_one_generator_for_all_calls(self):
+        # Given an algo with an order generator that can only be made once
+        order_gen_mock = Mock(return_value=iter([Order('buy',100), Order('sell',100)]))
+        algo = SimpleAlgo(order_gen_mock)
+        exchange = Exchange()
+        exchange.add_client(algo)
+        # When it is called twice
+        exchange.do_trading()
+        exchange.do_trading()
+        # Then both orders are submitted in turn
+        self.assertEqual(order_gen_mock.call_count, 1)
+        self.assertEqual(exchange.order_book(), [Order('buy',100), Order('sell',100)])
 
 def test_run():
     exchange = Exchange()
     exchange.add_client(MarketMaker())
     exchange.add_client(SimpleAlgo(order_gen))
     for i in range(100):
-        print 'Round: ', i
+        print('Round: ', i)
         exchange.do_trading()
         trades = exchange.match_orders()
-        print exchange.last_trade()
+        print(exchange.last_trade())
         
 
 if __name__ == "__main__":
@@ -0,0 +1,137 @@
+'''
+Asyncio trading rounds
+
+Run an exchange's clients as asyncio tasks so that coroutine clients can do
+I/O, such as loading signals or fetching model outputs, at the same time as
+each other. Each client is called with its own context rather than through
+exchange.current_client. Clients still act on the exchange one at a time in the
+order they were registered, as in Exchange.do_trading, so a round gives the
+same result however long each client's I/O takes.
+'''
+import asyncio
+import inspect
+import logging
+import unittest
+from exchange import ClientContext, Exchange, Order
+from market_maker import MarketMaker
+
+logger = logging.getLogger(__name__)
+
+class AsyncClientContext(object):
+    """An exchange as seen by one coroutine client
+
+    Exchange methods are coroutines here. Each waits until the clients
+    registered before this one have finished, then acts for this client.
+    Other attributes are passed through to the exchange.
+    """
+    def __init__(self, context, turn=None):
+        self._context = context
+        self._turn = turn
+    def __getattr__(self, name):
+        attribute = getattr(self._context, name)
+        if not callable(attribute):
+            return attribute
+        async def call_in_turn(*args, **kwargs):
+            if self._turn is not None:
+                await self._turn.wait()
+            return attribute(*args, **kwargs)
+        return call_in_turn
+
+def is_coroutine_client(client):
+    """Return True if calling the client returns a coroutine"""
+    return (inspect.iscoroutinefunction(client) or
+            inspect.iscoroutinefunction(getattr(client, '__call__', None)))
+
+async def do_trading_async(exchange):
+    """Call every client of the exchange once, concurrently
+
+    Coroutine clients are called with an AsyncClientContext and other clients
+    with a ClientContext once the clients before them have finished.
+    """
+    logger.debug('do_trading_async called')
+    tasks = []
+    previous_done = None
+    for client_id, client in enumerate(exchange.clients()):
+        done = asyncio.Event()
+        tasks.append(asyncio.ensure_future(
+            _run_client(exchange, client_id, client, previous_done, done)))
+        previous_done = done
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+async def _run_client(exchange, client_id, client, previous_done, done):
+    try:
+        context = ClientContext(exchange, client_id)
+        logger.debug('calling client %s', client_id)
+        if is_coroutine_client(client):
+            await client(AsyncClientContext(context, previous_done))
+        else:
+            if previous_done is not None:
+                await previous_done.wait()
+            client(context)
+    finally:
+        done.set()
+
+class TestAsyncTrading(unittest.TestCase):
+
+    def test_submissions_in_registration_order(self):
+        # given a slow coroutine client registered before a fast one
+        async def slow_client(exchange):
+            await asyncio.sleep(0.02)
+            await exchange.submit_order(Order('buy',100,10.0))
+        async def fast_client(exchange):
+            await exchange.submit_order(Order('sell',100,11.0))
+        exchange = Exchange()
+        exchange.add_client(slow_client)
+        exchange.add_client(fast_client)
+        # when a round is run
+        asyncio.run(do_trading_async(exchange))
+        # then the slow client's order still reached the book first
+        buy_order, sell_order = exchange.order_book()
+        self.assertTrue(buy_order.order_id < sell_order.order_id)
+        self.assertEqual(exchange._order_book.owner(buy_order.order_id), 0)
+        self.assertEqual(exchange._order_book.owner(sell_order.order_id), 1)
+        self.assertEqual(exchange.current_client, None)
+
+    def test_clients_wait_concurrently(self):
+        # given a client that can only finish once a later client has started
+        started = []
+        async def waiting_client(exchange):
+            while not started:
+                await asyncio.sleep(0)
+            await exchange.submit_order(Order('buy',100,10.0))
+        async def later_client(exchange):
+            started.append(True)
+            await exchange.submit_order(Order('sell',100,11.0))
+        exchange = Exchange()
+        exchange.add_client(waiting_client)
+        exchange.add_client(later_client)
+        # then the round completes
+        asyncio.run(asyncio.wait_for(do_trading_async(exchange), 1.0))
+        self.assertEqual(len(exchange.order_book()), 2)
+
+    def test_same_result_as_do_trading(self):
+        # given synchronous clients that use the exchange as before
+        def order_client(exchange):
+            bid, offer = exchange.bid_offer()
+            exchange.submit_order(Order('sell',100,offer * 1.05))
+        def run(do_round):
+            exchange = Exchange()
+            exchange.add_client(order_client)
+            exchange.add_client(MarketMaker())
+            exchange.current_client = 5
+            exchange.submit_order(Order('buy',150,99.5))
+            for _ in range(3):
+                do_round(exchange)
+                exchange.match_orders()
+            return [(order.order_id, order.buy_sell, order.quantity, order.price)
+                    for order in exchange.order_book()]
+        # then running them asynchronously gives the same book
+        self.assertEqual(run(lambda exchange: asyncio.run(do_trading_async(exchange))),
+                         run(Exchange.do_trading))
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
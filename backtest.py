@@ -0,0 +1,351 @@
+'''
+Backtest driver
+
+run_backtest replays historical order and cancel events into an exchange
+round by round, calling the exchange's registered clients (the strategies
+being tested) and matching after each round's events, as in a live session.
+Events are streamed from a CSV or binary file, so a file of any length is
+replayed in bounded memory. The fills are written to a directory as one
+binary column per field, and summary statistics to summary.json in the same
+directory.
+
+A CSV file has a header naming at least the columns round, event ('order'
+or 'cancel'), client, side, quantity, price and ref, and optionally symbol.
+An empty price is an order without one. ref is the file's own ID for an
+order, which later cancels refer to. Rows must be in round order.
+write_binary_events converts events to the binary format, which is read
+through a memory map and is several times faster to replay.
+
+Historical client IDs are integers. They are offset by HISTORY_CLIENT_BASE on
+the exchange so as not to clash with the IDs of registered clients.
+'''
+import csv
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from array import array
+from collections import namedtuple
+from itertools import groupby
+from operator import attrgetter
+from exchange import SIDES, ClientContext, Exchange, Order
+from market_maker import MarketMaker
+
+Event = namedtuple('Event', 'round,event,client,side,quantity,price,symbol,ref')
+ORDER, CANCEL = 'order', 'cancel'
+
+HISTORY_CLIENT_BASE = 1 << 32
+
+MAGIC = b'EXEVTS01'
+SYMBOL_SIZE = 16
+# round, cancel, side, has symbol, client, quantity, price (NaN for none), ref, symbol
+EVENT_RECORD = struct.Struct('<qBBBxxxxxqqdq%ds' % SYMBOL_SIZE)
+
+# fill columns, in the order written, with their array type codes; client IDs
+# of None are written as -1 and symbols as their position in the summary's list
+FILL_COLUMNS = (('round', 'q'), ('symbol', 'q'), ('buy_order_id', 'q'), ('sell_order_id', 'q'),
+                ('buyer', 'q'), ('seller', 'q'), ('price', 'd'), ('quantity', 'q'))
+NO_CLIENT = -1
+
+def read_csv_events(path):
+    """Yield the Events in a CSV file, one row at a time"""
+    with open(path) as csv_file:
+        rows = csv.reader(csv_file)
+        columns = dict((name.strip(), i) for i, name in enumerate(next(rows)))
+        symbol_column = columns.get('symbol')
+        round_column, event_column, client_column, side_column, quantity_column, \
+            price_column, ref_column = [columns[name] for name in
+                                        ('round', 'event', 'client', 'side', 'quantity', 'price',
+                                         'ref')]
+        for row in rows:
+            if not row:
+                continue
+            price = row[price_column]
+            symbol = row[symbol_column] if symbol_column is not None else ''
+            yield Event(int(row[round_column]), row[event_column], int(row[client_column]),
+                        row[side_column], int(row[quantity_column] or 0),
+                        float(price) if price else None, symbol or None, int(row[ref_column]))
+
+def write_binary_events(events, path):
+    """Write Events to a binary event file
+
+    Symbols are stored in up to SYMBOL_SIZE bytes of UTF-8; a longer one
+    raises ValueError.
+    """
+    pack = EVENT_RECORD.pack
+    with open(path, 'wb') as event_file:
+        event_file.write(MAGIC)
+        for event in events:
+            symbol = b''
+            if event.symbol is not None:
+                symbol = event.symbol.encode('utf-8')
+                if len(symbol) > SYMBOL_SIZE:
+                    raise ValueError('symbol %r is longer than %s bytes in UTF-8' %
+                                     (event.symbol, SYMBOL_SIZE))
+            event_file.write(pack(
+                event.round, event.event == CANCEL, SIDES.index(event.side) if event.side else 0,
+                event.symbol is not None, event.client, event.quantity,
+                float('nan') if event.price is None else event.price, event.ref, symbol))
+
+def read_binary_events(path):
+    """Yield the Events in a binary event file, read through a memory map"""
+    with open(path, 'rb') as event_file:
+        if event_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not an event file' % path)
+        size = os.fstat(event_file.fileno()).st_size
+        if size == len(MAGIC):
+            return
+        data = mmap.mmap(event_file.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            offsets = range(len(MAGIC), size - EVENT_RECORD.size + 1, EVENT_RECORD.size)
+            unpack_from = EVENT_RECORD.unpack_from
+            for offset in offsets:
+                (round_number, cancel, side, has_symbol, client, quantity, price, ref,
+                 symbol) = unpack_from(data, offset)
+                yield Event(round_number, CANCEL if cancel else ORDER, client, SIDES[side], quantity,
+                            None if price != price else price,
+                            symbol.rstrip(b'\0').decode('utf-8') if has_symbol else None, ref)
+        finally:
+            data.close()
+
+def read_events(path):
+    """Yield the Events in a binary event file, or else a CSV file"""
+    with open(path, 'rb') as event_file:
+        binary = event_file.read(len(MAGIC)) == MAGIC
+    return read_binary_events(path) if binary else read_csv_events(path)
+
+class FillWriter(object):
+    """Writes fills to a directory as one binary column file per field
+
+    Fills are buffered and appended to the files CHUNK_SIZE at a time.
+    """
+    CHUNK_SIZE = 65536
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.symbols = []
+        self._symbol_indexes = {}
+        self._columns = [array(code) for _, code in FILL_COLUMNS]
+        self._files = [open(os.path.join(directory, name + '.bin'), 'wb')
+                       for name, _ in FILL_COLUMNS]
+    def write(self, round_number, trades):
+        rounds, symbols, buy_ids, sell_ids, buyers, sellers, prices, quantities = self._columns
+        for trade in trades:
+            symbol_index = self._symbol_indexes.get(trade.symbol)
+            if symbol_index is None:
+                symbol_index = self._symbol_indexes[trade.symbol] = len(self.symbols)
+                self.symbols.append(trade.symbol)
+            rounds.append(round_number)
+            symbols.append(symbol_index)
+            buy_ids.append(trade.buy_id)
+            sell_ids.append(trade.sell_id)
+            buyers.append(NO_CLIENT if trade.buyer is None else trade.buyer)
+            sellers.append(NO_CLIENT if trade.seller is None else trade.seller)
+            prices.append(trade.price)
+            quantities.append(trade.quantity)
+        if len(rounds) >= self.CHUNK_SIZE:
+            self.flush()
+    def flush(self):
+        for column, column_file in zip(self._columns, self._files):
+            column.tofile(column_file)
+            del column[:]
+            column_file.flush()
+    def close(self):
+        self.flush()
+        for column_file in self._files:
+            column_file.close()
+
+def read_fills(directory):
+    """Return the fill columns written to a directory as a dict of arrays"""
+    columns = {}
+    for name, code in FILL_COLUMNS:
+        column = array(code)
+        with open(os.path.join(directory, name + '.bin'), 'rb') as column_file:
+            column.frombytes(column_file.read())
+        columns[name] = column
+    return columns
+
+class Summary(object):
+    """Statistics of a backtest, accumulated as it runs"""
+    def __init__(self):
+        self.rounds = 0
+        self.orders = 0
+        self.cancels = 0
+        # cancels of orders no longer in the book, as when already filled
+        self.missed_cancels = 0
+        self.trades = 0
+        self.volume = 0
+        self.notional = 0.0
+        # symbol: [trades, volume, notional, first, low, high, last]
+        self.symbols = {}
+        # client ID: [bought, sold, cash]
+        self.clients = {}
+    def add_trades(self, trades):
+        for trade in trades:
+            quantity, price = trade.quantity, trade.price
+            value = quantity * price
+            self.trades += 1
+            self.volume += quantity
+            self.notional += value
+            prices = self.symbols.get(trade.symbol)
+            if prices is None:
+                self.symbols[trade.symbol] = [1, quantity, value, price, price, price, price]
+            else:
+                prices[0] += 1
+                prices[1] += quantity
+                prices[2] += value
+                prices[4] = min(prices[4], price)
+                prices[5] = max(prices[5], price)
+                prices[6] = price
+            for client_id, bought, sold, cash in ((trade.buyer, quantity, 0, -value),
+                                                  (trade.seller, 0, quantity, value)):
+                position = self.clients.get(client_id)
+                if position is None:
+                    position = self.clients[client_id] = [0, 0, 0.0]
+                position[0] += bought
+                position[1] += sold
+                position[2] += cash
+    def as_dict(self):
+        """Return the statistics as a dict for JSON
+
+        A client's cash is what its trades have paid and received, with no
+        value put on its position.
+        """
+        symbols = dict((str(symbol), {
+            'trades': trades, 'volume': volume, 'vwap': notional / volume if volume else None,
+            'first': first, 'low': low, 'high': high, 'last': last})
+                       for symbol, (trades, volume, notional, first, low, high, last)
+                       in self.symbols.items())
+        clients = dict((str(client_id), {'bought': bought, 'sold': sold, 'cash': cash})
+                       for client_id, (bought, sold, cash) in self.clients.items())
+        return {'rounds': self.rounds, 'orders': self.orders, 'cancels': self.cancels,
+                'missed_cancels': self.missed_cancels, 'trades': self.trades,
+                'volume': self.volume, 'vwap': self.notional / self.volume if self.volume else None,
+                'symbols': symbols, 'clients': clients}
+
+def run_backtest(events, exchange=None, output_directory=None):
+    """Replay events into an exchange round by round and return a Summary
+
+    Each round's events are applied in order, then the exchange's clients are
+    called with do_trading and the orders matched. The fills are written to
+    output_directory, if given, along with summary.json.
+    """
+    if exchange is None:
+        exchange = Exchange()
+    writer = FillWriter(output_directory) if output_directory is not None else None
+    summary = Summary()
+    contexts = {}
+    # the file's order refs still to be seen in a cancel: ref: (order ID, symbol)
+    refs = {}
+    prune_at = 1024
+    try:
+        for round_number, round_events in groupby(events, attrgetter('round')):
+            for event in round_events:
+                context = contexts.get(event.client)
+                if context is None:
+                    context = contexts[event.client] = ClientContext(
+                        exchange, HISTORY_CLIENT_BASE + event.client)
+                if event.event == ORDER:
+                    refs[event.ref] = (context.submit_order(
+                        Order(event.side, event.quantity, event.price), event.symbol), event.symbol)
+                    summary.orders += 1
+                elif event.event == CANCEL:
+                    order_id, symbol = refs.pop(event.ref, (None, None))
+                    summary.cancels += 1
+                    if order_id is None or not context.cancel_order(order_id, symbol):
+                        summary.missed_cancels += 1
+                else:
+                    raise ValueError('unknown event %r in round %s' % (event.event, round_number))
+            exchange.do_trading()
+            trades = exchange.match_orders()
+            summary.rounds += 1
+            summary.add_trades(trades)
+            if writer is not None:
+                writer.write(round_number, trades)
+            if len(refs) >= prune_at:
+                # forget the refs of filled orders, which will never be cancelled
+                refs = dict((ref, (order_id, symbol)) for ref, (order_id, symbol) in refs.items()
+                            if exchange.instrument(symbol).order_book.order(order_id) is not None)
+                prune_at = max(1024, 2 * len(refs))
+    finally:
+        if writer is not None:
+            writer.close()
+    if output_directory is not None:
+        result = summary.as_dict()
+        result['fill_symbols'] = writer.symbols
+        with open(os.path.join(output_directory, 'summary.json'), 'w') as summary_file:
+            json.dump(result, summary_file, indent=2)
+    return summary
+
+class TestBacktest(unittest.TestCase):
+
+    CSV = '''round,event,client,side,quantity,price,symbol,ref
+1,order,1,buy,100,99.0,,1
+1,order,2,sell,100,101.0,,2
+1,order,1,buy,50,,AAA,3
+2,order,2,sell,40,90.0,,4
+2,order,2,sell,70,10.0,AAA,5
+3,cancel,1,,,,,1
+3,cancel,2,,,,,4
+3,cancel,2,,,,AAA,5
+'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, 'events.csv')
+        with open(self.csv_path, 'w') as csv_file:
+            csv_file.write(self.CSV)
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_csv(self):
+        events = list(read_csv_events(self.csv_path))
+        self.assertEqual(events[0], Event(1, ORDER, 1, 'buy', 100, 99.0, None, 1))
+        self.assertEqual(events[2], Event(1, ORDER, 1, 'buy', 50, None, 'AAA', 3))
+        self.assertEqual(events[5], Event(3, CANCEL, 1, '', 0, None, None, 1))
+
+    def test_binary_round_trip(self):
+        binary_path = os.path.join(self.directory, 'events.bin')
+        write_binary_events(read_csv_events(self.csv_path), binary_path)
+        expected = [event._replace(side=event.side or 'buy') for event in read_csv_events(self.csv_path)]
+        self.assertEqual(list(read_events(binary_path)), expected)
+        self.assertEqual(list(read_events(self.csv_path))[0], expected[0])
+
+    def test_long_symbol(self):
+        binary_path = os.path.join(self.directory, 'events.bin')
+        event = Event(1, ORDER, 1, 'buy', 100, 10.0, 'A' * (SYMBOL_SIZE + 1), 1)
+        self.assertRaises(ValueError, write_binary_events, [event], binary_path)
+
+    def test_run_backtest(self):
+        # given a market maker trading against the historical events
+        exchange = Exchange()
+        exchange.add_client(MarketMaker())
+        output = os.path.join(self.directory, 'output')
+        summary = run_backtest(read_events(self.csv_path), exchange, output)
+        # then the fills are written as columns
+        fills = read_fills(output)
+        self.assertEqual(len(fills['price']), summary.trades)
+        self.assertEqual(sum(fills['quantity']), summary.volume)
+        self.assertEqual(summary.rounds, 3)
+        self.assertEqual((summary.orders, summary.cancels), (5, 3))
+        # the round 2 sell at 90.0 fills the historical bid at 99.0 and the
+        # market maker's offer, requoted below it, fills the rest, so both
+        # cancels of filled orders in round 3 miss
+        self.assertEqual(list(fills['round']), [2, 2, 2])
+        self.assertEqual(summary.missed_cancels, 2)
+        # and the market maker's trades are in the summary
+        with open(os.path.join(output, 'summary.json')) as summary_file:
+            result = json.load(summary_file)
+        self.assertEqual(result['trades'], 3)
+        self.assertEqual(result['clients']['0'], {'bought': 0, 'sold': 60, 'cash': 5940.0})
+        self.assertEqual(result['fill_symbols'], [None, 'AAA'])
+        self.assertEqual(result['symbols']['AAA']['volume'], 50)
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,263 @@
+'''
+Benchmarks for the order book and matching engine
+
+Each benchmark builds a book of a given depth from a seeded order generator,
+then times a number of operations on it one at a time. For each benchmark and
+depth it reports operations per second, latency percentiles and the peak
+memory allocated while building the book and running the operations. The
+memory is measured in a second, untimed run with tracemalloc, which would
+otherwise slow down the timed run.
+
+Run from the command line, for example:
+
+    python benchmark.py --depths 10 1000 --json results.json
+
+Results can be written as JSON for comparing runs.
+'''
+import argparse
+from functools import partial
+import json
+import math
+import platform
+import random
+import sys
+import time
+import tracemalloc
+import unittest
+from algo import SimpleAlgo, order_gen
+from exchange import ClientContext, Exchange, Order, OrderBook, SIDES, orders_from_arrays
+from market_maker import MarketMaker
+
+DEPTHS = (10, 100, 1000, 10000, 100000, 1000000)
+OPERATIONS = 1000
+SEED = 1
+# resting orders are spread evenly over this many clients
+CLIENTS = 100
+# resting buys are priced up to SPREAD below MID_PRICE and sells up to SPREAD
+# above it, on a grid of TICK_SIZE, so the book built does not cross
+MID_PRICE = 100.0
+SPREAD = 10.0
+TICK_SIZE = 0.01
+PERCENTILES = (50, 90, 99, 99.9)
+
+def order_columns(rng, count):
+    """Return columns of sides, quantities and prices for count resting orders"""
+    buy_sells = [rng.choice(SIDES) for _ in range(count)]
+    quantities = [rng.randint(1, 10) * 100 for _ in range(count)]
+    prices = [round(MID_PRICE + (1 if buy_sell == 'sell' else -1) *
+                    rng.randint(1, int(SPREAD / TICK_SIZE)) * TICK_SIZE, 2)
+              for buy_sell in buy_sells]
+    return buy_sells, quantities, prices
+
+def _client_slices(depth):
+    """Yield (client_id, start, end) dividing depth orders among the clients"""
+    for client_id in range(CLIENTS):
+        yield client_id, depth * client_id // CLIENTS, depth * (client_id + 1) // CLIENTS
+
+def build_order_book(rng, depth):
+    order_book = OrderBook(TICK_SIZE)
+    buy_sells, quantities, prices = order_columns(rng, depth)
+    for client_id, start, end in _client_slices(depth):
+        order_book.add_orders(orders_from_arrays(buy_sells[start:end], quantities[start:end],
+                                                 prices[start:end]), client_id)
+    return order_book
+
+def build_exchange(rng, depth):
+    exchange = Exchange(tick_size=TICK_SIZE)
+    buy_sells, quantities, prices = order_columns(rng, depth)
+    for client_id, start, end in _client_slices(depth):
+        ClientContext(exchange, client_id).submit_order_arrays(
+            buy_sells[start:end], quantities[start:end], prices[start:end])
+    return exchange
+
+# Each benchmark is a generator function taking a seeded random.Random, the
+# book depth and the number of operations. It builds its book, then yields
+# each operation to be timed as a function with no arguments.
+
+def bench_add(rng, depth, operations):
+    order_book = build_order_book(rng, depth)
+    for buy_sell, quantity, price in zip(*order_columns(rng, operations)):
+        yield partial(order_book.add, Order(buy_sell, quantity, price), rng.randrange(CLIENTS))
+
+def bench_delete(rng, depth, operations):
+    order_book = build_order_book(rng, depth)
+    for order in rng.sample(order_book.orders(), min(operations, depth)):
+        yield partial(order_book.delete, order)
+
+def bench_delete_orders_for_client(rng, depth, operations):
+    order_book = build_order_book(rng, depth)
+    for client_id in rng.sample(range(CLIENTS), min(operations, CLIENTS)):
+        yield partial(order_book.delete_orders_for_client, client_id)
+
+def bench_bid_offer(rng, depth, operations):
+    exchange = build_exchange(rng, depth)
+    for _ in range(operations):
+        yield exchange.bid_offer
+
+def bench_match_orders(rng, depth, operations):
+    exchange = build_exchange(rng, depth)
+    # a client of its own sends a market order to match each time, and
+    # cancels whatever is left of it afterwards
+    exchange.current_client = CLIENTS
+    for _ in range(operations):
+        exchange.submit_order(Order(rng.choice(SIDES), rng.randint(1, 10) * 100))
+        yield exchange.match_orders
+        exchange.delete_my_orders()
+
+def bench_trading_round(rng, depth, operations):
+    exchange = build_exchange(rng, depth)
+    exchange.add_client(MarketMaker())
+    exchange.add_client(SimpleAlgo(partial(order_gen, partial(rng.choice, SIDES))))
+    def trading_round():
+        exchange.do_trading()
+        exchange.match_orders()
+    for _ in range(operations):
+        yield trading_round
+
+BENCHMARKS = (
+    ('OrderBook.add', bench_add),
+    ('OrderBook.delete', bench_delete),
+    ('OrderBook.delete_orders_for_client', bench_delete_orders_for_client),
+    ('Exchange.bid_offer', bench_bid_offer),
+    ('Exchange.match_orders', bench_match_orders),
+    ('do_trading round', bench_trading_round),
+)
+
+def percentile(sorted_values, percent):
+    """Return the nearest-rank percentile of a sorted list"""
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+def time_benchmark(benchmark, depth, operations, seed):
+    """Run a benchmark and return the latency of each operation in seconds"""
+    latencies = []
+    timer = time.perf_counter
+    for operation in benchmark(random.Random(seed), depth, operations):
+        start = timer()
+        operation()
+        latencies.append(timer() - start)
+    return latencies
+
+def peak_memory(benchmark, depth, operations, seed):
+    """Run a benchmark under tracemalloc and return the peak bytes allocated"""
+    tracemalloc.start()
+    try:
+        for operation in benchmark(random.Random(seed), depth, operations):
+            operation()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run_benchmark(name, benchmark, depth, operations=OPERATIONS, seed=SEED, memory=True):
+    """Run one benchmark at one depth and return a dict of its results
+
+    Latencies are in microseconds.
+    """
+    latencies = sorted(time_benchmark(benchmark, depth, operations, seed))
+    total = sum(latencies)
+    result = {
+        'benchmark': name,
+        'depth': depth,
+        'operations': len(latencies),
+        'seconds': total,
+        'ops_per_sec': len(latencies) / total if total else None,
+        'latency_us': dict(('p%s' % percent, percentile(latencies, percent) * 1e6)
+                           for percent in PERCENTILES) if latencies else {},
+        'peak_memory_bytes': peak_memory(benchmark, depth, operations, seed) if memory else None,
+    }
+    if latencies:
+        result['latency_us']['max'] = latencies[-1] * 1e6
+    return result
+
+def run_benchmarks(names=None, depths=DEPTHS, operations=OPERATIONS, seed=SEED, memory=True,
+                   progress=None):
+    """Run the benchmarks named, or all, at each depth and return the results
+
+    progress, if given, is called with each result as it is made.
+    """
+    results = []
+    for name, benchmark in BENCHMARKS:
+        if names is not None and name not in names:
+            continue
+        for depth in depths:
+            result = run_benchmark(name, benchmark, depth, operations, seed, memory)
+            if progress is not None:
+                progress(result)
+            results.append(result)
+    return results
+
+def format_result(result):
+    latency = result['latency_us']
+    memory = result['peak_memory_bytes']
+    return '%-36s %8d %8d %12s %10s %10s %10s %10s' % (
+        result['benchmark'], result['depth'], result['operations'],
+        '%.0f' % result['ops_per_sec'] if result['ops_per_sec'] else '-',
+        '%.1f' % latency['p50'] if latency else '-',
+        '%.1f' % latency['p99'] if latency else '-',
+        '%.1f' % latency['max'] if latency else '-',
+        '%.1f' % (memory / 1e6) if memory is not None else '-')
+
+HEADER = '%-36s %8s %8s %12s %10s %10s %10s %10s' % (
+    'benchmark', 'depth', 'ops', 'ops/sec', 'p50 us', 'p99 us', 'max us', 'peak MB')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the order book and matching engine')
+    parser.add_argument('--depths', type=int, nargs='+', default=list(DEPTHS),
+                        help='book depths to run at')
+    parser.add_argument('--operations', type=int, default=OPERATIONS,
+                        help='operations timed for each benchmark and depth')
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--benchmarks', nargs='+', choices=[name for name, _ in BENCHMARKS],
+                        help='benchmarks to run, by default all')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the peak memory run')
+    parser.add_argument('--json', metavar='PATH',
+                        help="write the results as JSON to PATH, or to standard output for '-'")
+    args = parser.parse_args(argv)
+    show_table = args.json != '-'
+    if show_table:
+        print(HEADER)
+    results = run_benchmarks(args.benchmarks, args.depths, args.operations, args.seed, args.memory,
+                             lambda result: print(format_result(result)) if show_table else None)
+    if args.json:
+        report = {
+            'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'seed': args.seed,
+            'results': results,
+        }
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2)
+        else:
+            with open(args.json, 'w') as json_file:
+                json.dump(report, json_file, indent=2)
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_order_columns_seeded_and_not_crossing(self):
+        buy_sells, quantities, prices = order_columns(random.Random(3), 200)
+        self.assertEqual((buy_sells, quantities, prices), order_columns(random.Random(3), 200))
+        self.assertTrue(max(price for buy_sell, price in zip(buy_sells, prices) if buy_sell == 'buy') <
+                        min(price for buy_sell, price in zip(buy_sells, prices) if buy_sell == 'sell'))
+
+    def test_every_benchmark_runs(self):
+        results = run_benchmarks(depths=[10], operations=5)
+        self.assertEqual([result['benchmark'] for result in results], [name for name, _ in BENCHMARKS])
+        for result in results:
+            self.assertTrue(0 < result['operations'] <= 5)
+            self.assertTrue(result['peak_memory_bytes'] > 0)
+            self.assertTrue(result['latency_us']['p50'] <= result['latency_us']['max'])
+        json.dumps(results)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([], 50), None)
+
+if __name__ == "__main__":
+    main()
@@ -14,85 +14,839 @@ exchange.do_trading calls all
 exchange.delete_my_orders
 '''
 import unittest
-from collections import namedtuple
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque, namedtuple
+from heapq import merge
+from itertools import compress, islice, repeat
 from locale import currency
 import logging
+import math
+from operator import eq
+import time
 
-Trade = namedtuple('Trade', 'buy,sell,price')
+# A trade between two orders, by their IDs; buyer and seller are the IDs of
+# their clients. Orders themselves are not kept, as they go on changing in
+# the book after the trade.
+Trade = namedtuple('Trade', 'buy_id,sell_id,price,quantity,symbol,buyer,seller')
+# Result of an order executed immediately: its ID, its trades and the quantity
+# left unfilled, which is cancelled rather than added to the book
+Execution = namedtuple('Execution', 'order_id,trades,unfilled')
 
 logger = logging.getLogger(__name__)
 
+# Tolerance, in ticks, for float prices that should be on the tick grid and the
+# number of decimals prices made from ticks are rounded to
+TICK_TOLERANCE = 1e-9
+PRICE_DECIMALS = 10
+
+# Integer side codes, used internally in place of 'buy' and 'sell'
+BUY, SELL = 0, 1
+SIDES = ('buy', 'sell')
+_SIDE_CODES = {'buy': BUY, 'sell': SELL, BUY: BUY, SELL: SELL}
+
+# Ways of sharing out the volume at the marginal price level in an auction
+AUCTION_ALLOCATIONS = ('time', 'pro_rata')
+
+# Clock for the latencies reported to a metrics sink
+_clock = getattr(time, 'perf_counter', time.time)
+
+# Run an iterator to the end, for the side effects of the calls it maps
+_consume = deque(maxlen=0).extend
+
 class Order(object):
     # TODO: consider subclasses for buy and sell
+    __slots__ = ('side', 'quantity', 'price', 'order_id')
     def __init__(self,buy_sell,quantity,price=None):
-        self.buy_sell = buy_sell
+        """buy_sell can be 'buy' or 'sell', or the side codes BUY or SELL"""
+        self.side = _SIDE_CODES[buy_sell]
         self.quantity = quantity
         self.price = price
+        self.order_id = None
+    @property
+    def buy_sell(self):
+        return SIDES[self.side]
     def __eq__(self, other): 
-        return self.__dict__ == other.__dict__
+        """Orders are equal if they have the same ID or, before they have been
+        submitted, the same side, quantity and price
+        """
+        if self.order_id is not None and other.order_id is not None:
+            return self.order_id == other.order_id
+        return (self.side == other.side and self.quantity == other.quantity
+                and self.price == other.price)
+    def __ne__(self, other):
+        return not self == other
     def __str__(self):
         return 'Order( buy_sell=%s, quantity=%s, price=%s)' % (self.buy_sell, self.quantity, self.price)
 
+class _PriceLevels(object):
+    """One side of an order book
+
+    Priced orders are queued FIFO at their price level and the level prices are
+    kept sorted, so the best price is found without scanning the orders. Orders
+    without a price are queued separately, ahead of all priced levels. Each
+    queue is keyed by order ID so an order can be removed without a scan.
+    
+    The total quantity at each level is kept as orders are added, removed and
+    filled, and version goes up with every change, so views of the side can
+    be cached until it changes. Once changed is set to a set, the prices of
+    levels that change are added to it.
+    
+    A level restored from columns is kept in restored, with no queue, until
+    its queue is first needed; materialize(side, price) then makes its orders
+    and queue and returns the queue.
+    """
+    def __init__(self, descending, materialize=None):
+        self.descending = descending
+        self.prices = []
+        self.queues = {}
+        self.quantities = {}
+        self.unpriced = OrderedDict()
+        self.changed = None
+        self.version = 0
+        # price: (order IDs, client IDs, quantities, price) of a restored level
+        self.restored = {}
+        self.materialize = materialize
+    def add(self, order_id, entry, price):
+        if price is None:
+            self.unpriced[order_id] = entry
+        else:
+            queue = self.queues.get(price)
+            if queue is None and price in self.restored:
+                queue = self.materialize(self, price)
+            elif queue is None:
+                queue = self.queues[price] = OrderedDict()
+                self.quantities[price] = 0
+                insort(self.prices, price)
+            queue[order_id] = entry
+        self.touch(price, entry[1].quantity)
+    def add_many(self, items):
+        """Add (order_id, entry, price) items, sorting any new level prices in once"""
+        new_prices = []
+        for order_id, entry, price in items:
+            if price is None:
+                self.unpriced[order_id] = entry
+                continue
+            queue = self.queues.get(price)
+            if queue is None and price in self.restored:
+                queue = self.materialize(self, price)
+            elif queue is None:
+                queue = self.queues[price] = OrderedDict()
+                self.quantities[price] = 0
+                new_prices.append(price)
+            queue[order_id] = entry
+            self.touch(price, entry[1].quantity)
+        if new_prices:
+            self.prices.extend(new_prices)
+            self.prices.sort()
+        self.version += 1
+    def remove(self, order_id, price):
+        if price is None:
+            del self.unpriced[order_id]
+            self.version += 1
+            return
+        queue = self.queues[price]
+        _, order = queue.pop(order_id)
+        if queue:
+            self.touch(price, -order.quantity)
+        else:
+            del self.queues[price]
+            del self.quantities[price]
+            del self.prices[bisect_left(self.prices, price)]
+            self.touch(price)
+    def touch(self, price, quantity=0):
+        """Note a change at a level, adding quantity to its total"""
+        self.version += 1
+        if price is not None:
+            if quantity:
+                self.quantities[price] += quantity
+            if self.changed is not None:
+                self.changed.add(price)
+    def totals(self, price):
+        """Return the total quantity and number of orders at a level"""
+        queue = self.queues.get(price)
+        if queue is None and price in self.restored:
+            return self.quantities[price], len(self.restored[price][0])
+        return (self.quantities[price], len(queue)) if queue else (0, 0)
+    def queue_for(self, price):
+        """Return the queue at a level, made first if the level was restored,
+        or an empty dict if there is none
+        """
+        if price is None:
+            return self.unpriced
+        queue = self.queues.get(price)
+        if queue is None:
+            return self.materialize(self, price) if price in self.restored else {}
+        return queue
+    def best_price(self):
+        if not self.prices:
+            return None
+        return self.prices[-1] if self.descending else self.prices[0]
+    def next_price(self, price):
+        """Return the next level price after price in priority order, or None"""
+        if self.descending:
+            i = bisect_left(self.prices, price)
+            return self.prices[i - 1] if i > 0 else None
+        i = bisect_right(self.prices, price)
+        return self.prices[i] if i < len(self.prices) else None
+    def within(self, price, limit):
+        """Return True if a level at price can trade with a limit price on the other side"""
+        if limit is None:
+            return True
+        return price >= limit if self.descending else price <= limit
+    def trades_with(self, limit):
+        """Return True if any order on this side can trade with a limit price
+        on the other side (None for no limit)
+        """
+        if self.unpriced:
+            return True
+        best = self.best_price()
+        return best is not None and self.within(best, limit)
+    def levels(self):
+        """Return the priced levels in priority order, best price first"""
+        return reversed(self.prices) if self.descending else iter(self.prices)
+    def entries(self):
+        """Return all (client_id, order) entries in priority order"""
+        for entry in self.unpriced.values():
+            yield entry
+        for price in self.levels():
+            for entry in self.queue_for(price).values():
+                yield entry
+    def __len__(self):
+        return (len(self.unpriced) + sum(len(queue) for queue in self.queues.values()) +
+                sum(len(level[0]) for level in self.restored.values()))
+
+class _Cursor(object):
+    """A position in one side of a book, walked in priority order while the
+    orders passed are filled and removed from the book
+
+    Queues are read in place from their head, so finding the next order costs
+    the same however many orders wait at its level. A filled order leaves the
+    head of its queue; orders skipped over stay in the book and are counted,
+    so the next order is the one just after them.
+    """
+    def __init__(self, side):
+        self.side = side
+        self.restart()
+    def restart(self):
+        """Go back to the best order on the side"""
+        # the level key, None for the orders without a price
+        self.key = None
+        self.skipped = 0
+        self.exhausted = False
+    def current(self):
+        """Return the (order_id, entry) pair at the cursor, or None if there are
+        no more orders
+        """
+        side = self.side
+        while not self.exhausted:
+            queue = side.queue_for(self.key)
+            if len(queue) > self.skipped:
+                order_id = next(islice(queue, self.skipped, None))
+                return order_id, queue[order_id]
+            self.key = side.best_price() if self.key is None else side.next_price(self.key)
+            self.skipped = 0
+            self.exhausted = self.key is None
+        return None
+    def skip(self):
+        """Move past the order at the cursor, leaving it in the book"""
+        self.skipped += 1
+    def within(self, limit):
+        """Return True if the order at the cursor can trade with a limit price
+        on the other side
+        """
+        return self.key is None or self.side.within(self.key, limit)
+
 class OrderBook(object):
-    def __init__(self):
-        self._orders = []
+    def __init__(self, tick_size=None, symbol=None):
+        """If a tick size is given, prices are snapped to the tick grid as orders
+        are added and the book is keyed by whole numbers of ticks. The symbol
+        is recorded on the trades the book makes.
+        """
+        self.tick_size = tick_size
+        self.symbol = symbol
+        self._sides = (_PriceLevels(True, self._materialize), _PriceLevels(False, self._materialize))
+        self._index = {}
+        # the number of orders at restored levels not yet made, and a map of
+        # their IDs to (side, level price), made when first needed
+        self._restored_count = 0
+        self._restored_ids = None
+        self._client_orders = {}
+        self._last_order_id = 0
+        # (side versions, value) for the cached depth of each side and rendering
+        self._depth_cache = [(None, None), (None, None)]
+        self._rendered = (None, None)
+    def _versions(self):
+        return (self._sides[BUY].version, self._sides[SELL].version)
     def __str__(self):
-        elems = []
-        elems.append('OrderBook')
-        elems.append('Buys')
-        # TODO: helper function for formatting
-        elems.extend([str(order) for order in self.buy_orders()] if len(self.buy_orders()) else ['Empty'])
-        elems.append('Sells')
-        elems.extend([str(order) for order in self.sell_orders()] if len(self.sell_orders()) else ['Empty'])
-        return '\n'.join(elems)
-        
-    def add(self, order, client_id):
-        """Add an order to the book
-        """
-        self._orders.append((client_id,order))
+        """Render the book, reusing the last rendering if the book has not changed"""
+        versions, rendered = self._rendered
+        if versions != self._versions():
+            elems = []
+            elems.append('OrderBook')
+            for title, orders in (('Buys', self.buy_orders()), ('Sells', self.sell_orders())):
+                elems.append(title)
+                elems.extend([str(order) for order in orders] if orders else ['Empty'])
+            rendered = '\n'.join(elems)
+            self._rendered = (self._versions(), rendered)
+        return rendered
+    def depth(self, buy_sell):
+        """Return a tuple of (price, quantity, order_count) for each priced level
+        on one side, best price first
+        
+        The level totals are kept as the book changes, so this costs one step per
+        level, and nothing if the side has not changed since the last call.
+        """
+        side_code = _SIDE_CODES[buy_sell]
+        side = self._sides[side_code]
+        version, depth = self._depth_cache[side_code]
+        if version != side.version:
+            depth = tuple((self._level_price(key),) + side.totals(key) for key in side.levels())
+            self._depth_cache[side_code] = (side.version, depth)
+        return depth
+        
+    def add(self, order, client_id, order_id=None):
+        """Add an order to the book and return its ID
+        
+        If no order ID is given the next one after the highest seen is used.
+        """
+        if order_id is None:
+            order_id = self._last_order_id + 1
+        self._last_order_id = max(self._last_order_id, order_id)
+        order.order_id = order_id
+        entry = (client_id,order)
+        self._index[order_id] = entry
+        self._client_orders.setdefault(client_id, set()).add(order_id)
+        self._sides[order.side].add(order_id, entry, self._snap(order))
+        return order_id
+    def add_orders(self, orders, client_id, order_ids=None):
+        """Add a sequence of orders for one client to the book in a single pass
+        and return their IDs
+        """
+        if order_ids is None:
+            order_ids = range(self._last_order_id + 1, self._last_order_id + len(orders) + 1)
+        order_ids = list(order_ids)
+        if not order_ids:
+            return order_ids
+        items = ([], [])
+        index = self._index
+        for order, order_id in zip(orders, order_ids):
+            order.order_id = order_id
+            entry = (client_id,order)
+            index[order_id] = entry
+            items[order.side].append((order_id, entry, self._snap(order)))
+        self._client_orders.setdefault(client_id, set()).update(order_ids)
+        for side, side_items in zip(self._sides, items):
+            side.add_many(side_items)
+        self._last_order_id = max(self._last_order_id, max(order_ids))
+        return order_ids
+    def restore_orders(self, order_ids, client_ids, sides, quantities, prices):
+        """Add orders given as columns, as when restoring a saved book
+        
+        The columns are sequences, such as lists or arrays. The orders must be
+        in priority order for each side and their prices already on the tick
+        grid. Each new price level is kept as slices of the columns, and its
+        orders are only made when something first reaches it: matching, a
+        lookup by ID, a mass cancel or a listing of the book. Orders without a
+        price or at a level the book already has are made straight away. The
+        levels are found by searching the prices, so no Python code runs per
+        order. It is quickest when all the buys come before the sells.
+        """
+        columns = (order_ids, client_ids, quantities, prices)
+        buy_count = sides.count(BUY)
+        if sides[:buy_count].count(BUY) == buy_count:
+            # the buys come first, so each side is a slice of the columns
+            side_columns = [[column[:buy_count] for column in columns],
+                            [column[buy_count:] for column in columns]]
+        else:
+            side_columns = [[list(compress(column, map(eq, sides, repeat(side_code, len(sides))))) for column in columns]
+                            for side_code in (BUY, SELL)]
+        for side, (side_ids, side_clients, side_quantities, side_prices) in zip(self._sides, side_columns):
+            start = 0
+            while start < len(side_prices):
+                price = side_prices[start]
+                end = _run_end(side_prices, start)
+                key = self._key(price)
+                level = (side_ids[start:end], side_clients[start:end], side_quantities[start:end], price)
+                if key is None or key in side.queues or key in side.restored:
+                    self._make_orders(side, side.queue_for(key), level)
+                else:
+                    side.restored[key] = level
+                    side.quantities[key] = 0
+                    insort(side.prices, key)
+                    self._restored_count += end - start
+                    if self._restored_ids is not None:
+                        self._restored_ids.update(zip(level[0], repeat((side, key))))
+                side.touch(key, sum(level[2]))
+                start = end
+        if len(order_ids):
+            self._last_order_id = max(self._last_order_id, max(order_ids))
+    def _make_orders(self, side, queue, level):
+        """Make the orders of a restored level and add them to a queue on side"""
+        order_ids, client_ids, quantities, price = level
+        count = len(order_ids)
+        orders = list(map(Order, repeat(self._sides.index(side), count), quantities, repeat(price, count)))
+        _consume(map(setattr, orders, repeat('order_id', count), order_ids))
+        entries = list(zip(client_ids, orders))
+        self._index.update(zip(order_ids, entries))
+        queue.update(zip(order_ids, entries))
+        client_orders = self._client_orders
+        for client_id in set(client_ids):
+            client_orders.setdefault(client_id, set())
+        _consume(map(set.add, map(client_orders.__getitem__, client_ids), order_ids))
+    def _materialize(self, side, price):
+        """Make the orders of a restored level and return its new queue"""
+        level = side.restored.pop(price)
+        self._restored_count -= len(level[0])
+        if self._restored_ids is not None:
+            _consume(map(self._restored_ids.pop, level[0]))
+        queue = side.queues[price] = OrderedDict()
+        self._make_orders(side, queue, level)
+        return queue
+    def _materialize_all(self):
+        for side in self._sides:
+            for price in list(side.restored):
+                self._materialize(side, price)
+    def _entry(self, order_id):
+        """Return the (client_id, order) entry for an order ID, or None if the
+        order is not in the book, making its level's orders if it was restored
+        
+        The IDs of the orders at restored levels are only mapped to their
+        levels the first time one is looked up.
+        """
+        entry = self._index.get(order_id)
+        if entry is None and self._restored_count:
+            if self._restored_ids is None:
+                self._restored_ids = {}
+                for side in self._sides:
+                    for price, level in side.restored.items():
+                        self._restored_ids.update(zip(level[0], repeat((side, price))))
+            level = self._restored_ids.get(order_id)
+            if level is not None:
+                self._materialize(*level)
+                entry = self._index[order_id]
+        return entry
+    def cancel(self, order_id):
+        """Remove the order with the specified ID from the book
+        
+        Returns the (client_id, order) entry removed, or None if the order is
+        not in the book.
+        """
+        entry = self._index.pop(order_id, None)
+        if entry is None and self._restored_count:
+            entry = self._entry(order_id)
+            if entry is not None:
+                del self._index[order_id]
+        if entry is not None:
+            client_id, order = entry
+            self._sides[order.side].remove(order_id, self._key(order.price))
+            client_orders = self._client_orders[client_id]
+            client_orders.discard(order_id)
+            if not client_orders:
+                del self._client_orders[client_id]
+        return entry
+    def differs(self, order_id, quantity=None, price=None):
+        """Return True if an order in the book has a different quantity or price,
+        once on the tick grid, from those given (None for its current one)
+        """
+        order = self._entry(order_id)[1]
+        return ((quantity is not None and quantity != order.quantity) or
+                (price is not None and self._snapped(price, order.side) != order.price))
+    def keeps_priority(self, order_id, quantity=None, price=None):
+        """Return True if amending an order in the book to a quantity and price
+        (None to keep the current one) would keep its time priority: that is,
+        if the quantity is no larger and the price, once on the tick grid, is
+        the same
+        """
+        order = self._entry(order_id)[1]
+        if quantity is not None and quantity > order.quantity:
+            return False
+        return price is None or self._snapped(price, order.side) == order.price
+    def amend(self, order_id, quantity=None, price=None):
+        """Change the quantity and/or price of an order in the book, keeping its ID
+        
+        A quantity reduction at the same price is made in place, so the order
+        keeps its time priority. Otherwise the order moves to the back of the
+        queue at its new price. Amending an order to its current values
+        changes nothing. Returns True if the order kept its priority, False if
+        it moved, or None if it is not in the book.
+        """
+        entry = self._entry(order_id)
+        if entry is None:
+            return None
+        client_id, order = entry
+        if self.keeps_priority(order_id, quantity, price):
+            if self.differs(order_id, quantity):
+                self._sides[order.side].touch(self._key(order.price), quantity - order.quantity)
+                order.quantity = quantity
+            return True
+        self.cancel(order_id)
+        if quantity is not None:
+            order.quantity = quantity
+        if price is not None:
+            order.price = price
+        self.add(order, client_id, order_id)
+        return False
     def delete(self, order_to_delete):
         """Delete an order from the book
         """
-        for (client_id,order) in self._orders:
+        if self._entry(order_to_delete.order_id) is not None:
+            self.cancel(order_to_delete.order_id)
+            return
+        for (_,order) in list(self._sides[order_to_delete.side].queue_for(self._key(order_to_delete.price)).values()):
             if order == order_to_delete:
-                self._orders.remove((client_id,order))
+                self.cancel(order.order_id)
+                return
+    def order(self, order_id):
+        """Return the order with the specified ID, or None if it is not in the book"""
+        entry = self._entry(order_id)
+        return entry[1] if entry is not None else None
+    def owner(self, order_id):
+        """Return the client ID for the order with the specified ID"""
+        entry = self._entry(order_id)
+        return entry[0] if entry is not None else None
     def orders(self):
         """Return a list of all orders in the book
+        
+        Buys come before sells, each side in price-time priority.
         """
-        return [order for (_,order) in self._orders]
-    def highest_buy_order(self):
+        return self.buy_orders() + self.sell_orders()
+    def highest_buy_order(self, excluding=()):
         """Return the buy order with the highest price or None if there are no buy orders
+        
+        Orders with IDs in excluding are left out.
         """
-        buy_prices = [order.price for (_,order) in self._orders 
-                        if order.price is not None 
-                        and order.buy_sell == 'buy']
-        return max(buy_prices) if buy_prices else None
-#         sell_prices = [order.price for order in self._sell_order_book if order.price is not None]        pass
-    def lowest_sell_order(self):
+        return self._level_price(self._best_key(BUY, excluding))
+    def lowest_sell_order(self, excluding=()):
         """Return the sell order with the lowest price or None if there are no sell orders
+        
+        Orders with IDs in excluding are left out.
         """
-        sell_prices = [order.price for (_,order) in self._orders 
-                        if order.price is not None 
-                        and order.buy_sell == 'sell']
-        return min(sell_prices) if sell_prices else None
+        return self._level_price(self._best_key(SELL, excluding))
+    def _best_key(self, side_code, excluding):
+        """Return the key of the best level on a side with an order not in excluding"""
+        side = self._sides[side_code]
+        key = side.best_price()
+        if excluding:
+            while key is not None and all(order_id in excluding for order_id in side.queue_for(key)):
+                key = side.next_price(key)
+        return key
     def delete_orders_for_client(self, client_id_to_delete):
         """Delete all orders associated with a specified client
         """
-        for (client_id,order) in self._orders:
-            if client_id == client_id_to_delete:
-                self._orders.remove((client_id,order))
+        self._materialize_all()
+        for order_id in self._client_orders.pop(client_id_to_delete, ()):
+            entry = self._index.pop(order_id)
+            self._sides[entry[1].side].remove(order_id, self._key(entry[1].price))
+    def match(self, current_price):
+        """Match crossing orders in price-time priority and return the trades
+        
+        Buys are taken best first and each sweeps the sells it crosses from the
+        best sell down, skipping orders from the same client, so only the
+        crossing levels at the top of each side are visited. One cursor walks
+        the sells for all the buys and goes back to the best sell only for a
+        buy from another client than the sells skipped, so the cost is one step
+        per fill or skipped order, whatever the size of the levels. Each fill
+        is a separate trade for the quantity filled; whatever is left of a
+        partly filled order stays in the book. Trade prices are set by
+        match_order, starting from current_price and following the price of
+        each trade.
+        """
+        trades = []
+        buys, sells = self._sides[BUY], self._sides[SELL]
+        buy_cursor, sell_cursor = _Cursor(buys), _Cursor(sells)
+        # the client whose sells the sell cursor has skipped since it restarted
+        skipped_client = None
+        buy = buy_cursor.current()
+        while buy is not None:
+            buy_id, (buy_client, buy_order) = buy
+            buy_key = self._key(buy_order.price)
+            if not sells.trades_with(buy_key):
+                break
+            if skipped_client not in (None, buy_client):
+                sell_cursor.restart()
+                skipped_client = None
+            sell = sell_cursor.current()
+            while sell is not None and sell_cursor.within(buy_key):
+                sell_id, (sell_client, sell_order) = sell
+                if sell_client == buy_client:
+                    sell_cursor.skip()
+                    skipped_client = buy_client
+                else:
+                    quantity = min(buy_order.quantity, sell_order.quantity)
+                    _, current_price = match_order(current_price, buy_order.price, sell_order.price)
+                    trades.append(Trade(buy_id=buy_id, sell_id=sell_id, price=current_price,
+                                        quantity=quantity, symbol=self.symbol,
+                                        buyer=buy_client, seller=sell_client))
+                    self.fill(sell_id, quantity)
+                    if not self.fill(buy_id, quantity):
+                        break
+                sell = sell_cursor.current()
+            if buy_order.quantity > 0:
+                buy_cursor.skip()
+            buy = buy_cursor.current()
+        return trades
+    def execute(self, order, client_id, current_price):
+        """Match an incoming order against the opposite side of the book
+        
+        The order is not added to the book. It takes the resting orders it
+        crosses in price-time priority, skipping those from the same client, and
+        its quantity is reduced to the unfilled remainder. The resting orders
+        are walked with a cursor, so the cost is one step per fill or skipped
+        order, whatever the size of the levels. Returns the trades.
+        """
+        trades = []
+        is_buy = order.side == BUY
+        cursor = _Cursor(self._sides[SELL if is_buy else BUY])
+        limit = self._snap(order)
+        resting = cursor.current()
+        while resting is not None and cursor.within(limit):
+            resting_id, (resting_client, resting_order) = resting
+            if resting_client == client_id:
+                cursor.skip()
+            else:
+                quantity = min(order.quantity, resting_order.quantity)
+                buy_order, sell_order = (order, resting_order) if is_buy else (resting_order, order)
+                buyer, seller = (client_id, resting_client) if is_buy else (resting_client, client_id)
+                _, current_price = match_order(current_price, buy_order.price, sell_order.price)
+                trades.append(Trade(buy_id=buy_order.order_id, sell_id=sell_order.order_id,
+                                    price=current_price, quantity=quantity, symbol=self.symbol,
+                                    buyer=buyer, seller=seller))
+                self.fill(resting_id, quantity)
+                order.quantity -= quantity
+                if order.quantity <= 0:
+                    break
+            resting = cursor.current()
+        return trades
+    def clearing_price(self, current_price):
+        """Return (price, volume) for an auction of the book, or (None, 0) if
+        nothing would trade
+        
+        The price is the level price at which the most volume would trade.
+        Ties go to the price leaving the smallest imbalance between demand and
+        supply, then to the price closest to current_price, then to the lower
+        price. Orders without a price count at every price; if there are no
+        priced orders they trade at current_price. Demand and supply are
+        accumulated over the level totals, so this costs one step per level.
+        """
+        return self._clearing(current_price)[1:]
+    def _clearing(self, current_price):
+        """Return (level key, price, volume) for an auction of the book"""
+        buys, sells = self._sides
+        unpriced_demand = sum(order.quantity for (_,order) in buys.unpriced.values())
+        unpriced_supply = sum(order.quantity for (_,order) in sells.unpriced.values())
+        keys = []
+        for key in merge(buys.prices, sells.prices):
+            if not keys or key != keys[-1]:
+                keys.append(key)
+        if not keys:
+            volume = min(unpriced_demand, unpriced_supply)
+            return (None, current_price, volume) if volume else (None, None, 0)
+        # demand at each price: buys at or above it; supply: sells at or below it
+        demand = [0] * len(keys)
+        total = unpriced_demand
+        for i in range(len(keys) - 1, -1, -1):
+            total += buys.quantities.get(keys[i], 0)
+            demand[i] = total
+        best = (None, None, 0)
+        best_rank = None
+        total = unpriced_supply
+        for i, key in enumerate(keys):
+            total += sells.quantities.get(key, 0)
+            volume = min(demand[i], total)
+            if not volume:
+                continue
+            price = self._level_price(key)
+            rank = (-volume, abs(demand[i] - total), abs(price - current_price), price)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = (key, price, volume), rank
+        return best
+    def uncross(self, current_price, allocation='time'):
+        """Match the book as a call auction and return the trades
+        
+        Every trade is at the clearing price. The volume is given to the buys
+        and sells that can trade at that price in price priority. At the last
+        price level reached it is shared out in time priority, or, for
+        'pro_rata' allocation, in proportion to order size with the odd units
+        going to the earliest orders. Buys and sells are then paired in
+        priority order, never pairing a client's buy with its own sell; volume
+        that cannot be paired is left in the book.
+        """
+        if allocation not in AUCTION_ALLOCATIONS:
+            raise ValueError('unknown auction allocation %r' % (allocation,))
+        key, price, volume = self._clearing(current_price)
+        if not volume:
+            return []
+        buy_fills = self._allocate(BUY, key, volume, allocation)
+        sell_fills = self._allocate(SELL, key, volume, allocation)
+        trades = []
+        start = 0
+        for buy_id, buy_client, buy_order, buy_quantity in buy_fills:
+            i = start
+            while buy_quantity and i < len(sell_fills):
+                sell_fill = sell_fills[i]
+                if sell_fill[3] and sell_fill[1] != buy_client:
+                    quantity = min(buy_quantity, sell_fill[3])
+                    trades.append(Trade(buy_id=buy_id, sell_id=sell_fill[0], price=price,
+                                        quantity=quantity, symbol=self.symbol,
+                                        buyer=buy_client, seller=sell_fill[1]))
+                    self.fill(buy_id, quantity)
+                    self.fill(sell_fill[0], quantity)
+                    buy_quantity -= quantity
+                    sell_fill[3] -= quantity
+                if sell_fill[3] and sell_fill[1] != buy_client:
+                    break
+                i += 1
+            while start < len(sell_fills) and not sell_fills[start][3]:
+                start += 1
+        return trades
+    def _allocate(self, side_code, clearing_key, volume, allocation):
+        """Return [order_id, client_id, order, quantity] for the orders on one
+        side given the auction volume, in priority order
+        """
+        side = self._sides[side_code]
+        def queues():
+            yield side.unpriced
+            key = side.best_price() if clearing_key is not None else None
+            while key is not None and side.within(key, clearing_key):
+                yield side.queue_for(key)
+                key = side.next_price(key)
+        fills = []
+        remaining = volume
+        for queue in queues():
+            if not remaining:
+                break
+            entries = list(queue.items())
+            total = sum(order.quantity for _, (_, order) in entries)
+            if total <= remaining or allocation == 'time':
+                for order_id, (client_id, order) in entries:
+                    quantity = min(order.quantity, remaining)
+                    fills.append([order_id, client_id, order, quantity])
+                    remaining -= quantity
+                    if not remaining:
+                        break
+            else:
+                shares = [order.quantity * remaining // total for _, (_, order) in entries]
+                odd_units = remaining - sum(shares)
+                for (order_id, (client_id, order)), share in zip(entries, shares):
+                    if odd_units:
+                        share += 1
+                        odd_units -= 1
+                    if share:
+                        fills.append([order_id, client_id, order, share])
+                remaining = 0
+        return fills
+    def fill(self, order_id, quantity):
+        """Reduce the open quantity of an order by a filled quantity
+        
+        The order is removed from the book once it is completely filled.
+        Returns the quantity still open.
+        """
+        order = self._index[order_id][1]
+        order.quantity -= quantity
+        self._sides[order.side].touch(self._key(order.price), -quantity)
+        if order.quantity <= 0:
+            self.cancel(order_id)
+        return order.quantity
+    def apply_fills(self, fills):
+        """Apply (buy_id, sell_id, price, quantity) fills between orders in the
+        book and return the trades for them
+        """
+        trades = []
+        for buy_id, sell_id, price, quantity in fills:
+            buyer, seller = self._entry(buy_id)[0], self._entry(sell_id)[0]
+            trades.append(Trade(buy_id=buy_id, sell_id=sell_id, price=price,
+                                quantity=quantity, symbol=self.symbol, buyer=buyer, seller=seller))
+            self.fill(buy_id, quantity)
+            self.fill(sell_id, quantity)
+        return trades
+    def _snap(self, order):
+        """Move an order's price onto the tick grid and return its level key
+        
+        Buys are rounded down and sells up, so an order never trades at a worse
+        price than its limit.
+        """
+        if self.tick_size is None or order.price is None:
+            return order.price
+        ticks = to_ticks(order.price, self.tick_size, order.side)
+        order.price = from_ticks(ticks, self.tick_size)
+        return ticks
+    def _snapped(self, price, side):
+        """Return a price moved onto the tick grid as it would be for an order"""
+        if self.tick_size is None or price is None:
+            return price
+        return from_ticks(to_ticks(price, self.tick_size, side), self.tick_size)
+    def _key(self, price):
+        """Return the level key for a price already on the tick grid"""
+        if self.tick_size is None or price is None:
+            return price
+        return int(round(price / self.tick_size))
+    def _level_price(self, key):
+        if self.tick_size is None or key is None:
+            return key
+        return from_ticks(key, self.tick_size)
+    def changed_levels(self):
+        """Return (buy_sell, price, quantity, order_count) for each priced level
+        that has changed since the last call, each side in priority order
+        
+        Levels that have emptied are returned with a quantity and count of 0.
+        The first call returns every level, and starts the tracking of changes.
+        """
+        changes = []
+        for side_code, side in enumerate(self._sides):
+            if side.changed is None:
+                keys = list(side.levels())
+            else:
+                keys = sorted(side.changed, reverse=side.descending)
+            side.changed = set()
+            for key in keys:
+                quantity, count = side.totals(key)
+                changes.append((SIDES[side_code], self._level_price(key), quantity, count))
+        return changes
+    def order_count(self):
+        """Return the number of orders in the book"""
+        return len(self._index) + self._restored_count
+    def client_order_ids(self, client_id):
+        """Return the IDs of all orders in the book for a specified client"""
+        self._materialize_all()
+        return set(self._client_orders.get(client_id, ()))
+    def order_entries(self):
+        """Return (client_id, order) for every order, buys then sells, each side
+        in priority order
+        """
+        return list(self._sides[BUY].entries()) + list(self._sides[SELL].entries())
     def buy_orders(self):
         """Return all buy orders in the book"""
-        return [order for (_,order) in self._orders if order.buy_sell == 'buy']
+        return [order for (_,order) in self._sides[BUY].entries()]
     def sell_orders(self):
         """Return all sell orders in the book"""
-        return [order for (_,order) in self._orders if order.buy_sell == 'sell']
+        return [order for (_,order) in self._sides[SELL].entries()]
     def client_id_for(self, order):
         """Return the client ID associated with the specified trade"""
-        for (client_id,order_in_book) in self._orders:
+        entry = self._entry(order.order_id)
+        if entry is not None:
+            return entry[0]
+        for (client_id,order_in_book) in self._sides[order.side].queue_for(self._key(order.price)).values():
             if order_in_book == order:
                 return client_id
 
+class TestOrder(unittest.TestCase):
+    def test_side_codes(self):
+        self.assertEqual(Order('buy',1000,10.0).side, BUY)
+        self.assertEqual(Order(SELL,1000,10.0).buy_sell, 'sell')
+        self.assertEqual(Order(BUY,1000,10.0), Order('buy',1000,10.0))
+        self.assertRaises(KeyError, Order, 'hold', 1000)
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(Order('buy',1000,10.0), '__dict__'))
+    def test_submitted_orders_compare_by_id(self):
+        order_book = OrderBook()
+        first = Order('buy',1000,10.0)
+        second = Order('buy',1000,10.0)
+        self.assertEqual(first, second)
+        order_book.add(first, 0)
+        order_book.add(second, 0)
+        self.assertNotEqual(first, second)
+        self.assertEqual(first, Order('buy',1000,10.0))
+
 class TestOrderBook(unittest.TestCase):
     def test_add_order(self):
         order_book = OrderBook()
@@ -154,6 +908,21 @@ class TestOrderBook(unittest.TestCase):
         # then the order for that client is no longer present
         # and the order for the other client is still present
         self.assertEqual(order_book.orders(), [Order('buy',1001,10.1)])
+    def test_remove_all_orders_for_client_2(self):
+        # given an order book with adjacent orders for one client around another's
+        order_book = OrderBook()
+        order_book.add(Order('buy',1000,10.0), 0)
+        order_book.add(Order('buy',1000,10.0), 0)
+        kept_id = order_book.add(Order('buy',1000,10.0), 1)
+        order_book.add(Order('sell',1000,10.1), 0)
+        order_book.add(Order('sell',1000,10.2), 0)
+        # when the orders for the first client are removed
+        order_book.delete_orders_for_client(0)
+        # then every one of them is gone
+        self.assertEqual([order.order_id for order in order_book.orders()], [kept_id])
+        self.assertEqual(order_book.client_order_ids(0), set())
+        self.assertEqual(order_book.client_order_ids(1), set([kept_id]))
+        self.assertEqual(order_book.lowest_sell_order(), None)
     def test_buy_orders(self):
         # given an order book with a buy and a sell order
         order_book = OrderBook()
@@ -170,95 +939,817 @@ class TestOrderBook(unittest.TestCase):
         # when sell_orders is called
         # only the sell order is returned
         self.assertEqual(order_book.sell_orders(), [Order('sell',1001,10.1)])
+    def test_best_price_after_best_level_deleted(self):
+        # given a book with buys and sells at several prices
+        order_book = OrderBook()
+        best_buy = Order('buy',1000,10.2)
+        best_sell = Order('sell',1000,10.3)
+        for order in (Order('buy',1000,10.0), best_buy, Order('buy',1000,10.1),
+                      Order('sell',1000,10.5), best_sell, Order('sell',1000,10.4)):
+            order_book.add(order, 0)
+        # when the best order on each side is deleted
+        order_book.delete(best_buy)
+        order_book.delete(best_sell)
+        # then the next level becomes the best price
+        self.assertEqual(order_book.highest_buy_order(), 10.1)
+        self.assertEqual(order_book.lowest_sell_order(), 10.4)
+    def test_cancel_by_id(self):
+        # given a book with two orders with the same side, quantity and price
+        order_book = OrderBook()
+        first_id = order_book.add(Order('buy',1000,10.0), 0)
+        second_id = order_book.add(Order('buy',1000,10.0), 1)
+        # when the second is cancelled by ID
+        client_id, order = order_book.cancel(second_id)
+        # then only that order is removed
+        self.assertEqual(client_id, 1)
+        self.assertEqual(order.order_id, second_id)
+        self.assertEqual([order.order_id for order in order_book.orders()], [first_id])
+        self.assertEqual(order_book.cancel(second_id), None)
+    def test_apply_fills(self):
+        # given a book with a buy and two sells
+        order_book = OrderBook()
+        buy_id = order_book.add(Order('buy',100,10.0), 1)
+        first_sell_id = order_book.add(Order('sell',50,9.5), 2)
+        second_sell_id = order_book.add(Order('sell',100,9.8), 3)
+        # when fills between them are applied
+        trades = order_book.apply_fills([(buy_id, first_sell_id, 9.5, 50), (buy_id, second_sell_id, 9.8, 20)])
+        # then trades are returned for them and filled orders leave the book
+        self.assertEqual([(trade.buy_id, trade.sell_id, trade.quantity, trade.buyer, trade.seller)
+                          for trade in trades],
+                         [(buy_id, first_sell_id, 50, 1, 2), (buy_id, second_sell_id, 20, 1, 3)])
+        self.assertEqual([(order.order_id, order.quantity) for order in order_book.orders()],
+                         [(buy_id, 30), (second_sell_id, 80)])
+    def test_order_and_owner_lookup(self):
+        order_book = OrderBook()
+        test_order = Order('sell',1000,10.0)
+        order_id = order_book.add(test_order, 7)
+        self.assertTrue(order_book.order(order_id) is test_order)
+        self.assertEqual(order_book.owner(order_id), 7)
+        self.assertEqual(order_book.client_id_for(test_order), 7)
+        self.assertEqual(order_book.order(order_id + 1), None)
+    def test_add_orders(self):
+        # given a book with a buy at 10.0
+        order_book = OrderBook()
+        order_book.add(Order('buy',1000,10.0), 0)
+        # when several orders are added together
+        orders = [Order('buy',1000,10.1), Order('sell',1000,10.3), Order('buy',1000,9.9),
+                  Order('sell',1000,10.2), Order('buy',1000,10.1)]
+        order_ids = order_book.add_orders(orders, 1)
+        # then they get the next IDs and take their place in the book
+        self.assertEqual(order_ids, [2, 3, 4, 5, 6])
+        self.assertEqual([order.order_id for order in order_book.buy_orders()], [2, 6, 1, 4])
+        self.assertEqual([order.order_id for order in order_book.sell_orders()], [5, 3])
+        self.assertEqual(order_book.highest_buy_order(), 10.1)
+        self.assertEqual(order_book.lowest_sell_order(), 10.2)
+        self.assertEqual(order_book.client_order_ids(1), set(order_ids))
+    def test_restore_orders(self):
+        # given the entries of a book with a tick size, including orders
+        # without a price or a client
+        original = OrderBook(0.05)
+        original.add_orders([Order('buy',100), Order('buy',100,10.0), Order('sell',50,10.2),
+                             Order('buy',200,10.0), Order('sell',100)], 1)
+        original.add_orders([Order('buy',10,9.95), Order('sell',30,10.2)], None)
+        entries = original.order_entries()
+        columns = ([order.order_id for _, order in entries], [client_id for client_id, _ in entries],
+                   [order.side for _, order in entries], [order.quantity for _, order in entries],
+                   [order.price for _, order in entries])
+        # when they are restored buys first, or sells first
+        sells_first = sorted(range(len(entries)), key=lambda i: columns[2][i] == BUY)
+        for order in (list(range(len(entries))), sells_first):
+            restored = OrderBook(0.05)
+            restored.restore_orders(*[[column[i] for i in order] for column in columns])
+            # then the book is the same
+            self.assertEqual([(client_id, order.order_id, order.quantity, order.price)
+                              for client_id, order in restored.order_entries()],
+                             [(client_id, order.order_id, order.quantity, order.price)
+                              for client_id, order in entries])
+            self.assertEqual(restored.depth('buy'), original.depth('buy'))
+            self.assertEqual(restored.client_order_ids(None), original.client_order_ids(None))
+            self.assertEqual(restored.add(Order('sell',1,10.2), 2), 8)
+    def test_restored_levels_made_when_reached(self):
+        # given a book restored with one buy level and three sell levels
+        order_book = OrderBook(0.1)
+        order_book.restore_orders([1, 2, 3, 4, 5, 6], [1, 2, 1, 2, 1, 2], [BUY, SELL, SELL, SELL, SELL, SELL],
+                                  [100, 10, 20, 30, 40, 50], [9.9, 10.0, 10.0, 10.1, 10.2, 10.2])
+        # then its size and depth are known before its orders are made
+        self.assertEqual(order_book.order_count(), 6)
+        self.assertEqual(order_book.depth('sell'), ((10.0, 30, 2), (10.1, 30, 1), (10.2, 90, 2)))
+        self.assertEqual(len(order_book._sides[SELL].restored), 3)
+        # and matching only makes the levels it reaches
+        order_book.add(Order('buy',15,10.0), 3)
+        trades = order_book.match(10.0)
+        self.assertEqual([(trade.sell_id, trade.quantity) for trade in trades], [(2, 10), (3, 5)])
+        self.assertEqual(sorted(order_book._sides[SELL].restored), [101, 102])
+        # and orders at other levels are found by ID
+        self.assertEqual(order_book.owner(5), 1)
+        self.assertEqual(order_book.cancel(6)[1].quantity, 50)
+        self.assertEqual(order_book.cancel(7), None)
+        self.assertEqual(order_book.order_count(), 4)
+        # and a mass cancel reaches every level
+        order_book.delete_orders_for_client(2)
+        self.assertEqual([(order.order_id, order.quantity) for order in order_book.orders()],
+                         [(1, 100), (3, 15), (5, 40)])
+    def test_prices_snapped_to_ticks(self):
+        # given a book with a tick size of 0.05
+        order_book = OrderBook(tick_size=0.05)
+        # when orders are added between ticks, or just off a tick through float error
+        buy_order = Order('buy',1000,10.07)
+        sell_order = Order('sell',1000,10.07)
+        on_tick = Order('buy',1000,0.1 + 0.2)
+        order_book.add(buy_order, 0)
+        order_book.add(sell_order, 0)
+        order_book.add(on_tick, 0)
+        # then buys are rounded down and sells up
+        self.assertEqual(buy_order.price, 10.05)
+        self.assertEqual(sell_order.price, 10.1)
+        self.assertEqual(on_tick.price, 0.3)
+        self.assertEqual(order_book.highest_buy_order(), 10.05)
+        self.assertEqual(order_book.lowest_sell_order(), 10.1)
+        # and orders share a level once snapped
+        order_book.add(Order('buy',1000,10.09), 0)
+        self.assertEqual(len(order_book._sides[BUY].prices), 2)
+        order_book.delete(buy_order)
+        self.assertEqual(order_book.highest_buy_order(), 10.05)
+    def test_orders_in_price_time_priority(self):
+        # given a book with unpriced orders and several orders at one price
+        order_book = OrderBook()
+        first = Order('buy',1000,10.0)
+        second = Order('buy',2000,10.0)
+        for order in (first, Order('buy',1000,10.1), second, Order('buy',1000)):
+            order_book.add(order, 0)
+        # then unpriced orders come first, then best price, then time at a price
+        self.assertEqual(order_book.buy_orders(),
+                         [Order('buy',1000), Order('buy',1000,10.1), first, second])
+
+    def test_changed_levels(self):
+        # given a book with a buy level and a sell level
+        order_book = OrderBook()
+        order_book.add(Order('buy',1000,10.0), 0)
+        sell_id = order_book.add(Order('sell',1000,10.2), 1)
+        # then the first call returns every level
+        self.assertEqual(order_book.changed_levels(), [('buy', 10.0, 1000, 1), ('sell', 10.2, 1000, 1)])
+        # and later calls only the levels changed since
+        order_book.add(Order('buy',500,10.0), 0)
+        order_book.add(Order('buy',500), 0)
+        order_book.fill(sell_id, 400)
+        order_book.delete_orders_for_client(0)
+        self.assertEqual(order_book.changed_levels(), [('buy', 10.0, 0, 0), ('sell', 10.2, 600, 1)])
+        self.assertEqual(order_book.changed_levels(), [])
+
+    def test_depth(self):
+        # given a book with two orders at one buy level, one at another and an unpriced buy
+        order_book = OrderBook(tick_size=0.1)
+        order_book.add(Order('buy',1000,10.0), 0)
+        order_id = order_book.add(Order('buy',500,10.04), 1)
+        order_book.add(Order('buy',200,10.1), 0)
+        order_book.add(Order('buy',300), 0)
+        # then depth gives the totals for each priced level, best first
+        depth = order_book.depth('buy')
+        self.assertEqual(depth, ((10.1, 200, 1), (10.0, 1500, 2)))
+        self.assertEqual(order_book.depth(SELL), ())
+        # and the same result while the side is unchanged
+        order_book.add(Order('sell',100,11.0), 0)
+        self.assertTrue(order_book.depth('buy') is depth)
+        # and new totals after fills and cancels
+        order_book.fill(order_id, 100)
+        self.assertEqual(order_book.depth('buy'), ((10.1, 200, 1), (10.0, 1400, 2)))
+        order_book.delete_orders_for_client(0)
+        self.assertEqual(order_book.depth('buy'), ((10.0, 400, 1),))
+        self.assertEqual(order_book.depth('sell'), ())
+    def test_rendering_cached(self):
+        order_book = OrderBook()
+        order_id = order_book.add(Order('buy',1000,10.0), 0)
+        rendered = str(order_book)
+        self.assertEqual(rendered.split('\n'), ['OrderBook', 'Buys', str(Order('buy',1000,10.0)),
+                                                'Sells', 'Empty'])
+        self.assertTrue(str(order_book) is rendered)
+        order_book.fill(order_id, 400)
+        self.assertEqual(str(order_book).split('\n')[2], str(Order('buy',600,10.0)))
+
+class Instrument(object):
+    """The order book and last trade for one symbol on an exchange"""
+    def __init__(self, symbol, open_price, tick_size=None):
+        self.symbol = symbol
+        self.order_book = OrderBook(tick_size, symbol)
+        self.latest_price = open_price
+        self.latest_volume = None
 
 class Exchange(object):
-    # TODO: market orders
-    # TODO: partial fills, volumes not matching generally
     OPEN_DEFAULT_PRICE = 100.0
      
-    def __init__(self):
-        self._order_book = OrderBook()
-        self._latest_price = self.OPEN_DEFAULT_PRICE
-        self._latest_volume = None
+    def __init__(self, continuous=False, tick_size=None, journal=None,
+                 market_data=None, metrics=None, auction=None, risk=None):
+        """In continuous mode each order is matched as it is submitted and only
+        the remainder rests in the book; otherwise orders are collected and
+        matched by match_orders.
+        
+        If tick_size is given, order prices are snapped to multiples of it: buys
+        down and sells up.
+        
+        If a journal.Journal is given, every order, cancel and trade is written
+        to it.
+        
+        If a market_data.MarketDataFeed is given, the depth changes and trades
+        made by each call are published to it.
+        
+        If a metrics sink, such as a metrics.Metrics, is given, call latencies,
+        book depths and counts of orders and trades are reported to it.
+        
+        If auction is 'time' or 'pro_rata', match_orders uncrosses each book as
+        a call auction at a single clearing price, sharing out the volume at
+        the marginal price level by time priority or pro rata; see
+        OrderBook.uncross. It cannot be combined with continuous mode.
+        
+        If a risk.RiskManager is given, orders and amends that would break a
+        client's risk limits are rejected; see risk.py.
+        """
+        if auction is not None and auction not in AUCTION_ALLOCATIONS:
+            raise ValueError('unknown auction allocation %r' % (auction,))
+        if auction is not None and continuous:
+            raise ValueError('an auction exchange cannot trade continuously')
+        self.continuous = continuous
+        self.auction = auction
+        self.tick_size = tick_size
+        self.journal = journal
+        self.market_data = market_data
+        self.metrics = metrics
+        self.risk = risk
+        self._instruments = OrderedDict()
+        # symbols with orders submitted since the last match, in the order first touched
+        self._unmatched_symbols = OrderedDict()
+        self._client_symbols = {}
+        self._trades = []
         self._clients = []
         self.current_client = None
+        self._last_order_id = 0
+        # the instrument used when no symbol is given
+        self.add_instrument(None)
+    
+    # The default instrument's state, under the names used before the exchange had symbols
+    @property
+    def _order_book(self):
+        return self._instruments[None].order_book
+    @property
+    def _latest_price(self):
+        return self._instruments[None].latest_price
+    @_latest_price.setter
+    def _latest_price(self, price):
+        self._instruments[None].latest_price = price
+    @property
+    def _latest_volume(self):
+        return self._instruments[None].latest_volume
+    
+    def add_instrument(self, symbol, open_price=None, tick_size=None):
+        """Add an instrument to the exchange and return it
+        
+        The open price and tick size default to the exchange's. Instruments are
+        also added with the defaults when orders are first submitted or
+        restored for them.
+        """
+        if symbol in self._instruments:
+            raise ValueError('instrument %r already exists' % (symbol,))
+        instrument = Instrument(symbol,
+                                self.OPEN_DEFAULT_PRICE if open_price is None else open_price,
+                                self.tick_size if tick_size is None else tick_size)
+        self._instruments[symbol] = instrument
+        return instrument
+    
+    def instrument(self, symbol=None):
+        """Return the instrument for a symbol, or None if there is none"""
+        return self._instruments.get(symbol)
+    
+    def _instrument_for(self, symbol):
+        """Return the instrument for a symbol, adding it if it is new"""
+        instrument = self._instruments.get(symbol)
+        if instrument is None:
+            instrument = self.add_instrument(symbol)
+        return instrument
+    
+    def _last_price_for(self, symbol):
+        """Return the last trade price for a symbol, or the open price an
+        instrument would be added with if there is none
+        """
+        instrument = self._instruments.get(symbol)
+        return self.OPEN_DEFAULT_PRICE if instrument is None else instrument.latest_price
+    
+    def _next_order_id(self):
+        self._last_order_id += 1
+        return self._last_order_id
+    
+    def restore_order(self, order, client_id, order_id, symbol=None):
+        """Put an order straight into the book for a client, without matching or
+        journalling it
+        
+        Used to rebuild an exchange's state. Order IDs given out afterwards
+        follow on from the highest restored. Outside continuous mode the book
+        is matched by the next match_orders, in case the orders were submitted
+        after the last match.
+        """
+        self._client_symbols.setdefault(client_id, set()).add(symbol)
+        self._instrument_for(symbol).order_book.add(order, client_id, order_id)
+        self._note_unmatched(symbol)
+        self._last_order_id = max(self._last_order_id, order_id)
+    
+    def restore_orders(self, order_ids, client_ids, sides, quantities, prices, symbol=None):
+        """Put orders given as columns straight into a book, as restore_order does
+        
+        The orders must be in priority order for each side. As with
+        restore_order, the book is matched by the next match_orders outside
+        continuous mode.
+        """
+        for client_id in set(client_ids):
+            self._client_symbols.setdefault(client_id, set()).add(symbol)
+        self._instrument_for(symbol).order_book.restore_orders(order_ids, client_ids, sides,
+                                                                quantities, prices)
+        if order_ids:
+            self._last_order_id = max(self._last_order_id, max(order_ids))
+            self._note_unmatched(symbol)
+    
+    def last_order_id(self):
+        """Return the ID of the last order submitted"""
+        return self._last_order_id
+    
+    def restore_last_order_id(self, order_id):
+        """Make order IDs given out from now on follow on from order_id"""
+        self._last_order_id = max(self._last_order_id, order_id)
+    
+    def restore_amend(self, order_id, quantity=None, price=None, symbol=None):
+        """Amend an order in the book, without matching or journalling it
+        
+        As with restore_order, the book is matched by the next match_orders
+        outside continuous mode.
+        """
+        self._instrument_for(symbol).order_book.amend(order_id, quantity, price)
+        self._note_unmatched(symbol)
+    
+    def restore_fill(self, buy_id, sell_id, price, quantity, symbol=None):
+        """Apply a fill between two orders in the book, without matching or
+        journalling it, and make it the last trade
+        """
+        instrument = self._instrument_for(symbol)
+        instrument.order_book.apply_fills([(buy_id, sell_id, price, quantity)])
+        instrument.latest_price = price
+        instrument.latest_volume = quantity
+    
+    def symbols(self):
+        """Return the symbols of all instruments, in the order they were added"""
+        return list(self._instruments)
+    
+    def _book_for_submit(self, symbol, client_id):
+        """Return the instrument for symbol, noting that the client has orders in it"""
+        instrument = self._instrument_for(symbol)
+        self._client_symbols.setdefault(client_id, set()).add(symbol)
+        self._note_unmatched(symbol)
+        return instrument
+    
+    def _note_unmatched(self, symbol):
+        """Note that a book may have crossed, so that match_orders matches it"""
+        if not self.continuous:
+            self._unmatched_symbols[symbol] = None
  
-    def submit_order(self,order):
-        self._order_book.add(order, self.current_client)
+    # The client-facing methods below act for current_client. Each has a private
+    # counterpart taking the client ID explicitly, which ClientContext calls.
+    
+    def submit_order(self, order, symbol=None):
+        """Add an order to the book for the current client and return its ID,
+        or None if it is rejected by the risk checks
+        """
+        return self._submit_order(order, symbol, self.current_client)
+    
+    def _submit_order(self, order, symbol, client_id):
+        metrics = self.metrics
+        if metrics is not None:
+            start = _clock()
+        risk = self.risk
+        if risk is not None:
+            last_price = self._last_price_for(symbol)
+            if self._rejected(risk.check_order(client_id, order, symbol, last_price), client_id):
+                return None
+        instrument = self._book_for_submit(symbol, client_id)
+        order_id = self._next_order_id()
+        if self.journal is not None:
+            self.journal.record_order(order_id, client_id, order, symbol)
+        if risk is not None:
+            risk.add_order(order_id, client_id, order, symbol, last_price)
+        if self.continuous:
+            order.order_id = order_id
+            self._record_trades(instrument, instrument.order_book.execute(
+                order, client_id, instrument.latest_price))
+        if not self.continuous or order.quantity > 0:
+            instrument.order_book.add(order, client_id, order_id)
+        self._publish_book(instrument)
+        if metrics is not None:
+            metrics.record_latency('submit', _clock() - start)
+            metrics.increment('orders')
+        return order_id
+    
+    def execute_order(self, order, symbol=None):
+        """Execute an order straight away and cancel whatever is left of it
+        
+        An order without a price is a market order and takes the best prices
+        available; an order with a price is immediate-or-cancel and only trades
+        at its limit or better. Neither rests in the book. Returns an Execution,
+        or None if the order is rejected by the risk checks.
+        """
+        return self._execute_order(order, symbol, self.current_client)
+    
+    def _execute_order(self, order, symbol, client_id):
+        metrics = self.metrics
+        if metrics is not None:
+            start = _clock()
+        if self.risk is not None and self._rejected(
+                self.risk.check_order(client_id, order, symbol, self._last_price_for(symbol), False),
+                client_id):
+            return None
+        order_id = self._next_order_id()
+        order.order_id = order_id
+        if self.journal is not None:
+            self.journal.record_order(order_id, client_id, order, symbol)
+        # an order for a symbol with no book has nothing to trade with
+        instrument = self._instruments.get(symbol)
+        trades = []
+        if instrument is not None:
+            trades = instrument.order_book.execute(order, client_id, instrument.latest_price)
+            self._record_trades(instrument, trades)
+        if self.journal is not None and order.quantity > 0:
+            self.journal.record_cancel(order_id, client_id, symbol)
+        if instrument is not None:
+            self._publish_book(instrument)
+        if metrics is not None:
+            metrics.record_latency('execute', _clock() - start)
+            metrics.increment('orders')
+        return Execution(order_id=order_id, trades=trades, unfilled=max(order.quantity, 0))
+    
+    def cancel_order(self, order_id, symbol=None):
+        """Cancel one of the current client's orders by ID
+        
+        Returns True if the order was cancelled, False if it is not in the book
+        or belongs to another client.
+        """
+        return self._cancel_order(order_id, symbol, self.current_client)
+    
+    def _cancel_order(self, order_id, symbol, client_id):
+        metrics = self.metrics
+        if metrics is not None:
+            start = _clock()
+        instrument = self._instruments.get(symbol)
+        cancelled = (instrument is not None and instrument.order_book.owner(order_id) == client_id
+                     and instrument.order_book.cancel(order_id) is not None)
+        if cancelled:
+            if self.journal is not None:
+                self.journal.record_cancel(order_id, client_id, symbol)
+            if self.risk is not None:
+                self.risk.cancel_order(order_id)
+            self._publish_book(instrument)
+        if metrics is not None:
+            metrics.record_latency('cancel', _clock() - start)
+            if cancelled:
+                metrics.increment('cancelled')
+        return cancelled
              
-    def submit_orders(self, orders):
-        map(self.submit_order, orders)
+    def amend_order(self, order_id, quantity=None, price=None, symbol=None):
+        """Change the quantity and/or price of one of the current client's orders
+        
+        A quantity or price of None is left as it is. The order keeps its ID,
+        and its time priority if its quantity is only reduced. Otherwise it goes
+        to the back of the queue at its price and, in continuous mode, is first
+        matched as a new order would be. Amending an order to its current
+        values does nothing.
+        
+        Returns True if the order was amended or already had the values, False
+        if it is not in the book or belongs to another client, or None if the
+        amend is rejected by the risk checks, which leaves the order as it was.
+        """
+        return self._amend_order(order_id, quantity, price, symbol, self.current_client)
+    
+    def _amend_order(self, order_id, quantity, price, symbol, client_id):
+        if quantity is not None and quantity <= 0:
+            raise ValueError('amended quantity must be positive, not %r' % (quantity,))
+        metrics = self.metrics
+        if metrics is not None:
+            start = _clock()
+        instrument = self._instruments.get(symbol)
+        if instrument is None:
+            return False
+        order_book = instrument.order_book
+        order = order_book.order(order_id)
+        if order is None or order_book.owner(order_id) != client_id:
+            return False
+        if not order_book.differs(order_id, quantity, price):
+            return True
+        if self.risk is not None:
+            if self._rejected(self.risk.check_amend(order_id, quantity, price), client_id):
+                return None
+            self.risk.amend_order(order_id, quantity, price)
+        if self.journal is not None:
+            self.journal.record_amend(order_id, client_id, quantity, price, symbol)
+        if self.continuous and not order_book.keeps_priority(order_id, quantity, price):
+            order_book.cancel(order_id)
+            if quantity is not None:
+                order.quantity = quantity
+            if price is not None:
+                order.price = price
+            self._record_trades(instrument, order_book.execute(order, client_id,
+                                                               instrument.latest_price))
+            if order.quantity > 0:
+                order_book.add(order, client_id, order_id)
+        else:
+            order_book.amend(order_id, quantity, price)
+            self._note_unmatched(symbol)
+        self._publish_book(instrument)
+        if metrics is not None:
+            metrics.record_latency('amend', _clock() - start)
+        return True
+             
+    def submit_orders(self, orders, symbol=None):
+        """Submit a sequence of orders for the current client and return their IDs
+        
+        In batch mode the orders go into the book in a single pass. In
+        continuous mode each order is matched in turn as it would be by
+        submit_order. The ID of an order rejected by the risk checks is None.
+        """
+        return self._submit_orders(orders, symbol, self.current_client)
+    
+    def _submit_orders(self, orders, symbol, client_id):
+        metrics = self.metrics
+        if metrics is not None:
+            start = _clock()
+        if self.continuous:
+            # each order is counted by _submit_order
+            order_ids = [self._submit_order(order, symbol, client_id) for order in orders]
+        else:
+            orders = list(orders)
+            if self.risk is not None:
+                accepted = self._risk_check_orders(orders, symbol, client_id)
+                orders = list(compress(orders, accepted))
+            order_ids = list(range(self._last_order_id + 1, self._last_order_id + len(orders) + 1))
+            self._last_order_id += len(orders)
+            if self.journal is not None:
+                for order_id, order in zip(order_ids, orders):
+                    self.journal.record_order(order_id, client_id, order, symbol)
+            instrument = self._book_for_submit(symbol, client_id)
+            instrument.order_book.add_orders(orders, client_id, order_ids)
+            self._publish_book(instrument)
+            if metrics is not None:
+                metrics.increment('orders', len(order_ids))
+            if self.risk is not None and len(orders) < len(accepted):
+                accepted_ids = iter(order_ids)
+                order_ids = [next(accepted_ids) if ok else None for ok in accepted]
+        if metrics is not None:
+            metrics.record_latency('submit_orders', _clock() - start)
+        return order_ids
+    
+    def _risk_check_orders(self, orders, symbol, client_id):
+        """Return whether each of a batch of orders passes the risk checks,
+        counting each one accepted as open, under the ID it will be given,
+        before checking the next
+        """
+        risk = self.risk
+        last_price = self._last_price_for(symbol)
+        order_id = self._last_order_id
+        accepted = []
+        for order in orders:
+            ok = not self._rejected(risk.check_order(client_id, order, symbol, last_price),
+                                    client_id)
+            if ok:
+                order_id += 1
+                risk.add_order(order_id, client_id, order, symbol, last_price)
+            accepted.append(ok)
+        return accepted
+    
+    def _rejected(self, reason, client_id):
+        """Log and count a rejection by the risk checks, if reason is not None,
+        and return whether there was one
+        """
+        if reason is None:
+            return False
+        logger.debug('order or amend from client %s rejected: %s', client_id, reason)
+        if self.metrics is not None:
+            self.metrics.increment('rejected')
+        return True
+    
+    def submit_order_arrays(self, buy_sells, quantities, prices=None, symbol=None):
+        """Submit orders given as columns of sides, quantities and prices
+        
+        prices can be omitted to submit orders without a price. Returns the
+        order IDs.
+        """
+        return self._submit_orders(orders_from_arrays(buy_sells, quantities, prices),
+                                   symbol, self.current_client)
+     
+    def depth(self, buy_sell, symbol=None):
+        """Return (price, quantity, order_count) for each priced level on one
+        side of the book, best price first
+        """
+        instrument = self._instruments.get(symbol)
+        return () if instrument is None else instrument.order_book.depth(buy_sell)
      
-    def buy_order_book(self):
-        return self._order_book.buy_orders()
+    def buy_order_book(self, symbol=None):
+        instrument = self._instruments.get(symbol)
+        return [] if instrument is None else instrument.order_book.buy_orders()
      
-    def sell_order_book(self):
-        return self._order_book.sell_orders()        
+    def sell_order_book(self, symbol=None):
+        instrument = self._instruments.get(symbol)
+        return [] if instrument is None else instrument.order_book.sell_orders()
  
-    def order_book(self):
-        return self._order_book.orders()
+    def order_book(self, symbol=None):
+        instrument = self._instruments.get(symbol)
+        return [] if instrument is None else instrument.order_book.orders()
     
     def order_matches(self, buy_order, sell_order):
-        if (buy_order.quantity == sell_order.quantity and 
-            self._order_book.client_id_for(buy_order) != self._order_book.client_id_for(sell_order)):
+        if self._order_book.client_id_for(buy_order) != self._order_book.client_id_for(sell_order):
             return match_order(self._latest_price, buy_order.price, sell_order.price)
         return (False, None)
      
     def match_orders(self):
+        """Match the orders in the book and return the trades
+        
+        Only the books that have had orders submitted since the last call are
+        matched, in the order they were first submitted to. In continuous mode
+        orders have already been matched on submission, so this only returns
+        the trades made since the last call.
+        """
         logger.debug('match_orders called')
-        trades = []
-        for buy_order in self._order_book.buy_orders():
-            for sell_order in self._order_book.sell_orders():
-                orders_match, trade_price = self.order_matches(buy_order,sell_order)
-                if orders_match:
-                    logger.debug('match_orders: Matching orders found')
-                    trades.append(Trade(buy=buy_order, sell=sell_order,price=trade_price))
-                    self._order_book.delete(sell_order)
-                    break
-        logger.debug('match_orders: %s trades matched' % len(trades))
-        for trade in trades:
-            self._order_book.delete(trade.buy)
-        if trades:
-            self._latest_price = trades[0].price
-            self._latest_volume = trades[0].buy.quantity
-            logger.debug('match_orders: setting _latest_price=%s, _latest_volume=%s' 
-                         % (self._latest_price, self._latest_volume))
+        metrics = self.metrics
+        if metrics is not None:
+            start = _clock()
+        instruments = [self._instruments[symbol] for symbol in self._unmatched_symbols]
+        self._unmatched_symbols.clear()
+        for instrument in instruments:
+            self._record_trades(instrument, match_book(instrument.order_book,
+                                                       instrument.latest_price, self.auction))
+        for instrument in instruments:
+            self._publish_book(instrument)
+        trades, self._trades = self._trades, []
+        if metrics is not None:
+            metrics.record_latency('match', _clock() - start)
+            for instrument in instruments:
+                metrics.record_value(('depth', instrument.symbol), instrument.order_book.order_count())
+        logger.debug('match_orders: %s trades matched', len(trades))
         return trades
+    
+    def _record_trades(self, instrument, trades):
+        if trades:
+            if self.journal is not None:
+                for trade in trades:
+                    self.journal.record_trade(trade)
+            if self.risk is not None:
+                self.risk.add_trades(trades)
+            if self.market_data is not None:
+                self.market_data.publish_trades(trades)
+            if self.metrics is not None:
+                self.metrics.increment('trades', len(trades))
+                self.metrics.increment('volume', sum(trade.quantity for trade in trades))
+            self._trades.extend(trades)
+            instrument.latest_price = trades[-1].price
+            instrument.latest_volume = trades[-1].quantity
+            logger.debug('match_orders: setting latest_price=%s, latest_volume=%s for %s',
+                         instrument.latest_price, instrument.latest_volume, instrument.symbol)
+    
+    def _publish_book(self, instrument):
+        if self.market_data is not None:
+            self.market_data.publish_book(instrument.order_book)
       
-    def bid_offer(self):
+    def bid_offer(self, symbol=None, excluding=()):
         """Return bid, offer price
         
         Bid and offer are the prices of the highest current buy and lowest current 
         sell orders. If there are no orders of one type then the last trade price
-        is returned instead.
+        is returned instead. Orders with IDs in excluding, such as a client's
+        own quotes, are left out.
         """
-        bid = self._order_book.highest_buy_order()
-        offer = self._order_book.lowest_sell_order()
-        bid = bid if bid else (offer if offer else self._latest_price)
-        offer = offer if offer else (bid if bid else self._latest_price)
+        instrument = self._instruments.get(symbol)
+        if instrument is None:
+            return self.OPEN_DEFAULT_PRICE, self.OPEN_DEFAULT_PRICE
+        bid = instrument.order_book.highest_buy_order(excluding)
+        offer = instrument.order_book.lowest_sell_order(excluding)
+        bid = bid if bid else (offer if offer else instrument.latest_price)
+        offer = offer if offer else (bid if bid else instrument.latest_price)
         return bid, offer
      
-    def last_trade(self):
-        return self._latest_price, self._latest_volume
+    def last_trade(self, symbol=None):
+        instrument = self._instruments.get(symbol)
+        if instrument is None:
+            return self.OPEN_DEFAULT_PRICE, None
+        return instrument.latest_price, instrument.latest_volume
      
     def do_trading(self):
         logger.debug('do_trading called')
-#         logging.debug('initial state of order book: %s', self._order_book)
-        logging.debug('initial state of order book: %s', str(self._order_book))
+        # only render the book when it will be logged
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug('initial state of order book: %s', self._order_book)
+        metrics = self.metrics
+        if metrics is not None:
+            round_start = _clock()
         for client_id, client in enumerate(self._clients):
             self.current_client = client_id
-            logger.debug('calling client %s' % client_id)
+            if debug:
+                logger.debug('calling client %s', client_id)
+            if metrics is not None:
+                start = _clock()
             client(self)
-            logging.debug('order book after client %s: \n%s' % (client_id, str(self._order_book)))
+            if metrics is not None:
+                metrics.record_latency(('client', client_id), _clock() - start)
+            if debug:
+                logger.debug('order book after client %s: \n%s', client_id, self._order_book)
         self.current_client = None
+        if metrics is not None:
+            metrics.record_latency('round', _clock() - round_start)
         # TODO: do_trading should call match_orders. Need to add a test and review other tests.
      
     def add_client(self,client_callable):
         self._clients.append(client_callable)
                       
+    def clients(self):
+        """Return the registered clients; a client's ID is its position in the list"""
+        return list(self._clients)
+                      
     def delete_my_orders(self):
-        self._order_book.delete_orders_for_client(self.current_client)
+        """Delete the current client's orders for every symbol"""
+        self._delete_orders(self.current_client)
+        
+    def _delete_orders(self, client_id):
+        metrics = self.metrics
+        if metrics is not None:
+            start = _clock()
+        if self.journal is not None:
+            self.journal.record_mass_cancel(client_id)
+        if self.risk is not None:
+            self.risk.cancel_orders_for_client(client_id)
+        for symbol in self._client_symbols.pop(client_id, ()):
+            instrument = self._instruments[symbol]
+            instrument.order_book.delete_orders_for_client(client_id)
+            self._publish_book(instrument)
+        if metrics is not None:
+            metrics.record_latency('delete_orders', _clock() - start)
         
+class ClientContext(object):
+    """An exchange as seen by one client
+    
+    Orders submitted, executed and cancelled through a context belong to its
+    client, so a client can be called with one instead of setting the
+    exchange's current_client. Everything else is passed through to the
+    exchange.
+    """
+    def __init__(self, exchange, client_id):
+        self.exchange = exchange
+        self.client_id = client_id
+    def __getattr__(self, name):
+        return getattr(self.exchange, name)
+    def submit_order(self, order, symbol=None):
+        return self.exchange._submit_order(order, symbol, self.client_id)
+    def submit_orders(self, orders, symbol=None):
+        return self.exchange._submit_orders(orders, symbol, self.client_id)
+    def submit_order_arrays(self, buy_sells, quantities, prices=None, symbol=None):
+        return self.exchange._submit_orders(orders_from_arrays(buy_sells, quantities, prices),
+                                            symbol, self.client_id)
+    def execute_order(self, order, symbol=None):
+        return self.exchange._execute_order(order, symbol, self.client_id)
+    def cancel_order(self, order_id, symbol=None):
+        return self.exchange._cancel_order(order_id, symbol, self.client_id)
+    def amend_order(self, order_id, quantity=None, price=None, symbol=None):
+        return self.exchange._amend_order(order_id, quantity, price, symbol, self.client_id)
+    def delete_my_orders(self):
+        self.exchange._delete_orders(self.client_id)
+        
+def orders_from_arrays(buy_sells, quantities, prices=None):
+    """Return orders made from columns of sides, quantities and optional prices"""
+    if prices is None:
+        prices = [None] * len(quantities)
+    return [Order(buy_sell, quantity, price)
+            for (buy_sell, quantity, price) in zip(buy_sells, quantities, prices)]
+
+def _run_end(values, start):
+    """Return the end of the run of values equal to values[start], where equal
+    values are always next to each other
+    
+    The step taken doubles until it passes the end of the run, which is then
+    found by bisection, so a long run costs few comparisons.
+    """
+    value = values[start]
+    low, high, step = start, start + 1, 1
+    while high < len(values) and values[high] == value:
+        low = high
+        step *= 2
+        high = low + step
+    high = min(high, len(values))
+    while high - low > 1:
+        middle = (low + high) // 2
+        if values[middle] == value:
+            low = middle
+        else:
+            high = middle
+    return high
+
+def match_book(order_book, current_price, auction=None):
+    """Match a book, as a call auction with the given allocation if auction is
+    not None, and return the trades
+    """
+    if auction is None:
+        return order_book.match(current_price)
+    return order_book.uncross(current_price, auction)
+
 def clamp(n, max_n, min_n):
     """return n, limited to the range min_n <= n <= max_n
     
@@ -273,6 +1764,20 @@ def clamp(n, max_n, min_n):
     else:
         return max(min(max_n, n), min_n)
 
+def to_ticks(price, tick_size, side):
+    """Return price as a whole number of ticks, rounding down for BUY and up for SELL
+    
+    Prices within a rounding error of a tick are treated as on it.
+    """
+    ticks = float(price) / tick_size
+    if side == BUY:
+        return int(math.floor(ticks + TICK_TOLERANCE))
+    return int(math.ceil(ticks - TICK_TOLERANCE))
+
+def from_ticks(ticks, tick_size):
+    """Return the price for a whole number of ticks"""
+    return round(ticks * tick_size, PRICE_DECIMALS)
+
 def match_order(current_price, buy_price, sell_price):
     match = buy_price is None or sell_price is None or buy_price >= sell_price
     new_price = clamp(current_price, buy_price, sell_price)
@@ -412,6 +1917,54 @@ class TestExchange(unittest.TestCase):
         self.assertEqual(len(orders), 1)
         self.assertEqual(orders[0], order)
          
+    def test_submit_order_returns_unique_ids(self):
+        exchange = Exchange()
+        first_id = exchange.submit_order(Order('buy',1000,10.0))
+        second_id = exchange.submit_order(Order('buy',1000,10.0))
+        self.assertNotEqual(first_id, second_id)
+        self.assertNotEqual(exchange.order_book()[0], exchange.order_book()[1])
+ 
+    def test_cancel_order(self):
+        # given orders from two clients
+        exchange = Exchange()
+        exchange.current_client = 1
+        own_order_id = exchange.submit_order(Order('buy',1000,10.0))
+        exchange.current_client = 2
+        other_order_id = exchange.submit_order(Order('buy',1000,10.0))
+        # a client can cancel its own order but not another client's
+        self.assertFalse(exchange.cancel_order(own_order_id))
+        self.assertTrue(exchange.cancel_order(other_order_id))
+        self.assertFalse(exchange.cancel_order(other_order_id))
+        self.assertEqual([order.order_id for order in exchange.order_book()], [own_order_id])
+         
+    def test_submit_orders_returns_ids(self):
+        exchange = Exchange()
+        exchange.current_client = 3
+        order_ids = exchange.submit_orders([Order('buy',1000,10.0), Order('sell',1000,10.1)])
+        self.assertEqual([order.order_id for order in exchange.order_book()], order_ids)
+        self.assertEqual(exchange.submit_orders([]), [])
+ 
+    def test_submit_order_arrays(self):
+        exchange = Exchange()
+        order_ids = exchange.submit_order_arrays(['buy', 'sell', 'buy'], [100, 200, 300],
+                                                 [10.0, 10.2, 10.1])
+        self.assertEqual(len(order_ids), 3)
+        self.assertEqual(exchange.buy_order_book(), [Order('buy',300,10.1), Order('buy',100,10.0)])
+        self.assertEqual(exchange.sell_order_book(), [Order('sell',200,10.2)])
+        exchange.submit_order_arrays(['sell'], [100])
+        self.assertEqual(exchange.sell_order_book()[0], Order('sell',100))
+ 
+    def test_tick_size(self):
+        exchange = Exchange(tick_size=0.01)
+        exchange.current_client = 1
+        exchange.submit_order(Order('sell',1000,99.999))
+        exchange.current_client = 2
+        exchange.submit_order(Order('buy',1000,100.004))
+        self.assertEqual(exchange.bid_offer(), (100.0, 100.0))
+        trades = exchange.match_orders()
+        self.assertEqual(len(trades), 1)
+        self.assertEqual(trades[0].price, 100.0)
+ 
     def test_no_orders_no_matches(self):
         exchange = Exchange()
         matches = exchange.match_orders()
@@ -437,8 +1990,8 @@ class TestExchange(unittest.TestCase):
         exchange.submit_order(sell_order)
         trades = exchange.match_orders()
         self.assertEqual(len(trades), 1)
-        self.assertEqual(trades[0].buy, buy_order)
-        self.assertEqual(trades[0].sell, sell_order)
+        self.assertEqual(trades[0].buy_id, buy_order.order_id)
+        self.assertEqual(trades[0].sell_id, sell_order.order_id)
          
     def test_matched_orders_removed_from_order_book(self):
         exchange = Exchange()
@@ -474,8 +2027,8 @@ class TestExchange(unittest.TestCase):
         exchange.submit_order(sell_order_2)
         trades = exchange.match_orders()
         self.assertEqual(len(trades), 1)
-        self.assertEqual(trades[0].buy, buy_order)
-        self.assertEqual(trades[0].sell, sell_order_1)
+        self.assertEqual(trades[0].buy_id, buy_order.order_id)
+        self.assertEqual(trades[0].sell_id, sell_order_1.order_id)
         self.assertEqual(len(exchange.order_book()), 1)
         self.assertEqual(exchange.order_book()[0], sell_order_2)
          
@@ -491,11 +2044,85 @@ class TestExchange(unittest.TestCase):
         exchange.submit_order(sell_order)
         trades = exchange.match_orders()
         self.assertEqual(len(trades), 1)
-        self.assertEqual(trades[0].buy, buy_order_1)
-        self.assertEqual(trades[0].sell, sell_order)
+        self.assertEqual(trades[0].buy_id, buy_order_1.order_id)
+        self.assertEqual(trades[0].sell_id, sell_order.order_id)
         self.assertEqual(len(exchange.order_book()), 1)
         self.assertEqual(exchange.order_book()[0], buy_order_2)
         
+    def test_highest_buy_takes_lowest_sell(self):
+        # given buys and sells at several prices from different clients
+        exchange = Exchange()
+        exchange.current_client = 1
+        low_buy = Order('buy',1000,10.0)
+        high_buy = Order('buy',1000,10.2)
+        exchange.submit_order(low_buy)
+        exchange.submit_order(high_buy)
+        exchange.current_client = 2
+        high_sell = Order('sell',1000,10.1)
+        low_sell = Order('sell',1000,9.9)
+        exchange.submit_order(high_sell)
+        exchange.submit_order(low_sell)
+        # when orders are matched
+        trades = exchange.match_orders()
+        # then the highest buy trades with the lowest sell, and no other orders cross
+        self.assertEqual(len(trades), 1)
+        self.assertEqual(trades[0].buy_id, high_buy.order_id)
+        self.assertEqual(trades[0].sell_id, low_sell.order_id)
+        self.assertEqual(exchange.order_book(), [low_buy, high_sell])
+         
+    def test_own_order_skipped_for_next_in_priority(self):
+        # given a client whose own sell is best, and another client's sell behind it
+        exchange = Exchange()
+        exchange.current_client = 1
+        exchange.submit_order(Order('buy',1000,10.0))
+        own_sell = Order('sell',1000,9.8)
+        exchange.submit_order(own_sell)
+        exchange.current_client = 2
+        other_sell = Order('sell',1000,9.9)
+        exchange.submit_order(other_sell)
+        # when orders are matched
+        trades = exchange.match_orders()
+        # then the buy trades with the other client's sell
+        self.assertEqual(len(trades), 1)
+        self.assertEqual(trades[0].sell_id, other_sell.order_id)
+        self.assertEqual(exchange.order_book(), [own_sell])
+        
+    def test_large_buy_sweeps_several_sells(self):
+        # given sells for 300 at two prices and a buy for 500
+        exchange = Exchange()
+        exchange._latest_price = 10.0
+        exchange.current_client = 1
+        first_sell = Order('sell',100,10.0)
+        second_sell = Order('sell',200,10.1)
+        exchange.submit_order(second_sell)
+        exchange.submit_order(first_sell)
+        exchange.current_client = 2
+        buy_order = Order('buy',500,10.2)
+        exchange.submit_order(buy_order)
+        # when orders are matched
+        trades = exchange.match_orders()
+        # then each sell is filled by its own trade, best price first
+        self.assertEqual([(trade.sell_id, trade.quantity) for trade in trades],
+                         [(first_sell.order_id, 100), (second_sell.order_id, 200)])
+        # and the rest of the buy stays in the book
+        self.assertEqual(exchange.order_book(), [buy_order])
+        self.assertEqual(buy_order.quantity, 200)
+        self.assertEqual(exchange.last_trade(), (10.1, 200))
+         
+    def test_partial_fill_leaves_remainder_of_sell(self):
+        exchange = Exchange()
+        exchange.current_client = 1
+        sell_order = Order('sell',1000,10.0)
+        exchange.submit_order(sell_order)
+        exchange.current_client = 2
+        exchange.submit_order(Order('buy',400,10.0))
+        trades = exchange.match_orders()
+        self.assertEqual(len(trades), 1)
+        self.assertEqual(trades[0].quantity, 400)
+        self.assertEqual(exchange.sell_order_book(), [sell_order])
+        self.assertEqual(exchange.sell_order_book()[0].quantity, 600)
+        self.assertEqual(exchange.buy_order_book(), [])
+        
 # bid lower than offer - no match
 # bid equal to offer - match
 # bid higher than offer - match
@@ -503,6 +2130,356 @@ class TestExchange(unittest.TestCase):
 # multiple sells, lowest takes it
 # can't trade with yourself
  
+class TestClientContext(unittest.TestCase):
+    def test_orders_belong_to_context_client(self):
+        exchange = Exchange()
+        context = ClientContext(exchange, 4)
+        order_id = context.submit_order(Order('buy',100,10.0))
+        context.submit_orders([Order('sell',100,11.0)], 'AAA')
+        context.submit_order_arrays(['sell'], [100], [12.0])
+        self.assertEqual(exchange.current_client, None)
+        self.assertEqual(exchange._order_book.owner(order_id), 4)
+        self.assertFalse(exchange.cancel_order(order_id))
+        self.assertEqual(context.bid_offer(), (10.0, 12.0))
+        self.assertEqual(context.execute_order(Order('sell',100)).unfilled, 100)
+        self.assertTrue(context.cancel_order(order_id))
+        context.delete_my_orders()
+        self.assertEqual(exchange.order_book('AAA'), [])
+        self.assertEqual(exchange.order_book(), [])
+
+class TestSymbols(unittest.TestCase):
+    
+    def setUp(self):
+        self.exchange = Exchange()
+        self.exchange.add_instrument('AAA', open_price=10.0)
+        
+    def submit_crossing_orders(self, symbol):
+        self.exchange.current_client = 1
+        self.exchange.submit_order(Order('buy',100,10.5), symbol)
+        self.exchange.current_client = 2
+        self.exchange.submit_order(Order('sell',100,9.5), symbol)
+        
+    def test_books_are_separate(self):
+        self.exchange.submit_order(Order('buy',100,10.0), 'AAA')
+        self.exchange.submit_order(Order('sell',100,20.0), 'BBB')
+        self.assertEqual(self.exchange.bid_offer('AAA'), (10.0, 10.0))
+        self.assertEqual(self.exchange.bid_offer('BBB'), (20.0, 20.0))
+        self.assertEqual(self.exchange.bid_offer(), (100.0, 100.0))
+        self.assertEqual(self.exchange.order_book(), [])
+        self.assertEqual(self.exchange.symbols(), [None, 'AAA', 'BBB'])
+        self.assertRaises(ValueError, self.exchange.add_instrument, 'AAA')
+        
+    def test_reads_do_not_add_instruments(self):
+        # when an unknown symbol is read from, cancelled or amended in
+        self.assertEqual(self.exchange.last_trade('ZZZ'), (100.0, None))
+        self.assertEqual(self.exchange.bid_offer('TYPO'), (100.0, 100.0))
+        self.assertEqual(self.exchange.depth('buy', 'X'), ())
+        self.assertEqual(self.exchange.order_book('X'), [])
+        self.assertEqual(self.exchange.cancel_order(1, 'Q'), False)
+        self.assertEqual(self.exchange.amend_order(1, 50, None, 'Q'), False)
+        self.assertEqual(self.exchange.execute_order(Order('buy',100,None), 'Q').unfilled, 100)
+        self.assertEqual(self.exchange.instrument('Q'), None)
+        # then no instrument is added for it
+        self.assertEqual(self.exchange.symbols(), [None, 'AAA'])
+        
+    def test_trades_per_symbol(self):
+        self.submit_crossing_orders('AAA')
+        self.submit_crossing_orders('BBB')
+        trades = self.exchange.match_orders()
+        self.assertEqual([(trade.symbol, trade.price) for trade in trades],
+                         [('AAA', 10.0), ('BBB', 10.5)])
+        self.assertEqual(self.exchange.last_trade('AAA'), (10.0, 100))
+        self.assertEqual(self.exchange.last_trade(), (100.0, None))
+        
+    def test_only_books_with_new_orders_matched(self):
+        self.submit_crossing_orders('AAA')
+        self.exchange.match_orders()
+        # crossing orders put straight into the book, not submitted, are left alone
+        order_book = self.exchange.instrument('AAA').order_book
+        order_book.add(Order('buy',100,10.5), 1)
+        order_book.add(Order('sell',100,9.5), 2)
+        self.exchange.submit_order(Order('buy',100,1.0), 'BBB')
+        self.assertEqual(self.exchange.match_orders(), [])
+        self.assertEqual(len(self.exchange.order_book('AAA')), 2)
+        
+    def test_delete_my_orders_for_all_symbols(self):
+        self.exchange.current_client = 1
+        self.exchange.submit_order(Order('buy',100,10.0), 'AAA')
+        self.exchange.submit_orders([Order('buy',100,10.0)], 'BBB')
+        self.exchange.current_client = 2
+        self.exchange.submit_order(Order('buy',100,10.0), 'BBB')
+        order_id = self.exchange.submit_order(Order('buy',100,10.0), 'AAA')
+        self.exchange.current_client = 1
+        self.exchange.delete_my_orders()
+        self.assertEqual(self.exchange.order_book('AAA'), [Order('buy',100,10.0)])
+        self.assertEqual(len(self.exchange.order_book('BBB')), 1)
+        self.exchange.current_client = 2
+        self.assertFalse(self.exchange.cancel_order(order_id))
+        self.assertTrue(self.exchange.cancel_order(order_id, 'AAA'))
+
+class TestLevelSize(unittest.TestCase):
+    FILLS = 200
+
+    def time_fills(self, level_size, continuous=False):
+        """Return the seconds taken by FILLS one-lot buys, each filling one of
+        level_size resting sells at the same price, taking the best of 3 runs
+        """
+        best = None
+        for _ in range(3):
+            exchange = Exchange(continuous=continuous)
+            exchange.current_client = 1
+            exchange.submit_orders([Order('sell',1,10.0) for _ in range(level_size)])
+            exchange.match_orders()
+            exchange.current_client = 2
+            start = _clock()
+            for _ in range(self.FILLS):
+                exchange.submit_order(Order('buy',1,10.0))
+            trades = exchange.match_orders()
+            elapsed = _clock() - start
+            self.assertEqual(len(trades), self.FILLS)
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def test_match_cost_independent_of_level_size(self):
+        self.assertLess(self.time_fills(20000), 5 * self.time_fills(self.FILLS))
+
+    def test_continuous_cost_independent_of_level_size(self):
+        self.assertLess(self.time_fills(20000, continuous=True),
+                        5 * self.time_fills(self.FILLS, continuous=True))
+
+class TestImmediateOrders(unittest.TestCase):
+    
+    def setUp(self):
+        self.exchange = Exchange()
+        self.exchange.current_client = 1
+        self.exchange.submit_order(Order('sell',100,10.0))
+        self.exchange.submit_order(Order('sell',100,10.2))
+        self.exchange.submit_order(Order('buy',100,9.0))
+        self.exchange.current_client = 2
+    
+    def test_market_order_takes_best_prices(self):
+        execution = self.exchange.execute_order(Order('buy',150))
+        self.assertEqual([(trade.sell_id, trade.quantity) for trade in execution.trades],
+                         [(1, 100), (2, 50)])
+        self.assertEqual(execution.unfilled, 0)
+        self.assertEqual(self.exchange.sell_order_book(), [Order('sell',50,10.2)])
+        self.assertEqual(self.exchange.match_orders(), execution.trades)
+    
+    def test_market_order_remainder_cancelled(self):
+        execution = self.exchange.execute_order(Order('sell',300))
+        self.assertEqual(len(execution.trades), 1)
+        self.assertEqual(execution.unfilled, 200)
+        self.assertEqual(self.exchange.buy_order_book(), [])
+        self.assertEqual(len(self.exchange.order_book()), 2)
+    
+    def test_immediate_or_cancel_respects_limit(self):
+        execution = self.exchange.execute_order(Order('buy',300,10.1))
+        self.assertEqual([trade.quantity for trade in execution.trades], [100])
+        self.assertEqual(execution.unfilled, 200)
+        self.assertEqual(self.exchange.last_trade(), (10.1, 100))
+        self.assertEqual(self.exchange.buy_order_book(), [Order('buy',100,9.0)])
+    
+    def test_no_trade_with_own_orders(self):
+        self.exchange.current_client = 1
+        execution = self.exchange.execute_order(Order('buy',100))
+        self.assertEqual(execution.trades, [])
+        self.assertEqual(execution.unfilled, 100)
+
+class TestContinuousTrading(unittest.TestCase):
+    
+    def test_order_matched_on_submission(self):
+        # given a continuous exchange with a resting sell
+        exchange = Exchange(continuous=True)
+        exchange.current_client = 1
+        sell_order = Order('sell',300,10.0)
+        exchange.submit_order(sell_order)
+        # when another client submits a crossing buy for more
+        exchange.current_client = 2
+        buy_order = Order('buy',500,10.1)
+        exchange.submit_order(buy_order)
+        # then the trade happens straight away and only the remainder rests
+        self.assertEqual(exchange.last_trade(), (10.1, 300))
+        self.assertEqual(exchange.order_book(), [buy_order])
+        self.assertEqual(buy_order.quantity, 200)
+        # and match_orders reports the trade once
+        trades = exchange.match_orders()
+        self.assertEqual([(trade.buy_id, trade.sell_id, trade.quantity) for trade in trades],
+                         [(buy_order.order_id, sell_order.order_id, 300)])
+        self.assertEqual(exchange.match_orders(), [])
+        
+    def test_filled_order_does_not_rest(self):
+        exchange = Exchange(continuous=True)
+        exchange.current_client = 1
+        buy_order_id = exchange.submit_order(Order('buy',100,10.0))
+        exchange.current_client = 2
+        sell_order_id = exchange.submit_order(Order('sell',100,9.0))
+        self.assertNotEqual(buy_order_id, sell_order_id)
+        self.assertEqual(exchange.order_book(), [])
+    
+    def test_no_match_for_own_orders(self):
+        exchange = Exchange(continuous=True)
+        exchange.current_client = 1
+        exchange.submit_order(Order('buy',100,10.0))
+        exchange.submit_order(Order('sell',100,9.0))
+        self.assertEqual(len(exchange.order_book()), 2)
+        self.assertEqual(exchange.match_orders(), [])
+
+class TestAmend(unittest.TestCase):
+    
+    def setUp(self):
+        # a book with two buys from client 1 at 10.0 behind one from client 2
+        self.exchange = Exchange(tick_size=0.1)
+        self.exchange.current_client = 2
+        self.other_id = self.exchange.submit_order(Order('buy',100,10.0))
+        self.exchange.current_client = 1
+        self.first_id, self.second_id = self.exchange.submit_orders([Order('buy',100,10.0),
+                                                                      Order('buy',100,10.0)])
+    
+    def buy_ids(self):
+        return [order.order_id for order in self.exchange.buy_order_book()]
+    
+    def test_quantity_decrease_keeps_priority(self):
+        self.assertTrue(self.exchange.amend_order(self.first_id, 40))
+        self.assertEqual(self.buy_ids(), [self.other_id, self.first_id, self.second_id])
+        self.assertEqual(self.exchange.depth('buy'), ((10.0, 240, 3),))
+    
+    def test_quantity_increase_loses_priority(self):
+        self.assertTrue(self.exchange.amend_order(self.first_id, 150))
+        self.assertEqual(self.buy_ids(), [self.other_id, self.second_id, self.first_id])
+        self.assertEqual(self.exchange.depth('buy'), ((10.0, 350, 3),))
+    
+    def test_price_change(self):
+        self.assertTrue(self.exchange.amend_order(self.second_id, price=10.14))
+        self.assertEqual(self.buy_ids(), [self.second_id, self.other_id, self.first_id])
+        self.assertEqual(self.exchange.bid_offer(), (10.1, 10.1))
+        self.assertEqual(self.exchange.bid_offer(excluding=[self.second_id]), (10.0, 10.0))
+    
+    def test_restored_amend_is_matched(self):
+        # given a sell above the buys, matched with nothing to trade
+        self.exchange.current_client = 3
+        sell_id = self.exchange.submit_order(Order('sell',100,10.5))
+        self.assertEqual(self.exchange.match_orders(), [])
+        # when an amend that crosses is restored
+        self.exchange.restore_amend(sell_id, price=10.0)
+        # then the next match trades it
+        self.assertEqual([trade.sell_id for trade in self.exchange.match_orders()], [sell_id])
+    
+    def test_identical_amend_does_nothing(self):
+        order_book = self.exchange.instrument().order_book
+        version = order_book._sides[BUY].version
+        self.assertTrue(self.exchange.amend_order(self.first_id, 100, 10.04))
+        self.assertEqual(order_book._sides[BUY].version, version)
+        self.assertEqual(self.buy_ids(), [self.other_id, self.first_id, self.second_id])
+    
+    def test_only_own_orders(self):
+        self.assertFalse(self.exchange.amend_order(self.other_id, 50))
+        self.assertFalse(self.exchange.amend_order(self.second_id + 1, 50))
+        self.assertEqual(self.exchange.order_book()[0].quantity, 100)
+        self.assertTrue(ClientContext(self.exchange, 2).amend_order(self.other_id, 50))
+        self.assertEqual(self.exchange.order_book()[0].quantity, 50)
+        self.assertRaises(ValueError, self.exchange.amend_order, self.first_id, 0)
+    
+    def test_amend_matched(self):
+        # given a sell from another client above the buys
+        self.exchange.current_client = 3
+        self.exchange.submit_order(Order('sell',150,10.2))
+        self.exchange.match_orders()
+        # when a buy is amended up to cross it
+        self.exchange.current_client = 1
+        self.exchange.amend_order(self.second_id, price=10.2)
+        # then it trades at the next match
+        trades = self.exchange.match_orders()
+        self.assertEqual([(trade.buy_id, trade.quantity) for trade in trades],
+                         [(self.second_id, 100)])
+    
+    def test_amend_matched_in_continuous_mode(self):
+        self.exchange.continuous = True
+        self.exchange.current_client = 3
+        self.exchange.submit_order(Order('sell',150,10.2))
+        self.exchange.current_client = 1
+        self.exchange.amend_order(self.second_id, 200, 10.2)
+        self.assertEqual(self.exchange.last_trade(), (10.2, 150))
+        self.assertEqual(self.exchange.buy_order_book()[0].order_id, self.second_id)
+        self.assertEqual(self.exchange.buy_order_book()[0].quantity, 50)
+        self.assertEqual(self.exchange.sell_order_book(), [])
+
+class TestAuction(unittest.TestCase):
+    
+    def auction_exchange(self, allocation):
+        # buys of 100 at 10.2 and 200 at 10.1 cross sells of 100 at 9.9, 150 at
+        # 10.0 and 130 and 70 at 10.1
+        exchange = Exchange(tick_size=0.1, auction=allocation)
+        for client_id, order in ((1, Order('buy',100,10.2)), (2, Order('buy',200,10.1)),
+                                 (3, Order('buy',300,10.0)), (4, Order('sell',100,9.9)),
+                                 (5, Order('sell',150,10.0)), (6, Order('sell',130,10.1)),
+                                 (7, Order('sell',70,10.1)), (8, Order('sell',100,10.3))):
+            exchange.current_client = client_id
+            exchange.submit_order(order)
+        return exchange
+    
+    def traded(self, trades):
+        return [(trade.buy_id, trade.sell_id, trade.price, trade.quantity)
+                for trade in trades]
+    
+    def test_clearing_price_maximises_volume(self):
+        exchange = self.auction_exchange('time')
+        self.assertEqual(exchange.instrument().order_book.clearing_price(100.0), (10.1, 300))
+    
+    def test_time_allocation(self):
+        exchange = self.auction_exchange('time')
+        self.assertEqual(self.traded(exchange.match_orders()),
+                         [(1, 4, 10.1, 100), (2, 5, 10.1, 150), (2, 6, 10.1, 50)])
+        self.assertEqual(exchange.last_trade(), (10.1, 50))
+        self.assertEqual(exchange.depth('sell'), ((10.1, 150, 2), (10.3, 100, 1)))
+        self.assertEqual(exchange.depth('buy'), ((10.0, 300, 1),))
+    
+    def test_pro_rata_allocation(self):
+        exchange = self.auction_exchange('pro_rata')
+        # 50 shared between 130 and 70 is 32.5 and 17.5, the odd unit going to the earlier
+        self.assertEqual(self.traded(exchange.match_orders()),
+                         [(1, 4, 10.1, 100), (2, 5, 10.1, 150), (2, 6, 10.1, 33), (2, 7, 10.1, 17)])
+        self.assertEqual([(order.order_id, order.quantity) for order in exchange.sell_order_book()],
+                         [(6, 97), (7, 53), (8, 100)])
+    
+    def test_ties_go_to_price_nearest_last_trade(self):
+        order_book = OrderBook()
+        order_book.add(Order('buy',100,10.0), 1)
+        order_book.add(Order('sell',100,9.8), 2)
+        self.assertEqual(order_book.clearing_price(100.0), (10.0, 100))
+        self.assertEqual(order_book.clearing_price(9.0), (9.8, 100))
+    
+    def test_unpriced_orders(self):
+        exchange = Exchange(auction='time')
+        exchange.current_client = 1
+        exchange.submit_order(Order('buy',100))
+        exchange.current_client = 2
+        exchange.submit_order(Order('sell',60))
+        self.assertEqual(self.traded(exchange.match_orders()), [(1, 2, 100.0, 60)])
+        self.assertEqual(exchange.order_book(), [Order('buy',40)])
+    
+    def test_no_cross(self):
+        exchange = Exchange(auction='pro_rata')
+        exchange.current_client = 1
+        exchange.submit_order(Order('buy',100,9.0))
+        exchange.current_client = 2
+        exchange.submit_order(Order('sell',100,10.0))
+        self.assertEqual(exchange.match_orders(), [])
+        self.assertEqual(len(exchange.order_book()), 2)
+    
+    def test_no_trades_with_self(self):
+        exchange = Exchange(auction='time')
+        exchange.current_client = 1
+        exchange.submit_orders([Order('buy',100,10.0), Order('sell',50,10.0)])
+        exchange.current_client = 2
+        exchange.submit_order(Order('sell',50,10.0))
+        trades = exchange.match_orders()
+        self.assertEqual(self.traded(trades), [(1, 3, 10.0, 50)])
+        self.assertEqual((trades[0].buyer, trades[0].seller), (1, 2))
+    
+    def test_invalid_settings(self):
+        self.assertRaises(ValueError, Exchange, auction='random')
+        self.assertRaises(ValueError, Exchange, continuous=True, auction='time')
+        
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
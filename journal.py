@@ -0,0 +1,228 @@
+'''
+Binary event journal
+
+Exchange events (orders, cancels, mass cancels and trades) are appended to a
+file as fixed-size binary records, so writing one costs a struct pack into a
+buffer. replay() reads a journal back and rebuilds the exchange's state
+without calling any clients or running the matching engine.
+
+Client IDs must be integers or None, and quantities integers. Symbols are
+stored in up to SYMBOL_SIZE bytes of UTF-8; a longer one raises ValueError
+rather than being cut short.
+'''
+import math
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from exchange import ClientContext, Exchange, Order
+
+ORDER, CANCEL, MASS_CANCEL, TRADE, AMEND = 1, 2, 3, 4, 5
+SYMBOL_SIZE = 16
+
+# kind, has symbol, side, order ID (buy ID for trades), sell ID, client ID,
+# quantity, price, symbol
+RECORD = struct.Struct('<BBBxxxxxqqqqd%ds' % SYMBOL_SIZE)
+
+# client ID recorded for client None
+NO_CLIENT = -1
+# amends record a quantity of 0 and a NaN price for values left as they are
+
+class Journal(object):
+    """Append-only writer of exchange events
+
+    Records are buffered; call flush() to push them to the file, for example
+    at the end of each round.
+    """
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, path):
+        self._file = open(path, 'ab', self.BUFFER_SIZE)
+        self._pack = RECORD.pack
+    def _write(self, kind, symbol, side=0, order_id=0, sell_id=0, client_id=None,
+               quantity=0, price=None):
+        encoded = b''
+        if symbol is not None:
+            encoded = symbol.encode('utf-8')
+            if len(encoded) > SYMBOL_SIZE:
+                raise ValueError('symbol %r is longer than %s bytes in UTF-8' % (symbol, SYMBOL_SIZE))
+        self._file.write(self._pack(
+            kind, symbol is not None, side, order_id, sell_id,
+            NO_CLIENT if client_id is None else client_id, quantity,
+            float('nan') if price is None else price, encoded))
+    def record_order(self, order_id, client_id, order, symbol=None):
+        self._write(ORDER, symbol, order.side, order_id, 0, client_id, order.quantity, order.price)
+    def record_cancel(self, order_id, client_id, symbol=None):
+        self._write(CANCEL, symbol, 0, order_id, 0, client_id)
+    def record_amend(self, order_id, client_id, quantity, price, symbol=None):
+        self._write(AMEND, symbol, 0, order_id, 0, client_id, quantity or 0, price)
+    def record_mass_cancel(self, client_id):
+        self._write(MASS_CANCEL, None, client_id=client_id)
+    def record_trade(self, trade):
+        self._write(TRADE, trade.symbol, 0, trade.buy_id, trade.sell_id, None,
+                    trade.quantity, trade.price)
+    def flush(self):
+        self._file.flush()
+    def close(self):
+        self._file.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_records(path):
+    """Yield the journal's records as tuples of
+    (kind, side, order_id, sell_id, client_id, quantity, price, symbol)
+
+    A partly written record at the end of the file, as left by a crash, is
+    ignored.
+    """
+    with open(path, 'rb') as journal_file:
+        size = os.fstat(journal_file.fileno()).st_size
+        size -= size % RECORD.size
+        if not size:
+            return
+        data = mmap.mmap(journal_file.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            # unpack_from holds no export of the map between records, unlike
+            # iter_unpack, so it can be closed when the caller stops early
+            unpack_from = RECORD.unpack_from
+            for offset in range(0, size, RECORD.size):
+                (kind, has_symbol, side, order_id, sell_id, client_id, quantity,
+                 price, symbol) = unpack_from(data, offset)
+                yield (kind, side, order_id, sell_id,
+                       None if client_id == NO_CLIENT else client_id, quantity,
+                       None if math.isnan(price) else price,
+                       symbol.rstrip(b'\0').decode('utf-8') if has_symbol else None)
+        finally:
+            data.close()
+
+def replay(path, exchange=None):
+    """Rebuild an exchange from a journal and return it
+
+    Events are applied directly to the books: orders are restored and
+    amended, trades applied as fills and cancels carried out, with no matching and no client
+    callbacks. The exchange given, if any, should be new, configured like the
+    one that wrote the journal and have no journal of its own.
+    """
+    if exchange is None:
+        exchange = Exchange()
+    for (kind, side, order_id, sell_id, client_id, quantity, price,
+         symbol) in read_records(path):
+        if kind == ORDER:
+            exchange.restore_order(Order(side, quantity, price), client_id, order_id, symbol)
+        elif kind == TRADE:
+            exchange.restore_fill(order_id, sell_id, price, quantity, symbol)
+        elif kind == AMEND:
+            exchange.restore_amend(order_id, quantity or None, price, symbol)
+        elif kind == CANCEL:
+            ClientContext(exchange, client_id).cancel_order(order_id, symbol)
+        elif kind == MASS_CANCEL:
+            ClientContext(exchange, client_id).delete_my_orders()
+    return exchange
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'exchange.journal')
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def state(self, exchange):
+        return dict((symbol, ([(order.order_id, exchange.instrument(symbol).order_book.owner(order.order_id),
+                                order.buy_sell, order.quantity, order.price)
+                               for order in exchange.order_book(symbol)],
+                              exchange.last_trade(symbol)))
+                    for symbol in exchange.symbols())
+
+    def run_session(self, exchange):
+        exchange.current_client = 1
+        exchange.submit_order(Order('buy',100,10.0))
+        exchange.submit_orders([Order('buy',200,10.1), Order('sell',50,10.4)], 'AAA')
+        cancelled_id = exchange.submit_order(Order('sell',100,10.5))
+        amended_id = exchange.submit_order(Order('sell',100,10.6))
+        exchange.amend_order(amended_id, 80)
+        exchange.amend_order(amended_id, price=10.3)
+        exchange.current_client = 2
+        exchange.submit_order(Order('sell',150,9.9))
+        exchange.submit_order(Order('sell',300,10.0), 'AAA')
+        exchange.execute_order(Order('buy',80))
+        exchange.match_orders()
+        exchange.current_client = 1
+        exchange.cancel_order(cancelled_id)
+        exchange.current_client = 3
+        exchange.submit_order(Order('buy',10,10.2), 'BBB')
+        exchange.delete_my_orders()
+        exchange.current_client = 4
+        exchange.submit_order(Order('buy',40,10.3))
+
+    def test_replay_rebuilds_state(self):
+        with Journal(self.path) as journal:
+            exchange = Exchange(journal=journal)
+            self.run_session(exchange)
+        replayed = replay(self.path)
+        self.assertEqual(self.state(replayed), self.state(exchange))
+        exchange.journal = None
+        self.assertEqual(replayed.submit_order(Order('buy',1,1.0)),
+                         exchange.submit_order(Order('buy',1,1.0)))
+
+    def test_replay_continuous_trading(self):
+        with Journal(self.path) as journal:
+            exchange = Exchange(continuous=True, tick_size=0.1, journal=journal)
+            self.run_session(exchange)
+        replayed = replay(self.path, Exchange(continuous=True, tick_size=0.1))
+        self.assertEqual(self.state(replayed), self.state(exchange))
+
+    def test_replay_before_match(self):
+        # given crossing orders journalled before the round was matched
+        with Journal(self.path) as journal:
+            exchange = Exchange(journal=journal)
+            exchange.current_client = 1
+            exchange.submit_order(Order('buy',100,10.0))
+            exchange.current_client = 2
+            exchange.submit_order(Order('sell',100,10.0))
+        # then the replayed exchange matches them as the original would
+        replayed = replay(self.path)
+        exchange.journal = None
+        self.assertEqual([(trade.buyer, trade.seller, trade.price, trade.quantity)
+                          for trade in replayed.match_orders()],
+                         [(trade.buyer, trade.seller, trade.price, trade.quantity)
+                          for trade in exchange.match_orders()])
+        self.assertEqual(replayed.order_book(), [])
+
+    def test_partial_record_ignored(self):
+        with Journal(self.path) as journal:
+            exchange = Exchange(journal=journal)
+            exchange.submit_order(Order('buy',100,10.0))
+        with open(self.path, 'ab') as journal_file:
+            journal_file.write(b'\x01\x00\x00')
+        self.assertEqual(len(list(read_records(self.path))), 1)
+        self.assertEqual(replay(self.path).order_book(), [Order('buy',100,10.0)])
+
+    def test_long_symbol(self):
+        with Journal(self.path) as journal:
+            order = Order('buy',100,10.0)
+            journal.record_order(1, 1, order, u'\xc5' * (SYMBOL_SIZE // 2))
+            self.assertRaises(ValueError, journal.record_order, 2, 1, order,
+                              u'\xc5' * (SYMBOL_SIZE // 2 + 1))
+        self.assertEqual([record[-1] for record in read_records(self.path)],
+                         [u'\xc5' * (SYMBOL_SIZE // 2)])
+
+    def test_stop_reading_early(self):
+        with Journal(self.path) as journal:
+            exchange = Exchange(journal=journal)
+            exchange.submit_orders([Order('buy',100,10.0), Order('buy',100,10.0)])
+        records = read_records(self.path)
+        self.assertEqual(next(records)[0], ORDER)
+        records.close()
+
+    def test_empty_journal(self):
+        Journal(self.path).close()
+        self.assertEqual(replay(self.path).order_book(), [])
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
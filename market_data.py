@@ -0,0 +1,195 @@
+'''
+Market data feed
+
+A MarketDataFeed given to an Exchange publishes what changes as orders are
+submitted, cancelled and matched, rather than clients polling copies of the
+whole book:
+
+- TradePrint for each trade
+- DepthUpdate with the new total quantity and order count at each price level
+  that changed; a quantity of 0 means the level is empty
+- TopOfBook whenever the best bid or offer, or the quantity at either, changes
+
+A subscriber is first sent the depth and top of book as they stand, and from
+then on only the changes, so it can keep its own view of the book. BookView
+is such a view. Depth covers orders with a price; unpriced orders are left out.
+'''
+from collections import namedtuple
+import unittest
+from exchange import Exchange, Order
+
+TradePrint = namedtuple('TradePrint', 'symbol,price,quantity')
+DepthUpdate = namedtuple('DepthUpdate', 'symbol,buy_sell,price,quantity,order_count')
+# Prices are None, and quantities 0, for a side with no priced orders
+TopOfBook = namedtuple('TopOfBook', 'symbol,bid,bid_quantity,offer,offer_quantity')
+
+class MarketDataFeed(object):
+    """Publishes trades and depth changes to subscribers"""
+    def __init__(self):
+        self._subscribers = []
+        # symbol: ({buy price: (quantity, order_count)}, {sell price: ...})
+        self._depth = {}
+        self._tops = {}
+    def subscribe(self, callback, symbols=None):
+        """Call callback with every event for the symbols given, or for all
+        symbols if symbols is None
+
+        The callback is first called with the current depth and top of book.
+        """
+        symbols = None if symbols is None else set(symbols)
+        self._subscribers.append((callback, symbols))
+        for symbol, (buys, sells) in self._depth.items():
+            if symbols is None or symbol in symbols:
+                for buy_sell, levels, descending in (('buy', buys, True), ('sell', sells, False)):
+                    for price in sorted(levels, reverse=descending):
+                        quantity, order_count = levels[price]
+                        callback(DepthUpdate(symbol, buy_sell, price, quantity, order_count))
+                callback(self._tops[symbol])
+    def unsubscribe(self, callback):
+        self._subscribers = [(subscriber, symbols) for (subscriber, symbols) in self._subscribers
+                             if subscriber != callback]
+    def _send(self, event):
+        for callback, symbols in self._subscribers:
+            if symbols is None or event.symbol in symbols:
+                callback(event)
+    def publish_trades(self, trades):
+        for trade in trades:
+            self._send(TradePrint(trade.symbol, trade.price, trade.quantity))
+    def publish_book(self, order_book):
+        """Publish the levels of a book that have changed since it was last
+        published, and its top of book if that has changed
+        """
+        symbol = order_book.symbol
+        depth = self._depth.get(symbol)
+        if depth is None:
+            depth = self._depth[symbol] = ({}, {})
+        buys, sells = depth
+        for buy_sell, price, quantity, order_count in order_book.changed_levels():
+            levels = buys if buy_sell == 'buy' else sells
+            if quantity or order_count:
+                levels[price] = (quantity, order_count)
+            elif levels.pop(price, None) is None:
+                continue
+            self._send(DepthUpdate(symbol, buy_sell, price, quantity, order_count))
+        bid = order_book.highest_buy_order()
+        offer = order_book.lowest_sell_order()
+        top = TopOfBook(symbol, bid, buys[bid][0] if bid is not None else 0,
+                        offer, sells[offer][0] if offer is not None else 0)
+        if top != self._tops.get(symbol):
+            self._tops[symbol] = top
+            self._send(top)
+
+class BookView(object):
+    """One symbol's depth, top of book and last trade, kept up to date from a feed"""
+    def __init__(self, feed, symbol=None):
+        self.symbol = symbol
+        self.top = TopOfBook(symbol, None, 0, None, 0)
+        self.last_trade = None
+        self._levels = {'buy': {}, 'sell': {}}
+        feed.subscribe(self.on_event, [symbol])
+    def on_event(self, event):
+        if isinstance(event, DepthUpdate):
+            levels = self._levels[event.buy_sell]
+            if event.quantity or event.order_count:
+                levels[event.price] = (event.quantity, event.order_count)
+            else:
+                levels.pop(event.price, None)
+        elif isinstance(event, TopOfBook):
+            self.top = event
+        elif isinstance(event, TradePrint):
+            self.last_trade = event
+    def depth(self, buy_sell, max_levels=None):
+        """Return (price, quantity, order_count) for the levels on one side,
+        best price first
+        """
+        levels = self._levels[buy_sell]
+        prices = sorted(levels, reverse=buy_sell == 'buy')[:max_levels]
+        return [(price,) + levels[price] for price in prices]
+
+class TestMarketData(unittest.TestCase):
+
+    def setUp(self):
+        self.feed = MarketDataFeed()
+        self.exchange = Exchange(market_data=self.feed)
+        self.events = []
+        self.feed.subscribe(self.events.append)
+
+    def test_depth_updates(self):
+        # given orders at two buy levels and one sell level
+        self.exchange.current_client = 1
+        self.exchange.submit_orders([Order('buy',100,10.0), Order('buy',200,10.0),
+                                     Order('buy',50,9.9), Order('sell',100,10.5)])
+        # then each level is published once with its totals, then the top of book
+        self.assertEqual(self.events, [DepthUpdate(None, 'buy', 10.0, 300, 2),
+                                       DepthUpdate(None, 'buy', 9.9, 50, 1),
+                                       DepthUpdate(None, 'sell', 10.5, 100, 1),
+                                       TopOfBook(None, 10.0, 300, 10.5, 100)])
+        # and cancelling below the top publishes only that level
+        del self.events[:]
+        self.exchange.delete_my_orders()
+        self.exchange.current_client = 2
+        order_id = self.exchange.submit_order(Order('buy',100,10.0))
+        self.exchange.submit_order(Order('buy',10,9.0))
+        del self.events[:]
+        self.exchange.cancel_order(order_id + 1)
+        self.assertEqual(self.events, [DepthUpdate(None, 'buy', 9.0, 0, 0)])
+
+    def test_trades_and_partial_fills(self):
+        # given a resting sell and a crossing buy for part of it
+        self.exchange.current_client = 1
+        self.exchange.submit_order(Order('sell',100,10.0))
+        self.exchange.current_client = 2
+        self.exchange.submit_order(Order('buy',40,10.0))
+        del self.events[:]
+        # when they are matched
+        self.exchange.match_orders()
+        # then the trade is printed and the levels and top of book updated
+        self.assertEqual(self.events, [TradePrint(None, 10.0, 40),
+                                       DepthUpdate(None, 'buy', 10.0, 0, 0),
+                                       DepthUpdate(None, 'sell', 10.0, 60, 1),
+                                       TopOfBook(None, None, 0, 10.0, 60)])
+
+    def test_symbols(self):
+        aaa_events = []
+        self.feed.subscribe(aaa_events.append, ['AAA'])
+        self.exchange.submit_order(Order('buy',100,10.0), 'AAA')
+        self.exchange.submit_order(Order('buy',100,10.0), 'BBB')
+        self.assertEqual(aaa_events, [DepthUpdate('AAA', 'buy', 10.0, 100, 1),
+                                      TopOfBook('AAA', 10.0, 100, None, 0)])
+        self.assertEqual(len(self.events), 4)
+
+    def test_book_view_matches_book(self):
+        # given a view subscribed part way through trading
+        self.exchange.current_client = 1
+        self.exchange.submit_orders([Order('buy',100,10.0), Order('sell',100,10.4),
+                                     Order('sell',100,10.3), Order('buy',100)])
+        view = BookView(self.feed)
+        # when orders are traded in continuous mode and cancelled
+        self.exchange.continuous = True
+        self.exchange.current_client = 2
+        self.exchange.submit_orders([Order('sell',150,9.9), Order('buy',150,10.4),
+                                     Order('buy',20,9.8)])
+        self.exchange.current_client = 1
+        self.exchange.execute_order(Order('sell',10,9.8))
+        # then the view agrees with the book
+        def levels(orders):
+            depth = []
+            for order in orders:
+                if order.price is None:
+                    continue
+                if depth and depth[-1][0] == order.price:
+                    price, quantity, order_count = depth.pop()
+                    depth.append((price, quantity + order.quantity, order_count + 1))
+                else:
+                    depth.append((order.price, order.quantity, 1))
+            return depth
+        self.assertEqual(view.depth('buy'), levels(self.exchange.buy_order_book()))
+        self.assertEqual(view.depth('sell'), levels(self.exchange.sell_order_book()))
+        bid, offer = self.exchange.bid_offer()
+        self.assertEqual((view.top.bid, view.top.offer), (bid, offer))
+        self.assertEqual((view.last_trade.price, view.last_trade.quantity),
+                         self.exchange.last_trade())
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -6,6 +6,7 @@ offered prices should be last traded price +- spread%/2
 '''
 import unittest
 from exchange import Exchange, Order
+from risk import RiskLimits, RiskManager
 
 #         buy_orders, sell_orders = exchange.find_orders('my counterparty id')
 
@@ -14,13 +15,32 @@ class MarketMaker(object):
     MARGIN = 0.02
     ORDER_QUANTITY = 100
 
+    def __init__(self, margin=None):
+        """margin, if given, replaces MARGIN for this market maker"""
+        if margin is not None:
+            self.MARGIN = margin
+        # IDs of the current buy and sell quotes
+        self.quote_ids = {'buy': None, 'sell': None}
+
     def __call__(self, exchange):
-        exchange.delete_my_orders()
-        current_bid, current_offer = exchange.bid_offer()
-        bid_price = current_bid * (1 - self.MARGIN/2)
-        offer_price = current_offer * (1 + self.MARGIN/2)
-        exchange.submit_order(Order('buy',self.ORDER_QUANTITY,bid_price))
-        exchange.submit_order(Order('sell',self.ORDER_QUANTITY,offer_price))
+        own_ids = [order_id for order_id in self.quote_ids.values() if order_id is not None]
+        current_bid, current_offer = exchange.bid_offer(excluding=own_ids)
+        self.quote(exchange, 'buy', current_bid * (1 - self.MARGIN/2))
+        self.quote(exchange, 'sell', current_offer * (1 + self.MARGIN/2))
+
+    def quote(self, exchange, buy_sell, price):
+        """Amend the quote on one side to price, or submit a new one if it has
+        been filled
+        
+        A quote whose amend is rejected by the risk checks stays as it was.
+        """
+        order_id = self.quote_ids[buy_sell]
+        if order_id is not None:
+            amended = exchange.amend_order(order_id, self.ORDER_QUANTITY, price)
+            # None is an amend rejected by the risk checks; False a quote filled
+            if amended or amended is None:
+                return
+        self.quote_ids[buy_sell] = exchange.submit_order(Order(buy_sell,self.ORDER_QUANTITY,price))
 
 class TestMarketMaker(unittest.TestCase):
 
@@ -63,6 +83,21 @@ class TestMarketMaker(unittest.TestCase):
         self.assertEqual(exchange.buy_order_book()[0].quantity, MarketMaker.ORDER_QUANTITY)
         self.assertEqual(exchange.sell_order_book()[0].quantity, MarketMaker.ORDER_QUANTITY)
         
+    def test_margin_per_instance(self):
+        exchange = Exchange()
+        exchange.add_client(MarketMaker(margin=0.1))
+        exchange.do_trading()
+        self.assertEqual(exchange.buy_order_book()[0].price, exchange.OPEN_DEFAULT_PRICE * 0.95)
+        self.assertEqual(exchange.sell_order_book()[0].price, exchange.OPEN_DEFAULT_PRICE * 1.05)
+        self.assertEqual(MarketMaker().MARGIN, MarketMaker.MARGIN)
+        
+    def test_quotes_snapped_to_tick_size(self):
+        exchange = Exchange(tick_size=2.0)
+        exchange.add_client(MarketMaker())
+        exchange.do_trading()
+        self.assertEqual(exchange.buy_order_book()[0].price, 98.0)
+        self.assertEqual(exchange.sell_order_book()[0].price, 102.0)
+        
     # check that marker maker prices are based on order book prices
     def test_market_maker_price(self):
         # scenario: check that marker maker prices are based on order book prices
@@ -83,6 +118,52 @@ class TestMarketMaker(unittest.TestCase):
         self.assertEqual(exchange.sell_order_book(),
                          [Order('sell',100,10.0 * (1 + MarketMaker.MARGIN/2))])
 
+    def test_quotes_amended_in_place(self):
+        # given a market maker quoting around another client's orders
+        exchange = Exchange()
+        exchange.current_client = 99
+        exchange.submit_orders([Order('buy',100,10.0), Order('sell',100,10.4)])
+        exchange.add_client(MarketMaker())
+        exchange.do_trading()
+        quotes = [(order.order_id, order.price) for order in exchange.order_book()]
+        # when it is called again with the same prices around it
+        exchange.do_trading()
+        # then its quotes are left as they were
+        self.assertEqual([(order.order_id, order.price) for order in exchange.order_book()], quotes)
+        # and when another order improves the bid it amends its bid to follow
+        exchange.current_client = 99
+        exchange.submit_order(Order('buy',100,10.1))
+        exchange.do_trading()
+        self.assertEqual(exchange.buy_order_book()[2].order_id, quotes[1][0])
+        self.assertEqual(exchange.buy_order_book()[2].price, 10.1 * (1 - MarketMaker.MARGIN/2))
+
+    def test_quotes_kept_when_amend_rejected(self):
+        # given a market maker allowed two messages a second, used by its quotes
+        now = [0.0]
+        risk = RiskManager(clock=lambda: now[0])
+        exchange = Exchange(risk=risk)
+        market_maker = MarketMaker()
+        exchange.add_client(market_maker)
+        risk.set_limits(0, RiskLimits(max_messages=2))
+        exchange.do_trading()
+        quote_ids = dict(market_maker.quote_ids)
+        # when another order improves the bid and the amend to follow it is rejected
+        exchange.current_client = 99
+        exchange.submit_order(Order('buy',100,100.5))
+        exchange.do_trading()
+        # then the market maker keeps its quotes and submits no others
+        order_book = exchange.instrument().order_book
+        def own_quotes():
+            return sorted(order.order_id for order in order_book.orders()
+                          if order_book.owner(order.order_id) == 0)
+        self.assertEqual(market_maker.quote_ids, quote_ids)
+        self.assertEqual(own_quotes(), sorted(quote_ids.values()))
+        # and once the limit allows, it amends its bid in place
+        now[0] = 1.0
+        exchange.do_trading()
+        self.assertEqual(own_quotes(), sorted(quote_ids.values()))
+        self.assertEqual(order_book.order(quote_ids['buy']).price, 100.5 * (1 - MarketMaker.MARGIN/2))
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
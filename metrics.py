@@ -0,0 +1,198 @@
+'''
+Exchange metrics
+
+An Exchange given a metrics sink reports to it:
+
+- latencies, in seconds, of 'submit', 'submit_orders', 'execute', 'cancel',
+  'amend', 'delete_orders' and 'match' calls, of each do_trading 'round' and
+  of each client's turn in a round, named ('client', client_id)
+- the number of orders in each book after matching, named ('depth', symbol)
+- counters of 'orders' submitted, 'cancelled' orders, 'trades' and traded
+  'volume', and of orders and amends 'rejected' by risk checks
+
+A sink is any object with increment(name, count), record_latency(name,
+seconds) and record_value(name, value) methods. Metrics is one that keeps
+counters and histograms in memory. With no sink, the exchange does no timing.
+'''
+from collections import defaultdict
+import unittest
+from exchange import Exchange, Order
+
+class Histogram(object):
+    """A histogram of non-negative integers with fixed relative precision, in
+    the style of an HDR histogram
+
+    Values below 2 ** (sub_bucket_bits + 1) are counted exactly. Above that,
+    each power of two is split into 2 ** sub_bucket_bits buckets, so a value is
+    known to within about 1 part in 2 ** sub_bucket_bits whatever its size,
+    and the memory used grows only with the log of the range of values.
+    """
+    def __init__(self, sub_bucket_bits=7):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+    def _bucket(self, value):
+        """Return (shift, value >> shift) for the bucket holding value"""
+        shift = max(0, value.bit_length() - self.sub_bucket_bits - 1)
+        return shift, value >> shift
+    def record(self, value, count=1):
+        value = max(int(value), 0)
+        self.counts[self._bucket(value)] += count
+        self.count += count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+    def merge(self, other):
+        """Add the values recorded in another histogram to this one"""
+        for bucket, count in other.counts.items():
+            self.counts[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+    def mean(self):
+        return float(self.total) / self.count if self.count else None
+    def percentile(self, percent):
+        """Return the highest value that could be in the bucket holding the
+        given percentile, or None if nothing has been recorded
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(-(-percent * self.count // 100)))
+        seen = 0
+        # in order of the lowest value in each bucket
+        for shift, index in sorted(self.counts, key=lambda bucket: bucket[1] << bucket[0]):
+            seen += self.counts[(shift, index)]
+            if seen >= rank:
+                return min(((index + 1) << shift) - 1, self.max)
+        return self.max
+
+class Metrics(object):
+    """A metrics sink keeping counters and histograms in memory
+
+    Latencies are kept in nanoseconds.
+    """
+    def __init__(self, sub_bucket_bits=7):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counters = defaultdict(int)
+        self.latencies = {}
+        self.values = {}
+    def _histogram(self, histograms, name):
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram(self.sub_bucket_bits)
+        return histogram
+    def increment(self, name, count=1):
+        self.counters[name] += count
+    def record_latency(self, name, seconds):
+        self._histogram(self.latencies, name).record(seconds * 1e9)
+    def record_value(self, name, value):
+        self._histogram(self.values, name).record(value)
+    def reset(self):
+        self.counters.clear()
+        self.latencies.clear()
+        self.values.clear()
+    def report(self):
+        """Return a table of the counters, then the latencies in microseconds
+        with the largest total time first, then the values
+        """
+        lines = ['%-30s %12s' % ('counter', 'count')]
+        lines.extend('%-30s %12d' % (_name(name), count)
+                     for name, count in sorted(self.counters.items(), key=lambda item: _name(item[0])))
+        for title, histograms, scale in (('latency us', self.latencies, 1e3),
+                                         ('value', self.values, 1)):
+            lines.append('%-30s %12s %12s %12s %12s %12s %12s' % (
+                title, 'count', 'total', 'mean', 'p50', 'p99', 'max'))
+            for name, histogram in sorted(histograms.items(), key=lambda item: -item[1].total):
+                lines.append('%-30s %12d %12.1f %12.1f %12.1f %12.1f %12.1f' % (
+                    _name(name), histogram.count, histogram.total / scale,
+                    histogram.mean() / scale, histogram.percentile(50) / scale,
+                    histogram.percentile(99) / scale, histogram.max / scale))
+        return '\n'.join(lines)
+
+def _name(name):
+    return ' '.join(str(part) for part in name) if isinstance(name, tuple) else str(name)
+
+class TestHistogram(unittest.TestCase):
+
+    def test_small_values_exact(self):
+        histogram = Histogram(sub_bucket_bits=3)
+        for value in range(1, 11):
+            histogram.record(value)
+        self.assertEqual(histogram.percentile(50), 5)
+        self.assertEqual(histogram.percentile(100), 10)
+        self.assertEqual((histogram.count, histogram.min, histogram.max, histogram.mean()),
+                         (10, 1, 10, 5.5))
+
+    def test_relative_precision(self):
+        histogram = Histogram(sub_bucket_bits=7)
+        for value in range(1000, 1000000, 997):
+            histogram.record(value)
+        values = list(range(1000, 1000000, 997))
+        for percent in (1, 50, 90, 99):
+            exact = values[-(-percent * len(values) // 100) - 1]
+            self.assertTrue(exact <= histogram.percentile(percent) <= exact * (1 + 1.0 / 128),
+                            (percent, exact, histogram.percentile(percent)))
+        self.assertTrue(len(histogram.counts) < 1500)
+
+    def test_merge(self):
+        first, second = Histogram(), Histogram()
+        first.record(10)
+        second.record(1000, 3)
+        first.merge(second)
+        self.assertEqual((first.count, first.min, first.max, first.total), (4, 10, 1000, 3010))
+        self.assertEqual(first.percentile(25), 10)
+        self.assertEqual(Histogram().percentile(50), None)
+
+class TestExchangeMetrics(unittest.TestCase):
+
+    def test_exchange_reports_metrics(self):
+        metrics = Metrics()
+        exchange = Exchange(metrics=metrics)
+        def buyer(exchange):
+            exchange.submit_order(Order('buy',100,10.0))
+        def seller(exchange):
+            order_id = exchange.submit_order(Order('sell',100,11.0))
+            exchange.cancel_order(order_id)
+            exchange.submit_orders([Order('sell',60,10.0), Order('sell',60,10.0)])
+        exchange.add_client(buyer)
+        exchange.add_client(seller)
+        exchange.do_trading()
+        exchange.match_orders()
+        self.assertEqual(dict(metrics.counters),
+                         {'orders': 4, 'cancelled': 1, 'trades': 2, 'volume': 100})
+        self.assertEqual(dict((name, histogram.count) for name, histogram in metrics.latencies.items()),
+                         {'submit': 2, 'cancel': 1, 'submit_orders': 1, 'match': 1, 'round': 1,
+                          ('client', 0): 1, ('client', 1): 1})
+        self.assertEqual(metrics.values[('depth', None)].max, 1)
+        self.assertTrue(metrics.latencies['round'].total >= metrics.latencies[('client', 1)].total)
+        self.assertTrue(metrics.report().startswith('counter'))
+
+    def test_custom_sink(self):
+        class RecordingSink(object):
+            def __init__(self):
+                self.calls = []
+            def increment(self, name, count=1):
+                self.calls.append(name)
+            def record_latency(self, name, seconds):
+                self.calls.append(name)
+            def record_value(self, name, value):
+                self.calls.append(name)
+        sink = RecordingSink()
+        exchange = Exchange(continuous=True, metrics=sink)
+        exchange.current_client = 1
+        exchange.submit_order(Order('sell',100,10.0))
+        exchange.current_client = 2
+        exchange.execute_order(Order('buy',100))
+        exchange.delete_my_orders()
+        self.assertEqual(sink.calls, ['submit', 'orders', 'trades', 'volume', 'execute', 'orders',
+                                      'delete_orders'])
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
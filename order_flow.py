@@ -0,0 +1,159 @@
+'''
+Synthetic order flow
+
+FlowGenerator makes seeded batches of orders as columns of sides, quantities
+and limit prices, ready for Exchange.submit_order_arrays:
+
+- the number of orders in an interval is Poisson, at arrival_rate orders per
+  unit of time
+- each order is a buy with probability buy_probability
+- limit prices are offset from the mid price by a normally distributed
+  fraction of it, away from the mid for positive offsets, so buys are priced
+  below the mid and sells above it on average when offset_mean > 0
+- sizes are lognormal around size_median, rounded to whole lots
+
+The batches are drawn with NumPy when it is installed, and otherwise with the
+random module, which gives the same distributions more slowly.
+'''
+import math
+import random
+import unittest
+from exchange import BUY, SELL, Exchange
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class FlowGenerator(object):
+    """Seeded generator of batches of order columns"""
+    def __init__(self, seed=None, arrival_rate=100.0, buy_probability=0.5, offset_mean=0.001,
+                 offset_sd=0.002, size_median=100, size_sigma=0.5, lot_size=1, use_numpy=None):
+        """use_numpy defaults to whether NumPy is installed"""
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        if use_numpy and numpy is None:
+            raise ImportError('NumPy is not installed')
+        self.arrival_rate = arrival_rate
+        self.buy_probability = buy_probability
+        self.offset_mean = offset_mean
+        self.offset_sd = offset_sd
+        self.size_median = size_median
+        self.size_sigma = size_sigma
+        self.lot_size = lot_size
+        if use_numpy:
+            self._rng = numpy.random.default_rng(seed)
+            self._batch = self._numpy_batch
+        else:
+            self._rng = random.Random(seed)
+            self._batch = self._python_batch
+    def batch(self, mid_price, interval=1.0):
+        """Return lists of side codes, quantities and prices for the orders
+        arriving in an interval
+        """
+        return self._batch(mid_price, interval)
+    def _numpy_batch(self, mid_price, interval):
+        rng = self._rng
+        count = rng.poisson(self.arrival_rate * interval)
+        sides = (rng.random(count) >= self.buy_probability).astype(numpy.int8)
+        offsets = rng.normal(self.offset_mean, self.offset_sd, count)
+        prices = mid_price * (1 + numpy.where(sides == SELL, offsets, -offsets))
+        lots = numpy.rint(rng.lognormal(math.log(self.size_median), self.size_sigma, count) /
+                          self.lot_size)
+        quantities = numpy.maximum(lots.astype(numpy.int64), 1) * self.lot_size
+        return sides.tolist(), quantities.tolist(), prices.tolist()
+    def _python_batch(self, mid_price, interval):
+        rng = self._rng
+        count = 0
+        if self.arrival_rate > 0:
+            arrival = rng.expovariate(self.arrival_rate)
+            while arrival <= interval:
+                count += 1
+                arrival += rng.expovariate(self.arrival_rate)
+        sides = [BUY if rng.random() < self.buy_probability else SELL for _ in range(count)]
+        prices = []
+        for side in sides:
+            offset = rng.gauss(self.offset_mean, self.offset_sd)
+            prices.append(mid_price * (1 + (offset if side == SELL else -offset)))
+        mu = math.log(self.size_median)
+        quantities = [max(int(round(rng.lognormvariate(mu, self.size_sigma) / self.lot_size)), 1) *
+                      self.lot_size for _ in range(count)]
+        return sides, quantities, prices
+
+class FlowClient(object):
+    """An exchange client that submits one batch from a FlowGenerator each time
+    it is called, around the mid of the current bid and offer
+
+    If replace is true, the client's orders left from the last batch are
+    deleted first, so the book does not keep growing over a long run.
+    """
+    def __init__(self, generator, symbol=None, interval=1.0, replace=False):
+        self.generator = generator
+        self.symbol = symbol
+        self.interval = interval
+        self.replace = replace
+    def __call__(self, exchange):
+        if self.replace:
+            exchange.delete_my_orders()
+        bid, offer = exchange.bid_offer(self.symbol)
+        sides, quantities, prices = self.generator.batch((bid + offer) / 2.0, self.interval)
+        exchange.submit_order_arrays(sides, quantities, prices, self.symbol)
+
+class TestFlowGenerator(unittest.TestCase):
+    use_numpy = False
+
+    def generator(self, seed=1, **kwargs):
+        return FlowGenerator(seed, use_numpy=self.use_numpy, **kwargs)
+
+    def test_seeded(self):
+        first, second = self.generator(), self.generator()
+        self.assertEqual([first.batch(100.0) for _ in range(3)], [second.batch(100.0) for _ in range(3)])
+        self.assertNotEqual(self.generator(seed=2).batch(100.0), self.generator().batch(100.0))
+
+    def test_distributions(self):
+        generator = self.generator(arrival_rate=2000.0, buy_probability=0.25, offset_mean=0.01,
+                                   offset_sd=0.001, size_median=300, lot_size=100)
+        sides, quantities, prices = generator.batch(50.0, interval=5.0)
+        count = len(sides)
+        # Poisson count with mean 10000 and standard deviation 100
+        self.assertTrue(9500 < count < 10500, count)
+        self.assertTrue(0.22 < sides.count(BUY) / float(count) < 0.28)
+        self.assertTrue(all(quantity % 100 == 0 and quantity >= 100 for quantity in quantities))
+        self.assertEqual(sorted(quantities)[count // 2], 300)
+        buy_prices = [price for side, price in zip(sides, prices) if side == BUY]
+        sell_prices = [price for side, price in zip(sides, prices) if side == SELL]
+        self.assertAlmostEqual(sum(buy_prices) / len(buy_prices), 49.5, places=2)
+        self.assertAlmostEqual(sum(sell_prices) / len(sell_prices), 50.5, places=2)
+
+    def test_no_arrivals(self):
+        self.assertEqual(self.generator(arrival_rate=0.0).batch(100.0), ([], [], []))
+
+    def test_client_submits_batches(self):
+        exchange = Exchange(tick_size=0.01)
+        client = FlowClient(self.generator(offset_mean=0.0), 'AAA')
+        exchange.add_client(client)
+        exchange.do_trading()
+        exchange.match_orders()
+        orders = exchange.order_book('AAA')
+        self.assertTrue(orders)
+        self.assertTrue(all(isinstance(order.quantity, int) and isinstance(order.price, float)
+                            for order in orders))
+
+    def test_client_replaces_batches(self):
+        exchange = Exchange(tick_size=0.01)
+        client = FlowClient(self.generator(arrival_rate=5.0, offset_mean=0.05, offset_sd=0.001),
+                            replace=True)
+        exchange.add_client(client)
+        exchange.do_trading()
+        first = exchange.order_book()
+        exchange.do_trading()
+        self.assertTrue(first)
+        self.assertFalse(set(order.order_id for order in first) &
+                         set(order.order_id for order in exchange.order_book()))
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class TestNumpyFlowGenerator(TestFlowGenerator):
+    use_numpy = True
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,318 @@
+'''
+Pre-trade risk checks
+
+An Exchange given a RiskManager asks it to check each order and amend a
+client makes before acting on it. An order that would break one of the
+client's limits is rejected: submit_order returns None in place of an order
+ID, submit_orders has None in place of the ID of each order rejected, and
+amend_order returns None. Cancels are never rejected.
+
+The limits, in RiskLimits, are on:
+
+- position: the client's position in a symbol if all its open orders on the
+  same side, and the new order, were filled
+- open orders: the number of the client's orders resting in books
+- open notional: the total value of those orders, with orders without a price
+  valued at the last trade price when they were submitted
+- message rate: the orders and amends sent within message_interval seconds
+
+The RiskManager keeps each client's position, open orders and messages
+itself, updated as orders are submitted, filled, amended and cancelled, so
+each check takes constant time whatever the size of the books. Only orders
+and trades made through the exchange's own methods are seen; orders put in
+a book by restore_order are not.
+'''
+from collections import defaultdict, deque
+import time
+import unittest
+from exchange import BUY, Exchange, Order
+
+_clock = getattr(time, 'monotonic', time.time)
+
+# Reasons for rejecting an order or amend
+POSITION, OPEN_ORDERS, OPEN_NOTIONAL, MESSAGE_RATE = ('position', 'open orders',
+                                                      'open notional', 'message rate')
+
+class RiskLimits(object):
+    """Limits for a client; a limit of None is no limit"""
+    def __init__(self, max_position=None, max_open_orders=None, max_open_notional=None,
+                 max_messages=None, message_interval=1.0):
+        self.max_position = max_position
+        self.max_open_orders = max_open_orders
+        self.max_open_notional = max_open_notional
+        self.max_messages = max_messages
+        self.message_interval = message_interval
+
+class _ClientRisk(object):
+    """One client's positions and open orders"""
+    def __init__(self, limits):
+        self.limits = limits
+        self.positions = defaultdict(int)
+        # quantities of open buy and sell orders by symbol
+        self.open_quantities = (defaultdict(int), defaultdict(int))
+        self.open_notional = 0.0
+        self.order_ids = set()
+        # times of the last max_messages messages
+        self.messages = deque(maxlen=limits.max_messages) if limits.max_messages else None
+
+class RiskManager(object):
+    """Checks orders against each client's limits and keeps the state the
+    checks need
+    """
+    def __init__(self, limits=None, clock=_clock):
+        """limits are the RiskLimits for clients without limits of their own"""
+        self.limits = limits if limits is not None else RiskLimits()
+        self.clock = clock
+        self._clients = {}
+        # order ID: [client ID, symbol, side code, open quantity, value price]
+        self._orders = {}
+        # reason: number of rejections
+        self.rejections = defaultdict(int)
+    def set_limits(self, client_id, limits):
+        """Give a client limits of its own"""
+        state = self._client(client_id)
+        state.limits = limits
+        state.messages = deque(state.messages or (), maxlen=limits.max_messages) \
+            if limits.max_messages else None
+    def _client(self, client_id):
+        state = self._clients.get(client_id)
+        if state is None:
+            state = self._clients[client_id] = _ClientRisk(self.limits)
+        return state
+
+    def position(self, client_id, symbol=None):
+        state = self._clients.get(client_id)
+        return state.positions[symbol] if state is not None else 0
+    def open_orders(self, client_id):
+        state = self._clients.get(client_id)
+        return len(state.order_ids) if state is not None else 0
+    def open_notional(self, client_id):
+        state = self._clients.get(client_id)
+        return state.open_notional if state is not None else 0.0
+
+    def _reject(self, reason):
+        self.rejections[reason] += 1
+        return reason
+    def _check(self, state, symbol, side, quantity, value, new_orders):
+        """Return the reason a change to a client's open orders would break
+        its limits, or None, counting it as a message if it would not
+        """
+        limits = state.limits
+        if limits.max_position is not None and quantity > 0:
+            if side == BUY:
+                exposure = state.positions[symbol] + state.open_quantities[BUY][symbol] + quantity
+            else:
+                exposure = state.open_quantities[side][symbol] + quantity - state.positions[symbol]
+            if exposure > limits.max_position:
+                return self._reject(POSITION)
+        if (limits.max_open_orders is not None and
+                len(state.order_ids) + new_orders > limits.max_open_orders):
+            return self._reject(OPEN_ORDERS)
+        if (limits.max_open_notional is not None and value > 0 and
+                state.open_notional + value > limits.max_open_notional):
+            return self._reject(OPEN_NOTIONAL)
+        messages = state.messages
+        if messages is not None:
+            now = self.clock()
+            if len(messages) == messages.maxlen and now - messages[0] < limits.message_interval:
+                return self._reject(MESSAGE_RATE)
+            messages.append(now)
+        return None
+
+    def check_order(self, client_id, order, symbol, last_price, resting=True):
+        """Return the reason a new order breaks the client's limits, or None
+        if it can be accepted
+
+        An order that is not resting, because it is executed straight away,
+        is only checked against the position and message rate limits.
+        """
+        value, new_orders = 0.0, 0
+        if resting:
+            value_price = order.price if order.price is not None else last_price
+            value, new_orders = order.quantity * (value_price or 0.0), 1
+        return self._check(self._client(client_id), symbol, order.side,
+                           order.quantity, value, new_orders)
+    def add_order(self, order_id, client_id, order, symbol, last_price):
+        """Count an accepted resting order as open"""
+        side = order.side
+        value_price = (order.price if order.price is not None else last_price) or 0.0
+        state = self._client(client_id)
+        state.open_quantities[side][symbol] += order.quantity
+        state.open_notional += order.quantity * value_price
+        state.order_ids.add(order_id)
+        self._orders[order_id] = [client_id, symbol, side, order.quantity, value_price]
+
+    def check_amend(self, order_id, quantity, price):
+        """Return the reason amending an open order breaks its client's limits,
+        or None
+        """
+        entry = self._orders.get(order_id)
+        if entry is None:
+            return None
+        client_id, symbol, side, open_quantity, value_price = entry
+        new_quantity, new_price = self._amended(entry, quantity, price)
+        return self._check(self._clients[client_id], symbol, side, new_quantity - open_quantity,
+                           new_quantity * new_price - open_quantity * value_price, 0)
+    def amend_order(self, order_id, quantity, price):
+        entry = self._orders.get(order_id)
+        if entry is None:
+            return
+        client_id, symbol, side, open_quantity, value_price = entry
+        new_quantity, new_price = self._amended(entry, quantity, price)
+        state = self._clients[client_id]
+        state.open_quantities[side][symbol] += new_quantity - open_quantity
+        state.open_notional += new_quantity * new_price - open_quantity * value_price
+        entry[3:] = [new_quantity, new_price]
+    def _amended(self, entry, quantity, price):
+        return (entry[3] if quantity is None else quantity,
+                entry[4] if price is None else price)
+
+    def cancel_order(self, order_id):
+        """Stop counting an order as open, if it is"""
+        entry = self._orders.pop(order_id, None)
+        if entry is not None:
+            client_id, symbol, side, open_quantity, value_price = entry
+            self._close(self._clients[client_id], order_id, symbol, side, open_quantity,
+                        value_price)
+    def cancel_orders_for_client(self, client_id):
+        """Stop counting any of a client's orders as open"""
+        state = self._clients.get(client_id)
+        if state is not None:
+            for order_id in state.order_ids:
+                del self._orders[order_id]
+            state.order_ids.clear()
+            for quantities in state.open_quantities:
+                quantities.clear()
+            state.open_notional = 0.0
+    def _close(self, state, order_id, symbol, side, quantity, value_price):
+        state.open_quantities[side][symbol] -= quantity
+        state.order_ids.discard(order_id)
+        # reset rather than leave a rounding error behind
+        state.open_notional = state.open_notional - quantity * value_price if state.order_ids else 0.0
+
+    def add_trades(self, trades):
+        """Update positions and open orders for trades"""
+        for trade in trades:
+            quantity = trade.quantity
+            for order_id, client_id, change in ((trade.buy_id, trade.buyer, quantity),
+                                                (trade.sell_id, trade.seller, -quantity)):
+                state = self._client(client_id)
+                state.positions[trade.symbol] += change
+                entry = self._orders.get(order_id)
+                if entry is None:
+                    continue
+                _, symbol, side, open_quantity, value_price = entry
+                if open_quantity > quantity:
+                    entry[3] = open_quantity - quantity
+                    state.open_quantities[side][symbol] -= quantity
+                    state.open_notional -= quantity * value_price
+                else:
+                    del self._orders[order_id]
+                    self._close(state, order_id, symbol, side, open_quantity, value_price)
+
+class TestRiskManager(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.risk = RiskManager(clock=lambda: self.now)
+        self.exchange = Exchange(risk=self.risk)
+
+    def submit(self, client_id, order, symbol=None):
+        self.exchange.current_client = client_id
+        return self.exchange.submit_order(order, symbol)
+
+    def test_position_limit(self):
+        # given a client limited to a position of 100 either way
+        self.risk.set_limits(1, RiskLimits(max_position=100))
+        # then open buys count towards the limit
+        self.assertTrue(self.submit(1, Order('buy',60,10.0)))
+        self.assertEqual(self.submit(1, Order('buy',50,10.0)), None)
+        self.assertEqual(self.risk.rejections, {POSITION: 1})
+        # and once bought, the position is what counts
+        self.submit(2, Order('sell',60,10.0))
+        self.exchange.match_orders()
+        self.assertEqual(self.risk.position(1), 60)
+        self.assertEqual(self.risk.position(2), -60)
+        self.assertEqual(self.risk.open_orders(1), 0)
+        self.assertEqual(self.submit(1, Order('buy',50,10.0)), None)
+        self.assertTrue(self.submit(1, Order('sell',160,10.0)))
+        self.assertEqual(self.submit(1, Order('sell',1,10.0)), None)
+        # and positions are per symbol
+        self.assertTrue(self.submit(1, Order('buy',100,10.0), 'AAA'))
+        # and other clients have no limits
+        self.assertTrue(self.submit(2, Order('sell',1000,10.0)))
+
+    def test_open_orders_and_notional(self):
+        self.risk.set_limits(1, RiskLimits(max_open_orders=2, max_open_notional=2000.0))
+        first = self.submit(1, Order('buy',100,10.0))
+        self.assertEqual(self.submit(1, Order('sell',200,10.0)), None)
+        self.assertEqual(self.risk.rejections, {OPEN_NOTIONAL: 1})
+        # an order without a price is valued at the last trade price
+        self.assertEqual(self.submit(1, Order('sell',11)), None)
+        self.assertTrue(self.submit(1, Order('sell',5)))
+        self.assertEqual(self.risk.open_notional(1), 1500.0)
+        self.assertEqual(self.submit(1, Order('sell',1,10.0)), None)
+        self.assertEqual(self.risk.rejections[OPEN_ORDERS], 1)
+        # cancelling frees up the limits
+        self.exchange.cancel_order(first)
+        self.assertEqual((self.risk.open_orders(1), self.risk.open_notional(1)), (1, 500.0))
+        self.assertTrue(self.submit(1, Order('sell',100,10.0)))
+        self.exchange.delete_my_orders()
+        self.assertEqual((self.risk.open_orders(1), self.risk.open_notional(1)), (0, 0.0))
+
+    def test_partial_fills(self):
+        self.risk.set_limits(1, RiskLimits(max_open_notional=1000.0))
+        self.submit(1, Order('sell',100,10.0))
+        self.submit(2, Order('buy',30,10.0))
+        self.exchange.match_orders()
+        self.assertEqual((self.risk.open_orders(1), self.risk.open_notional(1)), (1, 700.0))
+        self.assertTrue(self.submit(1, Order('sell',30,10.0)))
+
+    def test_message_rate(self):
+        self.risk.set_limits(1, RiskLimits(max_messages=2, message_interval=1.0))
+        order_id = self.submit(1, Order('buy',100,10.0))
+        self.assertTrue(self.exchange.amend_order(order_id, 50))
+        self.assertEqual(self.submit(1, Order('buy',100,10.0)), None)
+        # cancels are never rejected
+        self.assertTrue(self.exchange.cancel_order(order_id))
+        self.now = 1.0
+        self.assertTrue(self.submit(1, Order('buy',100,10.0)))
+
+    def test_amend(self):
+        self.risk.set_limits(1, RiskLimits(max_position=100, max_open_notional=1000.0))
+        order_id = self.submit(1, Order('buy',50,10.0))
+        self.assertEqual(self.exchange.amend_order(order_id, 150), None)
+        self.assertEqual(self.exchange.amend_order(order_id, price=30.0), None)
+        self.assertEqual(self.exchange.order_book()[0].quantity, 50)
+        self.assertTrue(self.exchange.amend_order(order_id, 100))
+        self.assertEqual(self.risk.open_notional(1), 1000.0)
+        self.assertEqual(self.risk.rejections, {POSITION: 1, OPEN_NOTIONAL: 1})
+
+    def test_batches_and_continuous(self):
+        # given a continuous exchange and a client allowed two open orders
+        self.exchange.continuous = True
+        self.risk.set_limits(1, RiskLimits(max_open_orders=2))
+        self.submit(2, Order('buy',100,10.0))
+        # then an order that fills completely is never open
+        self.exchange.current_client = 1
+        order_ids = self.exchange.submit_orders([Order('sell',100,10.0), Order('sell',100,11.0),
+                                                 Order('sell',100,11.0), Order('sell',100,12.0)])
+        self.assertEqual(order_ids[3], None)
+        self.assertTrue(all(order_ids[:3]))
+        self.assertEqual(self.risk.position(1), -100)
+        # and executed orders never stay open
+        self.risk.set_limits(3, RiskLimits(max_open_orders=0))
+        self.exchange.current_client = 3
+        self.assertEqual(self.exchange.execute_order(Order('buy',100)).unfilled, 0)
+        self.assertEqual(self.risk.position(3), 100)
+        # and in batch mode each order is checked against those before it
+        self.exchange.continuous = False
+        self.risk.set_limits(4, RiskLimits(max_open_orders=1))
+        self.exchange.current_client = 4
+        self.assertEqual(self.exchange.submit_order_arrays(['buy', 'buy'], [1, 1], [1.0, 1.0]),
+                         [order_ids[2] + 2, None])
+        self.assertEqual(len(self.exchange.order_book()), 2)
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,268 @@
+'''
+Monte Carlo simulation runner
+
+simulate runs one self-contained trading session: a MarketMaker quoting
+against synthetic order flow from FlowClients and market orders from a
+SimpleAlgo, on a fresh Exchange. All of its randomness comes from RNGs seeded
+from the run's seed, so a run depends only on its parameters and seed, and
+not on what else has run in the same process.
+
+run_simulations runs every point of a parameter grid with each of a list of
+seeds across a process pool, by default one process per CPU, and yields each
+run's result as it finishes. A result is a small dict of the run's
+parameters and aggregates (the market maker's PnL, position and fills, the
+traded volume and the mean spread), so books and trades never leave the
+worker. Summary accumulates results per grid point as they stream in.
+
+Run from the command line, for example:
+
+    python simulation.py --margins 0.01 0.02 0.05 --seeds 32 --rounds 500
+
+to sweep MarketMaker.MARGIN.
+'''
+from __future__ import print_function
+import argparse
+from functools import partial
+from itertools import product
+import json
+import math
+import multiprocessing
+import random
+import unittest
+from algo import SimpleAlgo, order_gen
+from exchange import SIDES, Exchange
+from market_maker import MarketMaker
+from order_flow import FlowClient, FlowGenerator
+
+# Parameters of a run, with their defaults
+PARAMETERS = (
+    ('rounds', 100),
+    ('margin', MarketMaker.MARGIN),
+    ('tick_size', 0.01),
+    ('arrival_rate', 10.0),
+    ('buy_probability', 0.5),
+    ('offset_mean', 0.0),
+    ('offset_sd', 0.01),
+    ('size_median', 100),
+)
+# Aggregates in each run's result
+RESULTS = ('pnl', 'position', 'fills', 'trades', 'volume', 'spread')
+
+def parameter_grid(**axes):
+    """Return a dict of parameters for every combination of the values given
+    for each parameter, for example parameter_grid(margin=[0.01, 0.02])
+    """
+    names = sorted(axes)
+    return [dict(zip(names, values)) for values in product(*[axes[name] for name in names])]
+
+def simulate(parameters, seed):
+    """Run one session and return a dict of its parameters, seed and results
+
+    The market maker's PnL is its cash plus its position valued at the last
+    trade price. spread is the mean over rounds of the best offer less the
+    best bid after matching, counting only rounds with both, or None.
+    """
+    settings = dict(PARAMETERS)
+    unknown = set(parameters) - set(settings)
+    if unknown:
+        raise ValueError('unknown parameters %s' % ', '.join(sorted(unknown)))
+    settings.update(parameters)
+    rng = random.Random(seed)
+    exchange = Exchange(tick_size=settings['tick_size'])
+    exchange.add_client(MarketMaker(settings['margin']))
+    # buys and sells come from separate flow clients, at the arrival rates
+    # given by buy_probability, so that they can trade with each other; flow
+    # is drawn with the random module so results do not depend on whether
+    # NumPy is installed
+    for buy_probability, share in ((1.0, settings['buy_probability']),
+                                   (0.0, 1 - settings['buy_probability'])):
+        exchange.add_client(FlowClient(FlowGenerator(
+            rng.getrandbits(64), settings['arrival_rate'] * share, buy_probability, settings['offset_mean'],
+            settings['offset_sd'], settings['size_median'], use_numpy=False), replace=True))
+    exchange.add_client(SimpleAlgo(partial(order_gen, partial(rng.choice, SIDES))))
+    # the market maker is the first client added
+    market_maker = 0
+    position = fills = trade_count = volume = 0
+    cash = spread_total = 0.0
+    quoted_rounds = 0
+    order_book = exchange.instrument().order_book
+    for _ in range(settings['rounds']):
+        exchange.do_trading()
+        for trade in exchange.match_orders():
+            trade_count += 1
+            volume += trade.quantity
+            if trade.buyer == market_maker:
+                position += trade.quantity
+                cash -= trade.quantity * trade.price
+                fills += 1
+            if trade.seller == market_maker:
+                position -= trade.quantity
+                cash += trade.quantity * trade.price
+                fills += 1
+        bid, offer = order_book.highest_buy_order(), order_book.lowest_sell_order()
+        if bid is not None and offer is not None:
+            spread_total += offer - bid
+            quoted_rounds += 1
+    result = dict(settings)
+    result.update(seed=seed, pnl=cash + position * exchange.last_trade()[0], position=position,
+                  fills=fills, trades=trade_count, volume=volume,
+                  spread=spread_total / quoted_rounds if quoted_rounds else None)
+    return result
+
+def _simulate_task(task):
+    grid_index, parameters, seed = task
+    result = simulate(parameters, seed)
+    result['grid_index'] = grid_index
+    return result
+
+def run_simulations(grid, seeds, processes=None, chunksize=1):
+    """Run every point of grid with every seed and yield the results in the
+    order they finish
+
+    Each result has the grid_index of its point in grid. processes defaults
+    to the number of CPUs; with processes=0 the runs are made one after
+    another in this process.
+    """
+    tasks = [(grid_index, parameters, seed)
+             for grid_index, parameters in enumerate(grid) for seed in seeds]
+    if processes == 0:
+        for task in tasks:
+            yield _simulate_task(task)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(_simulate_task, tasks, chunksize):
+            yield result
+        pool.close()
+    finally:
+        # also stops the workers if the caller stops iterating early
+        pool.terminate()
+        pool.join()
+
+class Statistic(object):
+    """Running count, mean, standard deviation, min and max of a series,
+    updated one value at a time (Welford's method)
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._squares = 0.0
+        self.min = None
+        self.max = None
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._squares += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+    def sd(self):
+        return math.sqrt(self._squares / (self.count - 1)) if self.count > 1 else None
+    def as_dict(self):
+        return {'count': self.count, 'mean': self.mean if self.count else None, 'sd': self.sd(),
+                'min': self.min, 'max': self.max}
+
+class Summary(object):
+    """Statistics of the results of each grid point, accumulated as results
+    arrive
+    """
+    def __init__(self, grid):
+        self.grid = grid
+        self.statistics = [dict((name, Statistic()) for name in RESULTS) for _ in grid]
+    def add(self, result):
+        statistics = self.statistics[result['grid_index']]
+        for name in RESULTS:
+            if result[name] is not None:
+                statistics[name].add(result[name])
+    def as_list(self):
+        """Return a dict for each grid point of its parameters and statistics"""
+        return [{'parameters': parameters,
+                 'results': dict((name, statistic.as_dict()) for name, statistic in statistics.items())}
+                for parameters, statistics in zip(self.grid, self.statistics)]
+
+def format_point(point):
+    results = point['results']
+    def mean_sd(name):
+        statistic = results[name]
+        if statistic['mean'] is None:
+            return '-'
+        return '%.2f +/- %.2f' % (statistic['mean'], statistic['sd'] or 0.0)
+    return '%-40s %6d %24s %20s %20s' % (
+        ' '.join('%s=%s' % item for item in sorted(point['parameters'].items())),
+        results['pnl']['count'], mean_sd('pnl'), mean_sd('volume'), mean_sd('spread'))
+
+HEADER = '%-40s %6s %24s %20s %20s' % ('parameters', 'runs', 'pnl', 'volume', 'spread')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run Monte Carlo simulations across seeds')
+    parser.add_argument('--seeds', type=int, default=16, help='runs for each parameter set')
+    parser.add_argument('--first-seed', type=int, default=0)
+    parser.add_argument('--rounds', type=int, default=dict(PARAMETERS)['rounds'])
+    parser.add_argument('--margins', type=float, nargs='+', default=[MarketMaker.MARGIN],
+                        help='MarketMaker margins to sweep')
+    parser.add_argument('--arrival-rates', type=float, nargs='+',
+                        default=[dict(PARAMETERS)['arrival_rate']],
+                        help='order flow arrival rates to sweep')
+    parser.add_argument('--processes', type=int, help='worker processes, by default one per CPU')
+    parser.add_argument('--json', metavar='PATH', help='write the summary as JSON to PATH')
+    args = parser.parse_args(argv)
+    grid = parameter_grid(rounds=[args.rounds], margin=args.margins,
+                          arrival_rate=args.arrival_rates)
+    summary = Summary(grid)
+    for result in run_simulations(grid, range(args.first_seed, args.first_seed + args.seeds),
+                                  args.processes):
+        summary.add(result)
+    points = summary.as_list()
+    print(HEADER)
+    for point in points:
+        print(format_point(point))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(points, json_file, indent=2)
+
+class TestSimulation(unittest.TestCase):
+
+    def test_parameter_grid(self):
+        self.assertEqual(parameter_grid(margin=[0.01, 0.02], rounds=[5]),
+                         [{'margin': 0.01, 'rounds': 5}, {'margin': 0.02, 'rounds': 5}])
+        self.assertEqual(parameter_grid(), [{}])
+
+    def test_runs_depend_only_on_seed(self):
+        # given the global random module in some state
+        random.seed(1)
+        first = simulate({'rounds': 20}, 7)
+        # when the same run is made after it has been used
+        random.random()
+        # then the results are the same
+        self.assertEqual(simulate({'rounds': 20}, 7), first)
+        self.assertNotEqual(simulate({'rounds': 20}, 8), first)
+        self.assertTrue(first['trades'] > 0)
+        self.assertEqual(first['margin'], MarketMaker.MARGIN)
+
+    def test_unknown_parameter(self):
+        self.assertRaises(ValueError, simulate, {'margins': 0.01}, 1)
+
+    def test_pool_matches_serial(self):
+        grid = parameter_grid(rounds=[10], margin=[0.01, 0.05])
+        serial = list(run_simulations(grid, range(3), processes=0))
+        parallel = list(run_simulations(grid, range(3), processes=2))
+        key = lambda result: (result['grid_index'], result['seed'])
+        self.assertEqual(sorted(parallel, key=key), sorted(serial, key=key))
+        self.assertEqual([result['margin'] for result in serial], [0.01] * 3 + [0.05] * 3)
+
+    def test_summary(self):
+        grid = [{}, {}]
+        summary = Summary(grid)
+        for grid_index, pnl, spread in ((0, 1.0, None), (0, 3.0, 0.5), (1, -2.0, 0.1)):
+            result = dict((name, 0) for name in RESULTS)
+            result.update(grid_index=grid_index, pnl=pnl, spread=spread)
+            summary.add(result)
+        points = summary.as_list()
+        self.assertEqual(points[0]['results']['pnl'],
+                         {'count': 2, 'mean': 2.0, 'sd': math.sqrt(2.0), 'min': 1.0, 'max': 3.0})
+        self.assertEqual(points[0]['results']['spread']['count'], 1)
+        self.assertEqual(points[1]['results']['pnl']['sd'], None)
+        json.dumps(points)
+
+if __name__ == "__main__":
+    main()
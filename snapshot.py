@@ -0,0 +1,257 @@
+'''
+Exchange snapshots
+
+save_snapshot writes an exchange's state to a file: the resting orders and
+their owners, each instrument's last trade and tick size, and the order ID
+counter. The orders are stored as one binary column per field, so
+load_snapshot reads each column straight into an array and hands slices of
+the arrays to the books. A book keeps each restored price level as columns
+until matching, a lookup by ID or a listing first reaches it, and only then
+makes its orders, so loading runs Python code per instrument and per price
+level, not per order.
+
+Client IDs must be integers or None.
+'''
+from array import array
+from itertools import compress, count
+import math
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import unittest
+from exchange import Exchange, Order
+
+MAGIC = b'EXSNAP01'
+# magic, big-endian columns, last order ID, number of instruments, number of orders
+HEADER = struct.Struct('<8sBqqq')
+# has symbol, symbol length in bytes, latest price, latest volume, tick size,
+# number of orders; followed by the symbol in UTF-8
+INSTRUMENT = struct.Struct('<BHdddq')
+# order columns, in file order, with their array type codes
+COLUMNS = (('order_ids', 'q'), ('client_ids', 'q'), ('sides', 'b'), ('quantities', 'q'),
+           ('prices', 'd'))
+
+# client ID stored for client None; None prices, volumes and tick sizes are stored as NaN
+NO_CLIENT = -1
+NAN = float('nan')
+
+def _to_float(value):
+    return NAN if value is None else value
+
+def _from_float(value):
+    return None if math.isnan(value) else value
+
+def _with_none(column, missing=None):
+    """Return a column with None in place of the value missing, or of NaN if
+    missing is None
+
+    The column is returned as it is if it has no such values, which is
+    checked without a Python call per value: NaN shows up in the sum, as the
+    other values stored are finite. Otherwise it is copied to a list and
+    only the values replaced are visited in Python.
+    """
+    if missing is None:
+        if not math.isnan(sum(column)):
+            return column
+        values = column.tolist()
+        is_missing = map(math.isnan, values)
+    else:
+        if column.count(missing) == 0:
+            return column
+        values = column.tolist()
+        is_missing = map(missing.__eq__, values)
+    for index in compress(count(), is_missing):
+        values[index] = None
+    return values
+
+def save_snapshot(exchange, path):
+    """Write a snapshot of the exchange's state to path"""
+    columns = dict((name, array(code)) for (name, code) in COLUMNS)
+    instruments = []
+    for symbol in exchange.symbols():
+        instrument = exchange.instrument(symbol)
+        entries = instrument.order_book.order_entries()
+        instruments.append((instrument, len(entries)))
+        for client_id, order in entries:
+            columns['order_ids'].append(order.order_id)
+            columns['client_ids'].append(NO_CLIENT if client_id is None else client_id)
+            columns['sides'].append(order.side)
+            columns['quantities'].append(order.quantity)
+            columns['prices'].append(_to_float(order.price))
+    with open(path, 'wb') as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, sys.byteorder == 'big', exchange.last_order_id(),
+                                        len(instruments), len(columns['order_ids'])))
+        for instrument, order_count in instruments:
+            symbol = b'' if instrument.symbol is None else instrument.symbol.encode('utf-8')
+            snapshot_file.write(INSTRUMENT.pack(
+                instrument.symbol is not None, len(symbol), instrument.latest_price,
+                _to_float(instrument.latest_volume),
+                _to_float(instrument.order_book.tick_size), order_count))
+            snapshot_file.write(symbol)
+        for name, _ in COLUMNS:
+            columns[name].tofile(snapshot_file)
+
+def load_snapshot(path, exchange=None):
+    """Restore a snapshot into an exchange and return the exchange
+
+    The exchange given, if any, should be new; by default one is created.
+    Instruments it already has take the saved tick sizes, and a ValueError
+    is raised if one with orders has a different tick size.
+    """
+    if exchange is None:
+        exchange = Exchange()
+    with open(path, 'rb') as snapshot_file:
+        data = memoryview(snapshot_file.read())
+    magic, big_endian, last_order_id, instrument_count, order_count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError('%s is not an exchange snapshot' % path)
+    offset = HEADER.size
+    instruments = []
+    for _ in range(instrument_count):
+        (has_symbol, symbol_size, latest_price, latest_volume, tick_size,
+         instrument_orders) = INSTRUMENT.unpack_from(data, offset)
+        offset += INSTRUMENT.size
+        symbol = data[offset:offset + symbol_size].tobytes().decode('utf-8') if has_symbol else None
+        offset += symbol_size
+        instruments.append((symbol, latest_price, _from_float(latest_volume),
+                            _from_float(tick_size), instrument_orders))
+    columns = {}
+    for name, code in COLUMNS:
+        column = array(code)
+        end = offset + order_count * column.itemsize
+        column.frombytes(data[offset:end])
+        if bool(big_endian) != (sys.byteorder == 'big'):
+            column.byteswap()
+        columns[name] = column
+        offset = end
+    start = 0
+    for symbol, latest_price, latest_volume, tick_size, instrument_orders in instruments:
+        if symbol not in exchange.symbols():
+            exchange.add_instrument(symbol, tick_size=tick_size)
+        instrument = exchange.instrument(symbol)
+        order_book = instrument.order_book
+        if order_book.tick_size != tick_size:
+            if order_book.order_count():
+                raise ValueError('instrument %r has tick size %r, not %r as saved' %
+                                 (symbol, order_book.tick_size, tick_size))
+            order_book.tick_size = tick_size
+        instrument.latest_price = latest_price
+        instrument.latest_volume = latest_volume
+        end = start + instrument_orders
+        exchange.restore_orders(columns['order_ids'][start:end],
+                                _with_none(columns['client_ids'][start:end], NO_CLIENT),
+                                columns['sides'][start:end], columns['quantities'][start:end],
+                                _with_none(columns['prices'][start:end]), symbol)
+        start = end
+    exchange.restore_last_order_id(last_order_id)
+    return exchange
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'exchange.snapshot')
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def state(self, exchange):
+        return [(symbol, instrument.latest_price, instrument.latest_volume,
+                 instrument.order_book.tick_size,
+                 [(client_id, order.order_id, order.buy_sell, order.quantity, order.price)
+                  for client_id, order in instrument.order_book.order_entries()])
+                for symbol, instrument in ((symbol, exchange.instrument(symbol))
+                                           for symbol in exchange.symbols())]
+
+    def test_round_trip(self):
+        # given an exchange with several instruments, trades and resting orders
+        exchange = Exchange()
+        exchange.add_instrument(u'\xc5AA', tick_size=0.05)
+        exchange.current_client = 1
+        exchange.submit_orders([Order('buy',100,10.0), Order('buy',100), Order('sell',200,10.4),
+                                Order('buy',300,10.0), Order('sell',50,9.8)], u'\xc5AA')
+        exchange.submit_order(Order('sell',100,101.0))
+        exchange.current_client = 2
+        exchange.submit_orders([Order('buy',100,10.1), Order('sell',100), Order('buy',25,10.0)], u'\xc5AA')
+        exchange.current_client = None
+        exchange.submit_order(Order('buy',100,99.0), 'BBB')
+        exchange.match_orders()
+        # when it is saved and loaded
+        save_snapshot(exchange, self.path)
+        restored = load_snapshot(self.path)
+        # then the books, owners, priorities and last trades are the same
+        self.assertEqual(self.state(restored), self.state(exchange))
+        # and order IDs carry on from the same place
+        self.assertEqual(restored.submit_order(Order('buy',1,1.0)),
+                         exchange.submit_order(Order('buy',1,1.0)))
+        # and orders can still be cancelled by their owners
+        restored.current_client = 1
+        restored.delete_my_orders()
+        self.assertEqual(set(client_id for client_id, _ in
+                             restored.instrument(u'\xc5AA').order_book.order_entries()), set([2]))
+
+    def test_saved_before_match(self):
+        # given crossing orders saved before the round was matched
+        exchange = Exchange()
+        exchange.current_client = 1
+        exchange.submit_order(Order('buy',100,10.0), 'AAA')
+        exchange.current_client = 2
+        exchange.submit_order(Order('sell',100,10.0), 'AAA')
+        save_snapshot(exchange, self.path)
+        # then the restored exchange matches them as the original would
+        restored = load_snapshot(self.path)
+        self.assertEqual([(trade.buyer, trade.seller, trade.price, trade.quantity)
+                          for trade in restored.match_orders()],
+                         [(trade.buyer, trade.seller, trade.price, trade.quantity)
+                          for trade in exchange.match_orders()])
+        self.assertEqual(restored.order_book('AAA'), [])
+
+    def test_tick_size_restored(self):
+        # given an exchange with a tick size saved and loaded into a default one
+        exchange = Exchange(tick_size=0.05)
+        exchange.submit_order(Order('buy',100,10.05))
+        save_snapshot(exchange, self.path)
+        restored = load_snapshot(self.path)
+        # then new orders are snapped to the same levels as the restored ones
+        restored.submit_order(Order('buy',100,10.07))
+        self.assertEqual(restored.depth('buy'), ((10.05, 200, 2),))
+        # and loading into a book with orders and another tick size fails
+        other = Exchange()
+        other.submit_order(Order('buy',100,10.07))
+        self.assertRaises(ValueError, load_snapshot, self.path, other)
+
+    def test_empty_exchange(self):
+        save_snapshot(Exchange(), self.path)
+        self.assertEqual(self.state(load_snapshot(self.path)), self.state(Exchange()))
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'wb') as snapshot_file:
+            snapshot_file.write(b'\0' * HEADER.size)
+        self.assertRaises(ValueError, load_snapshot, self.path)
+
+def time_restore(order_count=1000000, seed=1):
+    """Print how long it takes to save and load a book with order_count orders"""
+    rng = random.Random(seed)
+    exchange = Exchange(tick_size=0.01)
+    for client_id in range(100):
+        exchange.current_client = client_id
+        exchange.submit_order_arrays([rng.choice(('buy', 'sell')) for _ in range(order_count // 100)],
+                                     [100] * (order_count // 100),
+                                     [round(rng.uniform(50.0, 150.0), 2) for _ in range(order_count // 100)])
+    path = os.path.join(tempfile.mkdtemp(), 'exchange.snapshot')
+    try:
+        started = time.time()
+        save_snapshot(exchange, path)
+        saved = time.time()
+        load_snapshot(path, Exchange(tick_size=0.01))
+        loaded = time.time()
+        print('%s orders: save %.2fs, load %.2fs' % (order_count, saved - started, loaded - saved))
+    finally:
+        shutil.rmtree(os.path.dirname(path))
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()